@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for dsp processors and full processing chains
+
+Generates synthetic HPGe- or SiPM-like waveforms (step or fast pulses with
+exponential decay, gaussian noise and pileup) and measures the throughput in
+waveforms/s of
+  - each processor in PROCESSORS, run in a ProcessingChain for each dtype and
+    block width requested
+  - the full chain built by build_processing_chain() for dsp_bench_config.json
+    and each dsp json config found in experiments/ (or for those given with
+    -j). Configs that fail to build (e.g. referring to processors that no
+    longer exist) are reported with their error
+Results are written as json (see common.py). Runs offline.
+
+Example:
+    python bench_dsp.py -o dsp_bench.json
+    python bench_dsp.py -p trap_filter cusp_filter -b 8 16 64 --no_chains
+"""
+import os, sys, glob, json, time, argparse
+import numpy as np
+
+from common import time_it, bench_meta, write_results
+
+from pygama import lh5
+from pygama.dsp import processors
+from pygama.dsp.ProcessingChain import ProcessingChain
+from pygama.dsp.build_processing_chain import build_processing_chain
+
+
+# Processor recipes, in the style of the dsp json configs. Each is a list of
+# steps run in one ProcessingChain on input waveform "wf", so that processors
+# needing the output of another one (e.g. multi_t_filter) can be timed.
+# Strings in args/init_args are formatted with n (waveform length), t (real
+# type char) and c (complex type char) before being parsed by the chain.
+# Times are in samples.
+PROCESSORS = {
+    'bl_subtract' : [ { 'function' : 'bl_subtract', 'args' : ['wf', 1000., 'wf_out'] } ],
+    'pole_zero' : [ { 'function' : 'pole_zero', 'args' : ['wf', 40000., 'wf_out'] } ],
+    'double_pole_zero' : [ { 'function' : 'double_pole_zero', 'args' : ['wf', 40000., 200., 0.02, 'wf_out'] } ],
+    'trap_filter' : [ { 'function' : 'trap_filter', 'args' : ['wf', 625, 190, 'wf_out'] } ],
+    'trap_norm' : [ { 'function' : 'trap_norm', 'args' : ['wf', 625, 190, 'wf_out'] } ],
+    'asym_trap_filter' : [ { 'function' : 'asym_trap_filter', 'args' : ['wf', 4, 125, 190, 'wf_out'] } ],
+    'trap_pickoff' : [ { 'function' : 'trap_pickoff', 'args' : ['wf', 625, 190, 3000., 'a_out'] } ],
+    'moving_window_left' : [ { 'function' : 'moving_window_left', 'args' : ['wf', 50, 'wf_out'] } ],
+    'moving_window_right' : [ { 'function' : 'moving_window_right', 'args' : ['wf', 50, 'wf_out'] } ],
+    'moving_window_multi' : [ { 'function' : 'moving_window_multi', 'args' : ['wf', 50, 3, 'wf_out'] } ],
+    'avg_current' : [ { 'function' : 'avg_current', 'args' : ['wf', 10, 'wf_out({n}-10, {t})'] } ],
+    'soft_pileup_corr' : [ { 'function' : 'soft_pileup_corr', 'args' : ['wf', 1000, 40000., 'wf_out'] } ],
+    'fixed_time_pickoff' : [ { 'function' : 'fixed_time_pickoff', 'args' : ['wf', 3000., 'a_out'] } ],
+    'time_point_thresh' : [ { 'function' : 'time_point_thresh', 'args' : ['wf', 1100., 2500., 0, 't_out'] } ],
+    'min_max' : [ { 'function' : 'min_max', 'args' : ['wf', 't_min', 't_max', 'a_min', 'a_max'] } ],
+    'linear_slope_fit' : [ { 'function' : 'linear_slope_fit', 'args' : ['wf[0:1000]', 'mean', 'stdev', 'slope', 'intercept'] } ],
+    'saturation' : [ { 'function' : 'saturation', 'args' : ['wf', 16, 'n_lo', 'n_hi'] } ],
+    'log_check' : [ { 'function' : 'log_check', 'args' : ['wf', 'wf_out'] } ],
+    'presum' : [ { 'function' : 'presum', 'args' : ['wf', 'wf_out({n}//4, {t})'] } ],
+    'windower' : [ { 'function' : 'windower', 'args' : ['wf', 1000, 'wf_out(2000, {t})'] } ],
+    'cusp_filter' : [ { 'function' : 'cusp_filter', 'init_args' : [1000, 200., 60, 40000],
+                        'args' : ['wf', 'wf_out({n}-999, {t})'] } ],
+    'zac_filter' : [ { 'function' : 'zac_filter', 'init_args' : [1000, 200., 60, 40000],
+                       'args' : ['wf', 'wf_out({n}-999, {t})'] } ],
+    'gaussian_filter1d' : [ { 'function' : 'gaussian_filter1d', 'init_args' : [5, 4.],
+                              'args' : ['wf', 'wf_out({n}, {t})'] } ],
+    'dft' : [ { 'function' : 'dft', 'init_args' : ['wf', 'wf_dft({n}//2+1, {c})'],
+                'args' : ['wf', 'wf_dft'] } ],
+    'psd' : [ { 'function' : 'psd', 'init_args' : ['wf', 'wf_psd({n}//2+1, {t})'],
+                'args' : ['wf', 'wf_psd'] } ],
+    'multi_t_filter' : [
+        { 'function' : 'get_multi_local_extrema',
+          'args' : ['wf', 50., 'vt_max(20, {t})', 'vt_min(20, {t})', 'n_max', 'n_min', 'flag'] },
+        { 'function' : 'multi_t_filter', 'args' : ['wf', 1100., 'vt_max', 'vt_min', 't_out(20, {t})'] } ],
+}
+
+
+def make_waveforms(n_wfs, wf_len=5000, kind='hpge', dt=10., tau=400., baseline=1000.,
+                   noise=3., pileup_frac=0.05, seed=0):
+    """Make synthetic ADC waveforms
+
+    Parameters
+    ----------
+    n_wfs, wf_len : int
+        Number and length of the waveforms
+    kind : str
+        'hpge' : a single step (linear rise of 50-400 ns) at the middle of the
+            trace with a random amplitude, decaying with time constant tau
+        'sipm' : a poisson number (mean 2) of fast pulses of 1-4
+            photo-electrons at random times, decaying in 0.5 us
+    dt : float
+        Sampling period in ns
+    tau : float
+        Decay time constant in us for hpge waveforms
+    baseline, noise : float
+        Baseline level and gaussian noise sigma in ADC
+    pileup_frac : float
+        Fraction of hpge waveforms with a second step at a random time
+
+    Returns
+    -------
+    wfs : ndarray
+        (n_wfs, wf_len) uint16 array
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(wf_len, dtype='float64')
+    wfs = rng.normal(baseline, noise, size=(n_wfs, wf_len))
+
+    def add_pulses(i_wf, t0, amp, rise, decay):
+        # add pulses with linear rise time and exponential decay (all in samples)
+        dt0 = t[None,:] - t0[:,None]
+        shape = np.clip(dt0/rise[:,None], 0, 1) * np.exp(-np.clip(dt0, 0, None)/decay[:,None])
+        np.add.at(wfs, i_wf, amp[:,None]*shape)
+
+    if kind == 'hpge':
+        i_wf = np.arange(n_wfs)
+        add_pulses(i_wf, rng.normal(wf_len*0.45, 10, n_wfs), rng.uniform(100, 8000, n_wfs),
+                   rng.uniform(50, 400, n_wfs)/dt, np.full(n_wfs, tau*1000/dt))
+        i_wf = np.flatnonzero(rng.random(n_wfs) < pileup_frac)
+        n = len(i_wf)
+        add_pulses(i_wf, rng.uniform(0, wf_len, n), rng.uniform(100, 8000, n),
+                   rng.uniform(50, 400, n)/dt, np.full(n, tau*1000/dt))
+    elif kind == 'sipm':
+        n_pulses = rng.poisson(2, n_wfs)
+        i_wf = np.repeat(np.arange(n_wfs), n_pulses)
+        n = len(i_wf)
+        add_pulses(i_wf, rng.uniform(0, wf_len, n), 20.*rng.integers(1, 5, n),
+                   np.full(n, 2.), np.full(n, 500/dt))
+    else: raise ValueError('unknown waveform kind ' + kind)
+    return np.clip(np.rint(wfs), 0, 2**16-1).astype('uint16')
+
+
+def make_raw_table(wfs, dt=10.):
+    """Wrap waveforms in a raw-like lh5 Table, as read by raw_to_dsp"""
+    n_wfs = len(wfs)
+    wf_tbl = lh5.Table(col_dict={
+        't0' : lh5.Array(nda=np.zeros(n_wfs, dtype='float32'), attrs={'units':'ns'}),
+        'dt' : lh5.Array(nda=np.full(n_wfs, dt, dtype='float32'), attrs={'units':'ns'}),
+        'values' : lh5.ArrayOfEqualSizedArrays(nda=wfs, dims=[1,1]) })
+    return lh5.Table(col_dict={
+        'waveform' : wf_tbl,
+        'baseline' : lh5.Array(nda=wfs[:,:100].mean(axis=1).astype('uint16')),
+        'timestamp' : lh5.Array(nda=np.arange(n_wfs, dtype='float64')),
+        'channel' : lh5.Array(nda=np.zeros(n_wfs, dtype='uint32')) })
+
+
+def build_processor_chain(steps, wfs, dtype, block_width):
+    """Build a ProcessingChain running steps (see PROCESSORS) on wfs"""
+    wf_len = wfs.shape[1]
+    fmt = { 'n' : wf_len, 't' : np.dtype(dtype).char,
+            'c' : np.result_type(dtype, np.complex64).char }
+    pc = ProcessingChain(block_width, len(wfs), verbosity=0)
+    pc.add_input_buffer('wf', wfs, dtype)
+    for step in steps:
+        func = getattr(processors, step['function'])
+        if 'init_args' in step:
+            init_args = [ pc.get_variable(a.format(**fmt)) if isinstance(a, str) else a
+                          for a in step['init_args'] ]
+            func = func(*init_args)
+        args = [ a.format(**fmt) if isinstance(a, str) else a for a in step['args'] ]
+        pc.add_processor(func, *args, **step.get('kwargs', {}))
+    return pc
+
+
+def find_dsp_configs(repo_dir):
+    """dsp_bench_config.json, and the dsp json configs in experiments/ (json
+    files with 'processors' and 'outputs')"""
+    configs = [os.path.join(repo_dir, 'benchmarks', 'dsp_bench_config.json')]
+    for f in sorted(glob.glob(os.path.join(repo_dir, 'experiments', '*', '*.json'))):
+        try:
+            with open(f) as jf: config = json.load(jf)
+        except (ValueError, UnicodeDecodeError): continue
+        if isinstance(config, dict) and 'processors' in config and 'outputs' in config:
+            configs.append(f)
+    return configs
+
+
+def bench_processors(args, wfs):
+    results = []
+    n_wfs = len(wfs)
+    for name in args.processors:
+        for dtype in args.dtypes:
+            for block_width in args.block_widths:
+                res = { 'bench' : 'processor', 'name' : name, 'dtype' : dtype,
+                        'block_width' : block_width, 'n_wfs' : n_wfs, 'wf_len' : wfs.shape[1] }
+                try:
+                    pc = build_processor_chain(PROCESSORS[name], wfs, dtype, block_width)
+                    res.update(time_it(pc.execute, args.repeat, n_warmup=1))
+                    res['wfs_per_s'] = n_wfs / res['median_s']
+                except Exception as e:
+                    res['error'] = f'{type(e).__name__}: {e}'
+                results.append(res)
+                if args.verbose: print_result(res)
+    return results
+
+
+def bench_chains(args, raw_tbl):
+    results = []
+    n_wfs = len(raw_tbl)
+    for config_file in args.configs:
+        for block_width in args.block_widths:
+            res = { 'bench' : 'chain', 'name' : os.path.relpath(config_file, args.repo_dir),
+                    'dtype' : 'float32', 'block_width' : block_width, 'n_wfs' : n_wfs,
+                    'wf_len' : raw_tbl['waveform']['values'].nda.shape[1] }
+            try:
+                t0 = time.perf_counter()
+                pc, mask, tb_out = build_processing_chain(raw_tbl, config_file, verbosity=0,
+                                                          block_width=block_width)
+                res['build_s'] = time.perf_counter() - t0
+                res.update(time_it(pc.execute, args.repeat, n_warmup=1))
+                res['wfs_per_s'] = n_wfs / res['median_s']
+            except Exception as e:
+                res['error'] = f'{type(e).__name__}: {e}'
+            results.append(res)
+            if args.verbose: print_result(res)
+    return results
+
+
+def print_result(res):
+    label = f"{res['bench']:>9} {res['name']:>36} {res['dtype']:>7} {res['block_width']:>4}"
+    if 'error' in res: print(label + ': ' + res['error'].split('\n')[0][:80])
+    else: print(label + f": {res['median_s']*1e3:9.2f} ms, {res['wfs_per_s']:.3g} wfs/s")
+
+
+def main():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg = parser.add_argument
+    arg('-o', '--output', default='dsp_bench.json', help="json output file. Default dsp_bench.json")
+    arg('-n', '--n_wfs', default=2048, type=int, help="Number of waveforms. Default 2048")
+    arg('-w', '--wf_len', default=5000, type=int, help="Waveform length in samples. Default 5000")
+    arg('-k', '--kind', default='hpge', choices=['hpge', 'sipm'],
+        help="Kind of waveforms for the processor benchmarks. Default hpge")
+    arg('-p', '--processors', nargs='+', default=list(PROCESSORS), choices=list(PROCESSORS),
+        help="Processors to benchmark. Default all")
+    arg('-d', '--dtypes', nargs='+', default=['float32', 'float64'], help="Default float32 float64")
+    arg('-b', '--block_widths', nargs='+', default=[16, 64], type=int, help="Default 16 64")
+    arg('-j', '--configs', nargs='+', default=None,
+        help="dsp json configs for the chain benchmarks. Default: dsp_bench_config.json and all in experiments/")
+    arg('--no_processors', action='store_true', help="Skip the processor benchmarks")
+    arg('--no_chains', action='store_true', help="Skip the full chain benchmarks")
+    arg('-r', '--repeat', default=3, type=int, help="Repetitions of each benchmark. Default 3")
+    arg('-q', '--quiet', dest='verbose', action='store_false', help="Don't print results")
+    args = parser.parse_args()
+    args.repo_dir = repo_dir
+    if args.configs is None: args.configs = find_dsp_configs(repo_dir)
+
+    t_start = time.time()
+    results = []
+    if not args.no_processors:
+        wfs = make_waveforms(args.n_wfs, args.wf_len, kind=args.kind)
+        results += bench_processors(args, wfs)
+    if not args.no_chains:
+        raw_tbl = make_raw_table(make_waveforms(args.n_wfs, args.wf_len, kind='hpge'))
+        results += bench_chains(args, raw_tbl)
+    write_results(args.output, bench_meta(vars(args)), results)
+    if args.verbose: print(f'Done in {time.time()-t_start:.1f} s. Results written to {args.output}')
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the lh5 I/O layer
+
+Generates synthetic lh5 files and times Store.write_object appends, chunked
+Store.read_object with and without obj_buf, fancy-index reads, load_nda over
+many files and read_n_rows. Results are written as json (see common.py) so
+that they can be compared across commits. Runs offline, in a temporary
+directory unless --tmpdir is given.
+
+Example:
+    python bench_lh5.py -o lh5_bench.json
+    python bench_lh5.py -l dsp wf -n 100000 -r 5
+"""
+import os, sys, time, tempfile, argparse
+import numpy as np
+
+from common import time_it, bench_meta, write_results
+
+import pygama.lh5 as lh5
+
+
+LAYOUTS = ['dsp', 'wf', 'vov', 'multichannel']
+
+
+def make_table(layout, n_rows, n_cols=20, wf_len=1000, vov_mean_len=10, seed=0):
+    """Make a synthetic lh5 Table
+
+    layout : str
+        'dsp' : n_cols float32 columns, plus a uint64 timestamp
+        'wf' : 2-D uint16 waveforms of length wf_len, plus a timestamp
+        'vov' : jagged float32 data (poisson lengths with mean vov_mean_len),
+            e.g. SiPM hit lists, plus a timestamp
+        'multichannel' : same as 'dsp' (one table per channel, see
+            table_names())
+    """
+    rng = np.random.default_rng(seed)
+    col_dict = { 'timestamp' : lh5.Array(nda=np.arange(n_rows, dtype='uint64')) }
+    if layout in ['dsp', 'multichannel']:
+        for i in range(n_cols):
+            col_dict[f'par{i}'] = lh5.Array(nda=rng.normal(size=n_rows).astype('float32'))
+    elif layout == 'wf':
+        nda = rng.integers(0, 2**14, size=(n_rows, wf_len), dtype='uint16')
+        col_dict['values'] = lh5.ArrayOfEqualSizedArrays(nda=nda, dims=[1,1])
+    elif layout == 'vov':
+        lens = rng.poisson(vov_mean_len, size=n_rows)
+        cl = np.cumsum(lens).astype('uint32')
+        fd = rng.normal(size=int(cl[-1]) if n_rows > 0 else 0).astype('float32')
+        col_dict['hits'] = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=fd),
+                                               cumulative_length=lh5.Array(nda=cl))
+    else: raise ValueError('unknown layout ' + layout)
+    return lh5.Table(col_dict=col_dict)
+
+
+def table_names(layout, n_channels):
+    """The (group path, name) of the tables written for layout"""
+    if layout == 'multichannel': return [(f'ch{i:03d}', 'dsp') for i in range(n_channels)]
+    return [(layout, 'tb')]
+
+
+def table_nbytes(tbl):
+    """Total in-memory size of the data in tbl"""
+    n = 0
+    for col in tbl.values():
+        if isinstance(col, lh5.VectorOfVectors):
+            n += col.cumulative_length.nda.nbytes + col.flattened_data.nda.nbytes
+        else: n += col.nda.nbytes
+    return n
+
+
+def write_file(filename, tbl, names, chunk_len, amortize):
+    """Append tbl to filename in chunks of chunk_len rows for each of names"""
+    if os.path.exists(filename): os.remove(filename)
+    store = lh5.Store(keep_open=True, amortize_appends=amortize)
+    n_rows = len(tbl)
+    for start in range(0, n_rows, chunk_len):
+        n = min(chunk_len, n_rows - start)
+        for group, name in names:
+            store.write_object(tbl, name, filename, group=group, start_row=start, n_rows=n)
+    store.close()
+
+
+def run_layout(layout, args, tmpdir):
+    """Run all benchmarks for one layout. Returns a list of result dicts"""
+    results = []
+    tbl = make_table(layout, args.n_rows, n_cols=args.n_cols, wf_len=args.wf_len,
+                     vov_mean_len=args.vov_len)
+    names = table_names(layout, args.n_channels)
+    n_rows_total = args.n_rows * len(names)
+    nbytes_total = table_nbytes(tbl) * len(names)
+    def add(bench, timing, n_rows=n_rows_total, nbytes=nbytes_total, **params):
+        res = { 'layout' : layout, 'bench' : bench, 'n_rows' : n_rows,
+                'nbytes' : nbytes, **params, **timing }
+        t = timing['median_s']
+        res['rows_per_s'] = n_rows / t if t > 0 else None
+        res['MB_per_s'] = nbytes / 1e6 / t if t > 0 and nbytes is not None else None
+        results.append(res)
+        if args.verbose:
+            print(f"{layout:>12} {bench:>18} {str(params):>32}: "
+                  f"{timing['median_s']*1e3:9.2f} ms, {res['rows_per_s']:.3g} rows/s")
+
+    # write_object appends
+    f_main = os.path.join(tmpdir, f'{layout}_0.lh5')
+    for amortize in [False, True]:
+        t = time_it(lambda: write_file(f_main, tbl, names, args.chunk, amortize), args.repeat)
+        add('write_object', t, chunk_len=args.chunk, amortize_appends=amortize)
+
+    # chunked reads, with and without obj_buf
+    store = lh5.Store(keep_open=True)
+    def read_chunked(use_buf):
+        for group, name in names:
+            path = f'{group}/{name}'
+            buf = store.get_buffer(path, f_main, size=args.chunk) if use_buf else None
+            for start in range(0, args.n_rows, args.chunk):
+                obj, n = store.read_object(path, f_main, start_row=start, n_rows=args.chunk, obj_buf=buf)
+    for use_buf in [False, True]:
+        t = time_it(lambda: read_chunked(use_buf), args.repeat)
+        add('read_object', t, chunk_len=args.chunk, obj_buf=use_buf)
+
+    # fancy-index reads of a random fraction of the rows
+    rng = np.random.default_rng(1)
+    idx = np.sort(rng.choice(args.n_rows, size=max(1, int(args.n_rows*args.idx_frac)), replace=False))
+    fields = [f for f in tbl.keys() if not isinstance(tbl[f], lh5.VectorOfVectors)]
+    def read_idx():
+        for group, name in names:
+            store.read_object(f'{group}/{name}', f_main, idx=idx, field_mask=fields)
+    t = time_it(read_idx, args.repeat)
+    add('read_object_idx', t, n_rows=len(idx)*len(names), nbytes=None, idx_frac=args.idx_frac)
+    store.close()
+
+    # many files: load_nda and read_n_rows
+    files = [f_main]
+    for i in range(1, args.n_files):
+        f = os.path.join(tmpdir, f'{layout}_{i}.lh5')
+        write_file(f, tbl, names, args.n_rows, True)
+        files.append(f)
+    group, name = names[0]
+    path = f'{group}/{name}'
+    par = fields[1] if len(fields) > 1 else fields[0]
+    t = time_it(lambda: lh5.load_nda(files, [par], path, verbose=False), args.repeat)
+    add('load_nda', t, n_rows=args.n_rows*len(files), nbytes=tbl[par].nda.nbytes*len(files),
+        n_files=len(files), n_threads=1)
+    if args.n_threads > 1:
+        t = time_it(lambda: lh5.load_nda(files, [par], path, verbose=False, n_threads=args.n_threads), args.repeat)
+        add('load_nda', t, n_rows=args.n_rows*len(files), nbytes=tbl[par].nda.nbytes*len(files),
+            n_files=len(files), n_threads=args.n_threads)
+
+    def read_n_rows():
+        store = lh5.Store()
+        for f in files: store.read_n_rows(path, f)
+    t = time_it(read_n_rows, args.repeat)
+    add('read_n_rows', t, n_rows=len(files), nbytes=None, n_files=len(files))
+
+    for f in files: os.remove(f)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg = parser.add_argument
+    arg('-o', '--output', default='lh5_bench.json', help="json output file. Default lh5_bench.json")
+    arg('-l', '--layouts', nargs='+', default=LAYOUTS, choices=LAYOUTS, help="Layouts to benchmark. Default all")
+    arg('-n', '--n_rows', default=50000, type=int, help="Rows per table. Default 50000")
+    arg('-c', '--chunk', default=3200, type=int, help="Rows per write/read chunk. Default 3200")
+    arg('--n_cols', default=20, type=int, help="Number of columns for dsp layouts. Default 20")
+    arg('--wf_len', default=1000, type=int, help="Waveform length for the wf layout. Default 1000")
+    arg('--vov_len', default=10, type=int, help="Mean vector length for the vov layout. Default 10")
+    arg('--n_channels', default=16, type=int, help="Channels in the multichannel layout. Default 16")
+    arg('--n_files', default=10, type=int, help="Files for load_nda/read_n_rows. Default 10")
+    arg('--n_threads', default=4, type=int, help="Threads for the threaded load_nda. Default 4")
+    arg('--idx_frac', default=0.1, type=float, help="Fraction of rows for fancy-index reads. Default 0.1")
+    arg('-r', '--repeat', default=3, type=int, help="Repetitions of each benchmark. Default 3")
+    arg('--tmpdir', default=None, help="Directory for the test files. Default: a new temporary directory")
+    arg('-q', '--quiet', dest='verbose', action='store_false', help="Don't print results")
+    args = parser.parse_args()
+
+    t_start = time.time()
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        for layout in args.layouts: results += run_layout(layout, args, tmpdir)
+    write_results(args.output, bench_meta(vars(args)), results)
+    if args.verbose: print(f'Done in {time.time()-t_start:.1f} s. Results written to {args.output}')
+
+
+if __name__=="__main__":
+    main()
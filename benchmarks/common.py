@@ -0,0 +1,56 @@
+"""
+Helpers shared by the benchmark scripts
+
+Results files are json with two keys:
+    "meta" : the benchmark parameters and info on the machine, package
+        versions and git revision, so that runs can be compared across commits
+    "results" : a list of dicts, one per measurement, each with at least the
+        timing keys from time_it()
+"""
+import os, sys, time, json, platform, subprocess
+import numpy as np
+
+
+def time_it(func, n_repeat=3, n_warmup=0):
+    """Call func() n_repeat times (after n_warmup untimed calls) and return
+    a dict of timing statistics in seconds"""
+    for i in range(n_warmup): func()
+    times = []
+    for i in range(n_repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return { 'min_s' : min(times), 'median_s' : float(np.median(times)),
+             'mean_s' : float(np.mean(times)), 'n_repeat' : n_repeat }
+
+
+def git_revision():
+    """The git revision of the working tree, or None if not in a git repo"""
+    try:
+        rev = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return rev.stdout.strip() if rev.returncode == 0 else None
+    except OSError: return None
+
+
+def bench_meta(params):
+    """Metadata to be stored with the results of a benchmark run"""
+    import h5py
+    from pygama import __version__ as pygama_version
+    return { 'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'git_revision' : git_revision(),
+             'pygama_version' : pygama_version,
+             'python_version' : sys.version.split()[0],
+             'numpy_version' : np.__version__,
+             'h5py_version' : h5py.version.version,
+             'hdf5_version' : h5py.version.hdf5_version,
+             'platform' : platform.platform(),
+             'processor' : platform.processor(),
+             'n_cpus' : os.cpu_count(),
+             'params' : params }
+
+
+def write_results(filename, meta, results):
+    """Write meta and results to json file filename"""
+    with open(filename, 'w') as f:
+        json.dump({ 'meta' : meta, 'results' : results }, f, indent=2, default=str)
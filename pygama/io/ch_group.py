@@ -1,3 +1,5 @@
+import numpy as np
+
 from pygama import lh5
 
 def expand_ch_groups(ch_groups):
@@ -117,6 +119,90 @@ def get_list_of(key, ch_groups):
 
 
 
+class ChannelTables:
+    """ the tables of a set of channel groups, indexed by channel
+
+    Channels (e.g. ORCA ccc's or FlashCam adc indices) are routed to the
+    table of their group through a dense look-up array: self.slots[ch] is the
+    index of the channel's table in self.tables, or -1 for channels without a
+    table. Routing a channel or an array of channels is then an array
+    look-up. Hits in channels without a table are counted per channel in
+    self.n_skipped.
+
+    Supports the dict-style access ch_to_tbls[ch] and ch in ch_to_tbls.
+    """
+    def __init__(self):
+        self.tables = []
+        self.slots = np.full(0, -1, dtype='int32')
+        self.n_skipped = np.zeros(0, dtype='int64')
+
+
+    def add_table(self, tbl, ch_list):
+        """ route the channels in ch_list to tbl. Returns tbl's slot """
+        slot = len(self.tables)
+        self.tables.append(tbl)
+        ch_list = np.asarray(ch_list, dtype='int64')
+        if len(ch_list) > 0 and ch_list.max() >= len(self.slots):
+            slots = np.full(ch_list.max()+1, -1, dtype='int32')
+            slots[:len(self.slots)] = self.slots
+            self.slots = slots
+        self.slots[ch_list] = slot
+        return slot
+
+
+    def get_slots(self, chs):
+        """ the table slots of an array of channels (-1: no table) """
+        chs = np.asarray(chs)
+        if len(chs) > 0 and chs.max() >= len(self.slots):
+            slots = np.full(len(chs), -1, dtype='int32')
+            in_range = chs < len(self.slots)
+            slots[in_range] = self.slots[chs[in_range]]
+            return slots
+        return self.slots[chs]
+
+
+    def get_table(self, ch):
+        """ the table for channel ch, or None (counting the hit as skipped) """
+        slot = self.slots[ch] if ch < len(self.slots) else -1
+        if slot >= 0: return self.tables[slot]
+        if ch >= len(self.n_skipped): self.n_skipped = np.resize(self.n_skipped, ch+1)
+        self.n_skipped[ch] += 1
+        return None
+
+
+    def count_skipped(self, chs):
+        """ count hits in an array of channels without a table """
+        if len(chs) == 0: return
+        counts = np.bincount(chs, minlength=len(self.n_skipped))
+        counts[:len(self.n_skipped)] += self.n_skipped
+        self.n_skipped = counts
+
+
+    def skipped_channels(self):
+        """ dict of the number of skipped hits for each skipped channel """
+        chs = np.flatnonzero(self.n_skipped)
+        return dict(zip(chs.tolist(), self.n_skipped[chs].tolist()))
+
+
+    def __getitem__(self, ch):
+        tbl = self.tables[self.slots[ch]] if ch < len(self.slots) and self.slots[ch] >= 0 else None
+        if tbl is None: raise KeyError(ch)
+        return tbl
+
+
+    def __contains__(self, ch):
+        return 0 <= ch < len(self.slots) and self.slots[ch] >= 0
+
+
+    def keys(self):
+        return np.flatnonzero(self.slots >= 0).tolist()
+
+
+    def items(self):
+        return [ (ch, self.tables[self.slots[ch]]) for ch in self.keys() ]
+
+
+
 def build_tables(ch_groups, buffer_size, init_obj=None):
     """ build tables and associated I/O info for the channel groups.
 
@@ -128,12 +214,12 @@ def build_tables(ch_groups, buffer_size, init_obj=None):
 
     Returns
     -------
-    ch_to_tbls : dict or Table
-        A channel-indexed dictionary of tables for quick look-up, or if passed a
-        dummy group (no group name), return the one table made.
+    ch_to_tbls : ChannelTables or Table
+        The tables indexed by channel for quick look-up, or if passed a dummy
+        group (no group name), return the one table made.
     """
 
-    ch_to_tbls = {} 
+    ch_to_tbls = ChannelTables()
 
     # set up a table for each group
     for group_name, group_info in ch_groups.items():
@@ -154,12 +240,55 @@ def build_tables(ch_groups, buffer_size, init_obj=None):
                 return None
             return tbl
 
-        # cache the table to a ch-indexed dict for quick look-up
-        for ch in group_info['ch_list']: ch_to_tbls[ch] = tbl
+        # route the group's channels to the table
+        group_info['slot'] = ch_to_tbls.add_table(tbl, group_info['ch_list'])
 
     return ch_to_tbls
 
 
+def replace_table(group_info, new_tbl, ch_to_tbls):
+    """ swap in a new table for a channel group, e.g. the recycled table
+    returned by lh5.AsyncWriter.submit()
+
+    Parameters
+    ----------
+    group_info : dict
+        the ch_groups entry whose table gets replaced
+    new_tbl : Table
+    ch_to_tbls : ChannelTables or Table
+        the output of build_tables() for the ch_groups containing group_info
+
+    Returns
+    -------
+    ch_to_tbls : ChannelTables or Table
+        ch_to_tbls with the group's channels pointing to new_tbl (for a dummy
+        group, new_tbl itself)
+    """
+    group_info['table'] = new_tbl
+    if isinstance(ch_to_tbls, lh5.Table): return new_tbl
+    ch_to_tbls.tables[group_info['slot']] = new_tbl
+    return ch_to_tbls
+
+
+def create_outputs(ch_groups, lh5_store):
+    """ write each group's table with no rows to its output file
+
+    Creates all output datasets up front, as required before switching the
+    output files to SWMR mode (see lh5.Store.start_swmr()).
+
+    Returns
+    -------
+    out_files : set
+        the names of the output files
+    """
+    out_files = set()
+    for group_info in ch_groups.values():
+        lh5_store.write_object(group_info['table'], group_info['group_path'],
+                               group_info['out_file'], n_rows=0)
+        out_files.add(group_info['out_file'])
+    return out_files
+
+
 def set_outputs(ch_groups, out_file_template=None, grp_path_template='{group_name}'):
     ''' Set up output filenames and/or group paths for the channel group
 
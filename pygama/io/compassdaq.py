@@ -1,15 +1,23 @@
+import os, time
 import numpy as np
-import pandas as pd
-from .io_base import DataTaker
 
-class CAENDT57XX(DataTaker):
+from .io_base import DataDecoder
+from pygama import lh5
+
+
+class CAENDT57XX(DataDecoder):
     """
     decode CAENDT5725 or CAENDT5730 digitizer data.
-    
+
     Setting the model_name will set the appropriate sample_rate
     Use the input_config function to set certain variables by passing
     a dictionary, this will most importantly assemble the file header used
     by CAEN CoMPASS to label output files.
+
+    CoMPASS binary files are a sequence of fixed-size events (all waveforms in
+    a file have the same length), so a file is decoded as a whole by viewing
+    it as a numpy structured array with get_event_dtype(), see
+    process_compass().
     """
     def __init__(self, *args, **kwargs):
         self.id = None
@@ -26,19 +34,39 @@ class CAENDT57XX(DataTaker):
         self.v_range = 2.0
 
         self.e_cal = None
-        self.e_type = None
+        self.e_type = "uncalibrated"
         self.int_window = None
-        self.parameters = ["TIMETAG", "ENERGY", "E_SHORT", "FLAGS"]
 
         self.decoded_values = {
-            "board": None,
-            "channel": None,
-            "timestamp": None,
-            "energy": None,
-            "energy_short": None,
-            "flags": None,
-            "num_samples": None,
-            "waveform": []
+            "board": { # digitizer board number
+              "dtype": "uint16",
+            },
+            "channel": { # channel on the board
+              "dtype": "uint16",
+            },
+            "timestamp": { # trigger time tag
+              "dtype": "uint64",
+              "units": "ps",
+            },
+            "energy": { # long-gate energy. float64 for e_type "calibrated"
+              "dtype": "uint16",
+            },
+            "energy_short": { # short-gate energy
+              "dtype": "uint16",
+            },
+            "flags": {
+              "dtype": "uint32",
+            },
+            "num_samples": {
+              "dtype": "uint32",
+            },
+            "waveform": {
+              "dtype": "uint16",
+              "datatype": "waveform",
+              "length": 0, # set from the file, see set_num_samples()
+              "sample_period": 1e9/self.sample_rate,
+              "sample_period_units": "ns",
+            },
         }
         super().__init__(*args, **kwargs)
 
@@ -47,16 +75,30 @@ class CAENDT57XX(DataTaker):
         self.id = config["id"]
         self.v_range = config["v_range"]
         self.e_cal = config["e_cal"]
-        self.e_type = config["e_type"]
+        self.set_e_type(config["e_type"])
         self.int_window = config["int_window"]
         self.file_header = "CH_"+str(config["channel"])+"@"+self.model_name+"_"+str(config["id"])+"_Data_"
 
 
+    def set_e_type(self, e_type):
+        """ set the type of energy in the file: uncalibrated or calibrated """
+        if e_type == "uncalibrated": self.decoded_values["energy"]["dtype"] = "uint16"
+        elif e_type == "calibrated": self.decoded_values["energy"]["dtype"] = "float64"
+        else:
+            raise TypeError("Invalid e_type! Valid e_type's: uncalibrated, calibrated")
+        self.e_type = e_type
+
+
+    def set_num_samples(self, num_samples):
+        """ set the waveform length of the output tables """
+        self.decoded_values["waveform"]["length"] = num_samples
+
+
     def get_event_size(self, t0_file):
         with open(t0_file, "rb") as file:
             if self.e_type == "uncalibrated":
                 first_event = file.read(24)
-                [num_samples] = np.frombuffer(first_event[20:24], dtype=np.uint16)
+                [num_samples] = np.frombuffer(first_event[20:24], dtype=np.uint32)
                 return 24 + 2*num_samples
             elif self.e_type == "calibrated":
                 first_event = file.read(30)
@@ -66,88 +108,103 @@ class CAENDT57XX(DataTaker):
                 raise TypeError("Invalid e_type! Valid e_type's: uncalibrated, calibrated")
 
 
-    def get_event(self, event_data_bytes):
-        self.decoded_values["board"] = np.frombuffer(event_data_bytes[0:2], dtype=np.uint16)[0]
-        self.decoded_values["channel"] = np.frombuffer(event_data_bytes[2:4], dtype=np.uint16)[0]
-        self.decoded_values["timestamp"] = np.frombuffer(event_data_bytes[4:12], dtype=np.uint64)[0]
-        if self.e_type == "uncalibrated":
-            self.decoded_values["energy"] = np.frombuffer(event_data_bytes[12:14], dtype=np.uint16)[0]
-            self.decoded_values["energy_short"] = np.frombuffer(event_data_bytes[14:16], dtype=np.uint16)[0]
-            self.decoded_values["flags"] = np.frombuffer(event_data_bytes[16:20], np.uint32)[0]
-            self.decoded_values["num_samples"] = np.frombuffer(event_data_bytes[20:24], dtype=np.uint32)[0]
-            self.decoded_values["waveform"] = np.frombuffer(event_data_bytes[24:], dtype=np.uint16)
-        elif self.e_type == "calibrated":
-            self.decoded_values["energy"] = np.frombuffer(event_data_bytes[12:20], dtype=np.float64)[0]
-            self.decoded_values["energy_short"] = np.frombuffer(event_data_bytes[20:22], dtype=np.uint16)[0]
-            self.decoded_values["flags"] = np.frombuffer(event_data_bytes[22:26], np.uint32)[0]
-            self.decoded_values["num_samples"] = np.frombuffer(event_data_bytes[26:30], dtype=np.uint32)[0]
-            self.decoded_values["waveform"] = np.frombuffer(event_data_bytes[30:], dtype=np.uint16)
-        else:
-            raise TypeError("Invalid e_type! Valid e_type's: uncalibrated, calibrated")
-        return self.assemble_data_row()
-
-
-    def assemble_data_row(self):
-        timestamp = self.decoded_values["timestamp"]
-        energy = self.decoded_values["energy"]
-        energy_short = self.decoded_values["energy_short"]
-        flags = self.decoded_values["flags"]
-        waveform = self.decoded_values["waveform"]
-        return [timestamp, energy, energy_short, flags], waveform
-
-
-    def create_dataframe(self, array):
-        waveform_labels = [str(item) for item in list(range(self.decoded_values["num_samples"]-1))]
-        column_labels = self.parameters + waveform_labels
-        dataframe = pd.DataFrame(data=array, columns=column_labels, dtype=float)
-        return dataframe
-
-
-
-def process_compass(daq_filename, raw_filename, digitizer, output_dir=None):
+    def get_event_dtype(self, num_samples):
+        """
+        numpy structured dtype of one CoMPASS event (little endian, packed)
+        with waveforms of num_samples samples
+        """
+        energy_dtype = "<u2" if self.e_type == "uncalibrated" else "<f8"
+        return np.dtype([("board", "<u2"),
+                         ("channel", "<u2"),
+                         ("timestamp", "<u8"),
+                         ("energy", energy_dtype),
+                         ("energy_short", "<u2"),
+                         ("flags", "<u4"),
+                         ("num_samples", "<u4"),
+                         ("waveform", "<u2", (num_samples,))])
+
+
+    def decode_events(self, events, lh5_table):
+        """
+        Copy a structured array of events (see get_event_dtype()) into the
+        next rows of lh5_table. Returns the number of events copied, which is
+        limited by the space left in lh5_table
+        """
+        n = min(len(events), lh5_table.size - lh5_table.loc)
+        rows = slice(lh5_table.loc, lh5_table.loc + n)
+        for field in ["board", "channel", "timestamp", "energy", "energy_short", "flags", "num_samples"]:
+            lh5_table[field].nda[rows] = events[field][:n]
+        lh5_table["waveform"]["values"].nda[rows] = events["waveform"][:n]
+        lh5_table.loc += n
+        return n
+
+
+
+def process_compass(daq_filename, raw_filename, digitizer=None, output_dir=None,
+                    n_max=np.inf, buffer_size=8192, e_type="uncalibrated", verbose=False):
     """
     Takes an input .bin file name as daq_filename from CAEN CoMPASS and outputs raw_filename
     daq_filename: input file name, string type
-    raw_filename: output file name, string type
-    digitizer: CAEN digitizer, Digitizer type
-    options are uncalibrated or calibrated.  Select the one that was outputted by CoMPASS, string type
-    output_dir: path to output directory string type
+    raw_filename: output (lh5) file name, string type
+    digitizer: CAEN digitizer, CAENDT57XX type. Default: a CAENDT57XX set up
+        for e_type
+    output_dir: path to output directory string type. Default: raw_filename
+        is used as is
+    n_max: maximum number of events to decode
+    buffer_size: number of events decoded and written at a time. Memory use
+        is bounded by buffer_size events
+    e_type: uncalibrated or calibrated.  Select the one that was outputted by
+        CoMPASS, string type. Only used if no digitizer is given
+    verbose: print the progress
+
+    The file is memory-mapped as a structured array of fixed-size events,
+    which are copied a buffer_size chunk at a time into an lh5 Table written
+    to CAENDT57XX/raw in the output file.
+
+    Returns the number of bytes decoded
     """
-    start = time.time()
-    f_in = open(daq_filename.encode("utf-8"), "rb")
-    if f_in is None:
-        raise LookupError("Couldn't find the file %s" % daq_filename)
-    SEEK_END = 2
-    f_in.seek(0, SEEK_END)
-    file_size = float(f_in.tell())
-    f_in.seek(0, 0)
-    file_size_MB = file_size / 1e6
-    print("Total file size: {:.3f} MB".format(file_size_MB))
+    t_start = time.time()
+    if digitizer is None:
+        digitizer = CAENDT57XX()
+        digitizer.set_e_type(e_type)
+    if output_dir is not None: raw_filename = output_dir + "/" + raw_filename
+
+    file_size = os.path.getsize(daq_filename)
+    print("Total file size: {:.3f} MB".format(file_size / 1e6))
+    if file_size == 0:
+        print("process_compass: no events in", daq_filename)
+        return 0
 
     # ------------- scan over raw data starts here ----------------
 
-    print("Beginning Tier 0 processing ...")
+    print("Beginning daq-to-raw processing ...")
 
-    event_rows = []
-    waveform_rows = []
     event_size = digitizer.get_event_size(daq_filename)
-    with open(daq_filename, "rb") as metadata_file:
-        event_data_bytes = metadata_file.read(event_size)
-        while event_data_bytes != b"":
-            event, waveform = digitizer.get_event(event_data_bytes)
-            event_rows.append(event)
-            waveform_rows.append(waveform)
-            event_data_bytes = metadata_file.read(event_size)
-    all_data = np.concatenate((event_rows, waveform_rows), axis=1)
-    output_dataframe = digitizer.create_dataframe(all_data)
-    f_in.close()
-
-    output_dataframe.to_hdf(path_or_buf=output_dir+"/"+raw_filename, key="dataset", mode="w", table=True)
-    print("Wrote Tier 1 File:\n  {}\nFILE INFO:".format(raw_filename))
+    num_samples = (event_size - (24 if digitizer.e_type == "uncalibrated" else 30)) // 2
+    event_dtype = digitizer.get_event_dtype(num_samples)
+    n_events = file_size // event_size
+    if n_events * event_size != file_size:
+        print("process_compass: ignoring", file_size - n_events*event_size,
+              "bytes of incomplete event at the end of", daq_filename)
+    n_events = int(min(n_events, n_max))
+    events = np.memmap(daq_filename, dtype=event_dtype, mode="r", shape=(n_events,))
+
+    digitizer.set_num_samples(num_samples)
+    tbl = lh5.Table(buffer_size)
+    digitizer.initialize_lh5_table(tbl)
+    lh5_store = lh5.Store()
+    group_path = "CAENDT57XX/raw"
+    for start in range(0, n_events, buffer_size):
+        digitizer.decode_events(events[start:start+buffer_size], tbl)
+        lh5_store.write_object(tbl, group_path, raw_filename, n_rows=tbl.loc)
+        tbl.clear()
+        if verbose: print("decoded", min(start+buffer_size, n_events), "of", n_events, "events")
+    del events
+
+    print("Wrote RAW File:\n  {}\nFILE INFO:".format(raw_filename))
 
     # --------- summary -------------
 
-    with pd.HDFStore(raw_filename, "r") as store:
-        print(store.keys())
-
-
+    elapsed = time.time() - t_start
+    print("  {} events, {:.2f} sec".format(n_events, elapsed))
+    return n_events * event_size
@@ -2,8 +2,9 @@
 pygama tier 0 processing
 raw daq data --> pandas dfs saved to hdf5 file (tier 1)
 """
-import os, sys, time, json
+import os, sys, time, json, hashlib, traceback
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from parse import parse
 
 from ..utils import *
@@ -11,6 +12,7 @@ from ..io.orcadaq import *
 from ..io.llamadaq import *
 from ..io.compassdaq import *
 from ..io.fcdaq import *
+from ..io.telemetry import Telemetry
 
 
 def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
@@ -28,6 +30,35 @@ def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
         buffer_size (int): default length to use for tables
         ch_groups (dict): associates groups of channels to be in the same or
             a different output LH5 table. See ch_group.py
+        async_write (bool): write output tables from a separate thread while
+            decoding continues (ORCA and FlashCam only). Default False
+        swmr (bool): write output files in HDF5 SWMR mode so they can be read
+            while being written, e.g. with lh5.tail_object (ORCA and FlashCam
+            only). Default False
+        n_workers (int): number of worker processes decoding the data streams
+            of an ORCA file in parallel. Default 1 (serial)
+        n_regions (int): in parallel mode, also split an ORCA file into this
+            many regions decoded in parallel. Default 1
+        e_type (str): energy type of CAEN CoMPASS files, "uncalibrated" or
+            "calibrated". Default "uncalibrated"
+        follow (bool): decode an ORCA file that is still being written, as
+            the data arrive. Always done if daq_filename is a socket address
+            ('tcp://host:port' or 'unix:///path'). Default False
+        idle_timeout (float): when following, stop after this many seconds
+            without new data. Default 10
+        flush_interval (float): write out the data decoded so far at least
+            this often, in seconds, e.g. with follow and swmr (ORCA and
+            FlashCam only). Default None (write when tables are full)
+        flush_rows (int): write out tables once they have this many rows
+            (ORCA only). Default None (write when tables are full)
+        telemetry (bool or str): record the time spent reading, decoding
+            (per decoder), flushing and writing, and the throughput per data
+            ID and output group (ORCA and FlashCam only), and write it to a
+            json file. If True, the file is named after the raw file, with
+            suffix '_telemetry.json'. Default False
+        telemetry_interval (float): also snapshot the telemetry every this
+            many seconds, rewriting the json file each time, to monitor long
+            runs. Default None (only at the end)
     """
     # convert any environment variables
     daq_filename = os.path.expandvars(daq_filename)
@@ -39,6 +70,17 @@ def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
             config = json.load(f)
     d2r_conf = config['daq_to_raw'] if 'daq_to_raw' in config else config
     buffer_size = d2r_conf['buffer_size'] if 'buffer_size' in d2r_conf else 8192
+    async_write = d2r_conf['async_write'] if 'async_write' in d2r_conf else False
+    swmr = d2r_conf['swmr'] if 'swmr' in d2r_conf else False
+    n_workers = d2r_conf['n_workers'] if 'n_workers' in d2r_conf else 1
+    n_regions = d2r_conf['n_regions'] if 'n_regions' in d2r_conf else 1
+    e_type = d2r_conf['e_type'] if 'e_type' in d2r_conf else 'uncalibrated'
+    follow = d2r_conf['follow'] if 'follow' in d2r_conf else False
+    idle_timeout = d2r_conf['idle_timeout'] if 'idle_timeout' in d2r_conf else 10
+    flush_interval = d2r_conf['flush_interval'] if 'flush_interval' in d2r_conf else None
+    flush_rows = d2r_conf['flush_rows'] if 'flush_rows' in d2r_conf else None
+    telemetry_file = d2r_conf['telemetry'] if 'telemetry' in d2r_conf else False
+    telemetry_interval = d2r_conf['telemetry_interval'] if 'telemetry_interval' in d2r_conf else None
 
     # if we're not given a raw filename, make a simple one with subrun number
     if raw_file_pattern is None:
@@ -73,6 +115,15 @@ def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
           f'\n  Input: {daq_filename}\n  Output:')
     pprint(raw_files)
 
+    telemetry = None
+    if telemetry_file:
+        if telemetry_file is True:
+            base = os.path.splitext(raw_file_pattern)[0].replace('{', '').replace('}', '')
+            telemetry_file = base + '_telemetry.json'
+        telemetry = Telemetry(telemetry_interval, os.path.expandvars(telemetry_file))
+        telemetry.info.update({ 'daq' : config['daq'], 'daq_file' : daq_filename,
+                                'raw_file_pattern' : raw_file_pattern, 'buffer_size' : buffer_size })
+
     t_start = time.time()
     bytes_processed = None
 
@@ -83,18 +134,19 @@ def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
     # get the DAQ mode
     if config['daq'] == 'ORCA':
         print('note, remove decoder input option')
-        process_orca(daq_filename, raw_file_pattern, n_max, ch_groups_dict, verbose, buffer_size=buffer_size)
+        process_orca(daq_filename, raw_file_pattern, n_max, ch_groups_dict, verbose, buffer_size=buffer_size, async_write=async_write, swmr=swmr, n_workers=n_workers, n_regions=n_regions,
+                     follow=follow, flush_interval=flush_interval, flush_rows=flush_rows, idle_timeout=idle_timeout,
+                     telemetry=telemetry)
 
     elif config['daq'] == 'FlashCam':
         print("Processing FlashCam ...")
-        bytes_processed = process_flashcam(daq_filename, raw_files, n_max, ch_groups_dict, verbose, buffer_size=buffer_size, chans=chans)
+        bytes_processed = process_flashcam(daq_filename, raw_files, n_max, ch_groups_dict, verbose, buffer_size=buffer_size, chans=chans, async_write=async_write, swmr=swmr, flush_interval=flush_interval, telemetry=telemetry)
 
     elif config['daq'] == 'SIS3316':
-        process_llama_3316(daq_filename, raw_file_pattern, run, n_max, config, verbose)
+        bytes_processed = process_llama_3316(daq_filename, raw_file_pattern, subrun, n_max, config, verbose, buffer_size=buffer_size)
 
     elif config['daq'] == 'CAENDT57XXDecoder':
-        print('note, remove decoder input option')
-        process_compass(daq_filename, raw_file_pattern, None, out_dir)
+        bytes_processed = process_compass(daq_filename, raw_file_pattern, n_max=n_max, buffer_size=buffer_size, e_type=e_type, verbose=verbose)
 
     else:
         print(f"DAQ: {config['daq']} not recognized.  Exiting ...")
@@ -113,4 +165,168 @@ def daq_to_raw(daq_filename, raw_file_pattern=None, subrun=None, systems=None,
         print('Total converted: {}'.format(sizeof_fmt(bytes_processed)))
         print('Conversion speed: {}ps'.format(sizeof_fmt(bytes_processed/elapsed)))
 
+    if telemetry is not None:
+        telemetry.print_summary()
+        telemetry.write_json()
+        print('  Telemetry:', telemetry.filename)
+
     print('Done.\n')
+
+
+def daq_to_raw_files(dg, manifest=None, n_workers=None, n_max=np.inf,
+                     overwrite=False, check_hash=False, verbose=False):
+    """
+    Convert the DAQ files of a DataGroup fileDB selection in parallel.
+
+    Each file is converted by daq_to_raw() in a process of a pool of
+    n_workers. A json manifest records for each DAQ file its size, mtime (and
+    md5 hash if check_hash), the output files, the conversion time, the
+    conversion speed and the error of failed conversions. The manifest is
+    rewritten after every file, so that an interrupted batch can be resumed
+    by calling again with the same manifest: files that are up to date are
+    skipped.
+
+    A file is up to date if the manifest has a successful conversion of a DAQ
+    file with the same size and mtime (or, with check_hash, the same md5
+    hash, e.g. for a copied file), and all its output files still exist with
+    the recorded sizes.
+
+    Parameters
+    ----------
+    dg : DataGroup
+        dg.fileDB holds the files to convert (select rows beforehand, e.g.
+        dg.fileDB = dg.fileDB.query('run == 42')), with the raw_path and
+        raw_file columns from dg.get_lh5_cols()
+    manifest : str (optional)
+        The json manifest file. Default: manifest_daq_to_raw.json in
+        dg.lh5_dir
+    n_workers : int (optional)
+        Number of files converted in parallel. Default: the number of CPUs.
+        Mind that n_workers in the daq_to_raw config parallelizes within each
+        file on top of this
+    n_max : int (optional)
+        Passed on to daq_to_raw()
+    overwrite : bool (optional)
+        Convert all files, also the ones that are up to date
+    check_hash : bool (optional)
+        Also accept DAQ files with a changed mtime if their md5 hash is
+        unchanged. Hashing reads each DAQ file once more
+    verbose : bool (optional)
+        Passed on to daq_to_raw()
+
+    Returns
+    -------
+    entries : dict
+        The manifest entries of the DAQ files of this call, keyed by DAQ file
+    """
+    if manifest is None: manifest = f'{dg.lh5_dir}/manifest_daq_to_raw.json'
+    manifest = os.path.expandvars(manifest)
+    entries = {}
+    if os.path.isfile(manifest):
+        with open(manifest) as f: entries = json.load(f)
+
+    subs = dg.subsystems if dg.subsystems != [''] else None
+    jobs = []
+    for i, row in dg.fileDB.iterrows():
+        f_daq = f"{dg.daq_dir}/{row['daq_dir']}/{row['daq_file']}"
+        f_raw = f"{dg.lh5_dir}/{row['raw_path']}/{row['raw_file']}"
+        subrun = row['cycle'] if 'cycle' in row else None
+        if not os.path.isfile(f_daq):
+            print('daq_to_raw_files: DAQ file not found:', f_daq)
+            continue
+        if not overwrite and raw_up_to_date(entries.get(f_daq), f_daq, check_hash):
+            if verbose: print('up to date, skipping', f_daq)
+            continue
+        jobs.append((f_daq, f_raw, subrun))
+
+    n_skipped = len(dg.fileDB) - len(jobs)
+    if n_workers is None: n_workers = os.cpu_count()
+    print(f'Converting {len(jobs)} files ({n_skipped} skipped) with {n_workers} workers ...')
+
+    done = {}
+    t_start = time.time()
+    with ProcessPoolExecutor(n_workers) as pool:
+        futures = {}
+        for f_daq, f_raw, subrun in jobs:
+            for file in raw_outputs(f_raw, subs):
+                os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+            futures[pool.submit(convert_file, f_daq, f_raw, dg.config, subs, n_max, subrun, verbose)] = (f_daq, f_raw)
+        for future in as_completed(futures):
+            f_daq, f_raw = futures[future]
+            entry = future.result()
+            entry.update(daq_file_info(f_daq, check_hash))
+            entry['raw_files'] = {f : os.path.getsize(f) for f in raw_outputs(f_raw, subs) if os.path.isfile(f)}
+            if entry['status'] == 'failed':
+                print('daq_to_raw_files: conversion of', f_daq, 'failed:\n', entry['error'])
+            entries[f_daq] = done[f_daq] = entry
+            write_manifest(entries, manifest)
+
+    elapsed = time.time() - t_start
+    n_failed = sum(1 for entry in done.values() if entry['status'] == 'failed')
+    n_bytes = sum(entry['daq_size'] for entry in done.values())
+    print(f'Converted {len(done) - n_failed} files, {n_failed} failed, in {elapsed:.2f} sec')
+    if elapsed > 0: print('Conversion speed: {}ps'.format(sizeof_fmt(n_bytes/elapsed)))
+    print('Manifest:', manifest)
+    return done
+
+
+def convert_file(f_daq, f_raw, config, systems, n_max, subrun, verbose):
+    """
+    Run daq_to_raw() on one file, for daq_to_raw_files(). Returns the timing
+    and the status of the conversion instead of raising on errors
+    """
+    entry = {'t_start' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+    t_start = time.time()
+    try:
+        daq_to_raw(f_daq, f_raw, config=config, systems=systems, n_max=n_max,
+                   overwrite=True, subrun=subrun, verbose=verbose)
+        entry['status'] = 'done'
+    except (Exception, SystemExit):
+        entry['status'] = 'failed'
+        entry['error'] = traceback.format_exc()
+    entry['elapsed_s'] = time.time() - t_start
+    size = os.path.getsize(f_daq)
+    entry['bytes_per_s'] = size / entry['elapsed_s'] if entry['elapsed_s'] > 0 else None
+    return entry
+
+
+def raw_outputs(f_raw, systems):
+    """The output files of daq_to_raw() for raw file pattern f_raw"""
+    if systems is None: return [f_raw]
+    return [f_raw.replace('{sysn}', sysn) for sysn in systems]
+
+
+def daq_file_info(f_daq, check_hash=False):
+    """The size, mtime and (if check_hash) md5 hash of a DAQ file"""
+    stat = os.stat(f_daq)
+    info = {'daq_size' : stat.st_size, 'daq_mtime' : stat.st_mtime}
+    if check_hash:
+        md5 = hashlib.md5()
+        with open(f_daq, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''): md5.update(block)
+        info['daq_md5'] = md5.hexdigest()
+    return info
+
+
+def raw_up_to_date(entry, f_daq, check_hash=False):
+    """
+    Check whether the manifest entry of f_daq is a successful conversion of
+    the current DAQ file, with all output files unchanged
+    """
+    if entry is None or entry['status'] != 'done': return False
+    if len(entry['raw_files']) == 0: return False
+    for f, size in entry['raw_files'].items():
+        if not os.path.isfile(f) or os.path.getsize(f) != size: return False
+    stat = os.stat(f_daq)
+    if stat.st_size != entry['daq_size']: return False
+    if stat.st_mtime == entry['daq_mtime']: return True
+    if not check_hash or 'daq_md5' not in entry: return False
+    return daq_file_info(f_daq, True)['daq_md5'] == entry['daq_md5']
+
+
+def write_manifest(entries, manifest):
+    """Write the manifest entries to json file manifest, replacing it only
+    when the new one is complete"""
+    tmp_file = manifest + '.tmp'
+    with open(tmp_file, 'w') as f: json.dump(entries, f, indent=2)
+    os.replace(tmp_file, manifest)
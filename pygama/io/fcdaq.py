@@ -1,4 +1,4 @@
-import os
+import os, time
 import numpy as np
 from pprint import pprint
 from collections import defaultdict
@@ -7,6 +7,7 @@ from ..utils import *
 from .io_base import DataDecoder
 from pygama import lh5
 from .ch_group import *
+from .telemetry import Telemetry
 
 
 class FlashCamEventDecoder(DataDecoder):
@@ -130,7 +131,7 @@ class FlashCamEventDecoder(DataDecoder):
         ]
 
         super().__init__(*args, **kwargs)
-        self.skipped_channels = {}
+        self.column_cache = {}
 
 
     def get_decoded_values(self, channel=None):
@@ -158,82 +159,100 @@ class FlashCamEventDecoder(DataDecoder):
 
 
 
+    # event-level values, the same for all traces of an event:
+    # decoded value name -> FCIOEvent member
+    event_members = {
+        'ievt'           : 'eventnumber', # the eventnumber since the beginning of the file
+        'timestamp'      : 'eventtime',   # the time since epoch in seconds
+        'runtime'        : 'runtime',     # the time since the beginning of the file in seconds
+        'numtraces'      : 'numtraces',   # number of triggered adcs
+        'ts_pps'         : 'timestamp_pps',
+        'ts_ticks'       : 'timestamp_ticks',
+        'ts_maxticks'    : 'timestamp_maxticks',
+        'to_mu_sec'      : 'timeoffset_mu_sec',
+        'to_mu_usec'     : 'timeoffset_mu_usec',
+        'to_master_sec'  : 'timeoffset_master_sec',
+        'to_dt_mu_usec'  : 'timeoffset_dt_mu_usec',
+        'to_abs_mu_usec' : 'timeoffset_abs_mu_usec',
+        'to_start_sec'   : 'timeoffset_start_sec',
+        'to_start_usec'  : 'timeoffset_start_usec',
+        'dr_start_pps'   : 'deadregion_start_pps',
+        'dr_start_ticks' : 'deadregion_start_ticks',
+        'dr_stop_pps'    : 'deadregion_stop_pps',
+        'dr_stop_ticks'  : 'deadregion_stop_ticks',
+        'dr_maxticks'    : 'deadregion_maxticks',
+        'deadtime'       : 'deadtime',
+    }
+
+
+    def get_columns(self, tbl):
+        """
+        get the column arrays of tbl, cached so that the field look-ups are
+        only done once per table
+        """
+        cached = self.column_cache.get(id(tbl))
+        if cached is not None and cached[0] is tbl: return cached[1]
+        cols = { field : tbl[field].nda for field in self.event_members }
+        for field in ['packet_id', 'channel', 'baseline', 'energy', 'wf_max', 'wf_std']:
+            cols[field] = tbl[field].nda
+        cols['waveform'] = tbl['waveform']['values'].nda
+        self.column_cache[id(tbl)] = (tbl, cols)
+        return cols
+
+
     def decode_packet(self, fcio, lh5_tables, packet_id, verbose=False):
         """
         access FCIOEvent members for each event in the raw file
-        """
 
-        ievt      = fcio.eventnumber # the eventnumber since the beginning of the file
-        timestamp = fcio.eventtime   # the time since epoch in seconds
-        runtime   = fcio.runtime     # the time since the beginning of the file in seconds
+        All rows of the event going to the same table are filled at once:
+        the event-level values are broadcast, and the waveforms and
+        per-trace values are copied with fancy indexing on the tracelist.
+        """
         eventsamples = fcio.nsamples   # number of sample per trace
         numtraces = fcio.numtraces   # number of triggered adcs
         tracelist = fcio.tracelist   # list of triggered adcs
         traces    = fcio.traces      # the full traces for the event: (nadcs, nsamples)
         baselines = fcio.baseline    # the fpga baseline values for each channel in LSB
         energies  = fcio.daqenergy   # the fpga energy values for each channel in LSB
-        ts_pps         = fcio.timestamp_pps
-        ts_ticks       = fcio.timestamp_ticks
-        ts_maxticks    = fcio.timestamp_maxticks
-        to_mu_sec      = fcio.timeoffset_mu_sec
-        to_mu_usec     = fcio.timeoffset_mu_usec
-        to_master_sec  = fcio.timeoffset_master_sec
-        to_dt_mu_usec  = fcio.timeoffset_dt_mu_usec
-        to_abs_mu_usec = fcio.timeoffset_abs_mu_usec
-        to_start_sec   = fcio.timeoffset_start_sec
-        to_start_usec  = fcio.timeoffset_start_usec
-        dr_start_pps   = fcio.deadregion_start_pps
-        dr_start_ticks = fcio.deadregion_start_ticks
-        dr_stop_pps    = fcio.deadregion_stop_pps
-        dr_stop_ticks  = fcio.deadregion_stop_ticks
-        dr_maxticks    = fcio.deadregion_maxticks
-        deadtime       = fcio.deadtime
-
-        # all channels are read out simultaneously for each event
-        for iwf in tracelist:
-            tbl = lh5_tables
-            if not isinstance(tbl, lh5.Table):
-                if iwf not in lh5_tables:
-                    if iwf not in self.skipped_channels:
-                        self.skipped_channels[iwf] = 0
-                    self.skipped_channels[iwf] += 1
-                    continue
-                tbl = lh5_tables[iwf]
-            if eventsamples != tbl['waveform']['values'].nda.shape[1]:
+        event_vals = { field : getattr(fcio, member) for field, member in self.event_members.items() }
+
+        # all channels are read out simultaneously for each event. Group the
+        # traces by output table, keeping their order
+        if isinstance(lh5_tables, lh5.Table):
+            tbl_traces = [(lh5_tables, np.asarray(tracelist))]
+        else:
+            tracelist = np.asarray(tracelist)
+            slots = lh5_tables.get_slots(tracelist)
+            lh5_tables.count_skipped(tracelist[slots < 0])
+            tbl_traces = [(lh5_tables.tables[slot], tracelist[slots == slot])
+                          for slot in np.unique(slots[slots >= 0]).tolist()]
+
+        for tbl, iwfs in tbl_traces:
+            cols = self.get_columns(tbl)
+            if eventsamples != cols['waveform'].shape[1]:
                 print('FlashCamEventDecoder Warning: event wf length was',
                       eventsamples, 'when',
                       self.decoded_values['waveform']['length'], 'were expected')
-            ii = tbl.loc
-            tbl['channel'].nda[ii] = iwf
-            tbl['packet_id'].nda[ii] = packet_id
-            tbl['ievt'].nda[ii] =  ievt
-            tbl['timestamp'].nda[ii] =  timestamp
-            tbl['runtime'].nda[ii] =  runtime
-            tbl['numtraces'].nda[ii] =  numtraces
-            tbl['tracelist'].set_vector(ii, tracelist)
-            tbl['baseline'].nda[ii] = baselines[iwf]
-            tbl['energy'].nda[ii] = energies[iwf]
-            tbl['ts_pps'].nda[ii]         = ts_pps
-            tbl['ts_ticks'].nda[ii]       = ts_ticks
-            tbl['ts_maxticks'].nda[ii]    = ts_maxticks
-            tbl['to_mu_sec'].nda[ii]      = to_mu_sec
-            tbl['to_mu_usec'].nda[ii]     = to_mu_usec
-            tbl['to_master_sec'].nda[ii]  = to_master_sec
-            tbl['to_dt_mu_usec'].nda[ii]  = to_dt_mu_usec
-            tbl['to_abs_mu_usec'].nda[ii] = to_abs_mu_usec
-            tbl['to_start_sec'].nda[ii]   = to_start_sec
-            tbl['to_start_usec'].nda[ii]  = to_start_usec
-            tbl['dr_start_pps'].nda[ii]   = dr_start_pps
-            tbl['dr_start_ticks'].nda[ii] = dr_start_ticks
-            tbl['dr_stop_pps'].nda[ii]    = dr_stop_pps
-            tbl['dr_stop_ticks'].nda[ii]  = dr_stop_ticks
-            tbl['dr_maxticks'].nda[ii]    = dr_maxticks
-            tbl['deadtime'].nda[ii]       = deadtime
-            waveform = traces[iwf]
-            tbl['wf_max'].nda[ii] = np.amax(waveform)
-            tbl['wf_std'].nda[ii] = np.std(waveform)
-            tbl['waveform']['values'].nda[ii][:] = waveform
-            tbl.push_row()
+            n_rows = len(iwfs)
+            rows = slice(tbl.loc, tbl.loc + n_rows)
+            for field, value in event_vals.items(): cols[field][rows] = value
+            cols['packet_id'][rows] = packet_id
+            cols['channel'][rows] = iwfs
+            cols['baseline'][rows] = baselines[iwfs]
+            cols['energy'][rows] = energies[iwfs]
+            waveforms = cols['waveform'][rows]
+            waveforms[:] = traces[iwfs]
+            cols['wf_max'][rows] = np.amax(waveforms, axis=1)
+            cols['wf_std'][rows] = np.std(waveforms, axis=1)
+
+            # every row gets the full tracelist
+            tl = tbl['tracelist']
+            start = 0 if tbl.loc == 0 else tl.cumulative_length.nda[tbl.loc-1]
+            end = start + n_rows*len(tracelist)
+            if end > len(tl.flattened_data.nda): tl.reserve(end)
+            tl.flattened_data.nda[start:end] = np.tile(tracelist, n_rows)
+            tl.cumulative_length.nda[rows] = start + len(tracelist)*np.arange(1, n_rows+1)
+            tbl.loc += n_rows
 
         return 36*4 + numtraces*(1 + eventsamples + 2)*2
 
@@ -360,16 +379,52 @@ class FlashCamStatusDecoder(DataDecoder):
         return 302132
 
 
-def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=False, buffer_size=8192, chans=None, f_out = ''):
+def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=False, buffer_size=8192, chans=None, f_out = '', async_write=False, swmr=False, flush_interval=None, telemetry=None):
     """
     decode FlashCam data, using the fcutils package to handle file access,
     and the FlashCam DataTaker to save the results and write to output.
 
     `raw_files` can be a string, or a dict with a label for each file:
       `{'geds':'filename_geds.lh5', 'muvt':'filename_muvt.lh5}`
+
+    If `async_write` is True, full tables are handed off to an lh5.AsyncWriter
+    and written from a separate thread while decoding continues. If `swmr` is
+    True, the output files are written in HDF5 SWMR mode, so that they can be
+    read while being written (see lh5.tail_object).
+
+    `daq_file` can also be a stream address understood by fcio (e.g.
+    'tcp://host:port'), which is decoded as the data arrive. If
+    `flush_interval` is not None, the data decoded so far are written out
+    at least every `flush_interval` seconds (checked as records arrive),
+    so that they can be read soon after they were taken.
+
+    If `telemetry` is not None, it is a Telemetry that is filled with the time
+    spent reading records, decoding, flushing and writing tables, and the
+    records per type and rows per output group.
+    """
+    # TODO: add overwrite capability
+    lh5_store = lh5.Store(amortize_appends=True, swmr=swmr)
+    writer = lh5.AsyncWriter(lh5_store) if async_write else lh5_store
+    try:
+        return _process_flashcam(daq_file, raw_files, n_max, ch_groups_dict, verbose, buffer_size, chans, f_out,
+                                 async_write, swmr, flush_interval, telemetry, lh5_store, writer)
+    finally:
+        # also close the outputs if decoding failed, so that the datasets
+        # over-allocated by amortized appends get trimmed to the rows written.
+        # Closing again after a successful run does nothing
+        writer.close()
+
+
+def _process_flashcam(daq_file, raw_files, n_max, ch_groups_dict, verbose, buffer_size, chans, f_out,
+                      async_write, swmr, flush_interval, telemetry, lh5_store, writer):
+    """
+    the body of process_flashcam(). Writes go through writer, which is
+    lh5_store or an lh5.AsyncWriter around it. Closes writer when done
     """
     import fcutils
 
+    tel = telemetry if telemetry is not None else Telemetry()
+
     if isinstance(raw_files, str):
         single_output = True
         f_out = raw_files
@@ -427,21 +482,26 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
       status_filename = "fcio_status"
       config_filename = "fcio_config"
 
-    # Set up the store
-    # TODO: add overwrite capability
-    lh5_store = lh5.Store()
-
     # write fcio_config
     fcio_config = event_decoder.get_file_config_struct()
     lh5_store.write_object(fcio_config, 'fcio_config', config_filename)
 
+    # SWMR files can't get new objects, so create all outputs first
+    if swmr:
+        out_files = create_outputs(ch_groups, lh5_store)
+        lh5_store.write_object(status_tbl, 'fcio_status', status_filename, n_rows=0)
+        out_files.add(status_filename)
+        for out_file in out_files: lh5_store.start_swmr(out_file)
+    if async_write: lh5_store = writer
+
     # loop over raw data packets
     i_debug = 0
     packet_id = 0
     rc = 1
     bytes_processed = 0
     bytes_per_loop = 0
-    file_size = os.path.getsize(daq_file)
+    file_size = os.path.getsize(daq_file) if os.path.isfile(daq_file) else 0
+    t_flush = time.monotonic()
     max_numtraces = 0
 
     unit = "B"
@@ -453,7 +513,9 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
         n_entries = file_size
     progress_bar = tqdm_range(0, int(n_entries), text="Processing", verbose=verbose, unit=unit)
     while rc and packet_id < n_max:
+        t_start = tel.now()
         rc = fcio.get_record()
+        t_start = tel.add_time('read', t_start)
 
         # Skip non-interesting records
         # FIXME: push to a buffer of skipped packets?
@@ -465,12 +527,18 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
         if rc == 4:
             bytes_per_loop = status_decoder.decode_packet(fcio, status_tbl, packet_id)
             bytes_processed += bytes_per_loop
+            tel.add_time('decode/FlashCamStatusDecoder', t_start)
+            tel.count_packets('status', 1, bytes_per_loop, 'FlashCamStatusDecoder')
             if status_tbl.is_full():
-                lh5_store.write_object(status_tbl, 'fcio_status', status_filename, n_rows=status_tbl.size)
-                status_tbl.clear()
+                if async_write:
+                    status_tbl = tel.submit(lh5_store, status_tbl, 'fcio_status', status_filename, n_rows=status_tbl.size)
+                else:
+                    tel.write_object(lh5_store, status_tbl, 'fcio_status', status_filename, n_rows=status_tbl.size)
+                    status_tbl.clear()
 
         # Event or SparseEvent record
         if rc == 3 or rc == 6:
+            t_write = tel.stage_time['write']
             for group_info in ch_groups.values():
                 tbl = group_info['table']
                 # Check that the tables are large enough
@@ -483,13 +551,22 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
                 if tbl.size - tbl.loc < fcio.numtraces: # might overflow
                     group_path = group_info['group_path']
                     out_file = group_info['out_file']
-                    lh5_store.write_object(tbl, group_path, out_file, n_rows=tbl.loc)
                     if out_file in file_info: file_info[out_file] = True
-                    tbl.clear()
+                    if async_write:
+                        tbl = tel.submit(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
+                        event_tables = replace_table(group_info, tbl, event_tables)
+                    else:
+                        tel.write_object(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
+                        tbl.clear()
+
+            # the writes are accounted for separately
+            t_start = tel.add_time('flush', t_start + tel.stage_time['write'] - t_write)
 
             # Looks okay: just decode
             bytes_per_loop = event_decoder.decode_packet(fcio, event_tables, packet_id)
             bytes_processed += bytes_per_loop
+            tel.add_time('decode/FlashCamEventDecoder', t_start)
+            tel.count_packets('event', 1, bytes_per_loop, 'FlashCamEventDecoder')
 
             if verbose:
               update_len = 0
@@ -499,6 +576,23 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
                   update_len = bytes_per_loop
               update_progress(progress_bar, update_len)
 
+            if flush_interval is not None and time.monotonic() - t_flush >= flush_interval:
+                for group_info in ch_groups.values():
+                    tbl = group_info['table']
+                    if tbl.loc == 0: continue
+                    group_path = group_info['group_path']
+                    out_file = group_info['out_file']
+                    if out_file in file_info: file_info[out_file] = True
+                    if async_write:
+                        tbl = tel.submit(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
+                        event_tables = replace_table(group_info, tbl, event_tables)
+                    else:
+                        tel.write_object(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
+                        tbl.clear()
+                lh5_store.flush()
+                t_flush = time.monotonic()
+            tel.sample()
+
             # i_debug += 1
             # if i_debug == 10:
             #    print("breaking early")
@@ -510,13 +604,16 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
         if tbl.loc != 0:
             group_path = group_info['group_path']
             out_file = group_info['out_file']
-            lh5_store.write_object(tbl, group_path, out_file, n_rows=tbl.loc)
+            tel.write_object(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
             if out_file in file_info: file_info[out_file] = True
             tbl.clear()
     if status_tbl.loc != 0:
-        lh5_store.write_object(status_tbl, 'stat', status_filename,
-                               n_rows=status_tbl.loc)
+        tel.write_object(lh5_store, status_tbl, 'fcio_status', status_filename,
+                         n_rows=status_tbl.loc)
         status_tbl.clear()
+    t_start = tel.now()
+    lh5_store.close()
+    tel.add_time('write', t_start)
 
     # alert user to any files not actually saved in the end
     for out_file, is_saved in file_info.items():
@@ -526,10 +623,13 @@ def process_flashcam(daq_file, raw_files, n_max, ch_groups_dict=None, verbose=Fa
     if verbose:
         print(packet_id, 'packets decoded')
 
-    if len(event_decoder.skipped_channels) > 0:
+    skipped_channels = {}
+    if not isinstance(event_tables, lh5.Table):
+        skipped_channels = event_tables.skipped_channels()
+    if len(skipped_channels) > 0:
         print("Warning - daq_to_raw skipped some channels in file")
         if verbose:
-            for ch, n in event_decoder.skipped_channels.items():
+            for ch, n in skipped_channels.items():
                 print("  ch", ch, ":", n, "hits")
 
     return bytes_processed
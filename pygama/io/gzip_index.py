@@ -0,0 +1,359 @@
+"""
+Random access into gzip files through an index of access points, following
+zran.c from the zlib examples.
+
+While decompressing a file once, the state needed to restart decompression at
+a deflate block boundary (the compressed byte and bit position and the last
+32 kB of output) is saved about every span bytes of output. Reading from an
+arbitrary offset then only decompresses from the preceding access point. The
+index is persisted next to the file (<file>.gzidx), so the decompressed size
+and random access are available without decompressing the file again.
+
+Python's zlib module doesn't expose the calls needed (inflate with Z_BLOCK,
+inflatePrime, inflateSetDictionary), so zlib is called through ctypes. If the
+zlib library can't be loaded, open_gzip() falls back to gzip.open().
+"""
+import os, gzip, ctypes, ctypes.util
+import numpy as np
+
+
+WINSIZE = 32768 # deflate window size
+CHUNK = 2**16 # compressed bytes read at a time
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_DATA_ERROR = -3
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+
+class z_stream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+libz = None
+
+def get_libz():
+    """Load the zlib library, or return None if it can't be found"""
+    global libz
+    if libz is None:
+        name = ctypes.util.find_library('z')
+        try: lib = ctypes.CDLL(name) if name is not None else None
+        except OSError: lib = None
+        if lib is None:
+            libz = False
+            return None
+        p_strm = ctypes.POINTER(z_stream)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.inflateInit2_.argtypes = [p_strm, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        lib.inflate.argtypes = [p_strm, ctypes.c_int]
+        lib.inflateEnd.argtypes = [p_strm]
+        lib.inflateReset2.argtypes = [p_strm, ctypes.c_int]
+        lib.inflatePrime.argtypes = [p_strm, ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [p_strm, ctypes.c_char_p, ctypes.c_uint]
+        libz = lib
+    return libz if libz else None
+
+
+class Inflater:
+    """
+    Thin wrapper of a zlib inflate stream
+
+    window_bits as for zlib: -15 for raw deflate data, 31 for gzip, 47 for
+    gzip or zlib
+    """
+    def __init__(self, window_bits):
+        self.lib = get_libz()
+        self.strm = z_stream()
+        self.data = b''
+        ret = self.lib.inflateInit2_(ctypes.byref(self.strm), window_bits,
+                                     self.lib.zlibVersion(), ctypes.sizeof(z_stream))
+        if ret != Z_OK: raise RuntimeError(f'inflateInit2 failed: {ret}')
+
+    def set_input(self, data):
+        self.data = data # keep a reference while zlib reads from it
+        self.strm.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.strm.avail_in = len(data)
+
+    def remaining_input(self):
+        """The input not yet consumed"""
+        n = self.strm.avail_in
+        return self.data[len(self.data)-n:] if n > 0 else b''
+
+    def inflate(self, out_addr, n_out, flush=Z_NO_FLUSH):
+        """Inflate into n_out bytes at address out_addr. Returns the zlib
+        return code and the number of bytes written"""
+        self.strm.next_out = out_addr
+        self.strm.avail_out = n_out
+        ret = self.lib.inflate(ctypes.byref(self.strm), flush)
+        if ret == Z_NEED_DICT: ret = Z_DATA_ERROR
+        if ret < 0 and ret != Z_BUF_ERROR:
+            msg = self.strm.msg.decode() if self.strm.msg else ''
+            raise IOError(f'zlib inflate error {ret} {msg}')
+        return ret, n_out - self.strm.avail_out
+
+    def reset(self, window_bits):
+        self.lib.inflateReset2(ctypes.byref(self.strm), window_bits)
+
+    def prime(self, bits, value):
+        self.lib.inflatePrime(ctypes.byref(self.strm), bits, value)
+
+    def set_dictionary(self, window):
+        self.lib.inflateSetDictionary(ctypes.byref(self.strm), window, len(window))
+
+    def __del__(self):
+        if hasattr(self, 'strm'): self.lib.inflateEnd(ctypes.byref(self.strm))
+
+
+class GzipIndex:
+    """
+    Access points into a gzip file
+
+    Attributes
+    ----------
+    size : int
+        The decompressed size of the file
+    out_pos, in_pos, bits : arrays
+        For each access point, the decompressed and compressed byte positions
+        and the number of bits of the compressed byte before in_pos that
+        belong to the next deflate block
+    windows : 2D uint8 array
+        The WINSIZE bytes of output preceding each access point
+    """
+    def __init__(self, size, out_pos, in_pos, bits, windows, gz_size=None, gz_mtime=None, span=None):
+        self.size = int(size)
+        self.out_pos = np.asarray(out_pos, dtype='int64')
+        self.in_pos = np.asarray(in_pos, dtype='int64')
+        self.bits = np.asarray(bits, dtype='int32')
+        self.windows = np.asarray(windows, dtype='uint8').reshape(-1, WINSIZE)
+        self.gz_size = gz_size
+        self.gz_mtime = gz_mtime
+        self.span = span
+
+
+    def save(self, index_file):
+        """Write the index to index_file (numpy npz format). The file is
+        replaced only when the new one is complete"""
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez_compressed(f, size=self.size, out_pos=self.out_pos, in_pos=self.in_pos,
+                                bits=self.bits, windows=self.windows, gz_size=self.gz_size,
+                                gz_mtime=self.gz_mtime, span=self.span)
+        os.replace(tmp_file, index_file)
+
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as npz:
+            return cls(**{ key : npz[key][()] for key in npz.files })
+
+
+    def matches(self, gz_filename):
+        """Check that the index was built for the current version of gz_filename"""
+        stat = os.stat(gz_filename)
+        return self.gz_size == stat.st_size and self.gz_mtime == stat.st_mtime
+
+
+def build_gzip_index(gz_filename, span=2**24):
+    """
+    Decompress gz_filename once and return a GzipIndex with an access point
+    about every span bytes of decompressed data
+    """
+    inf = Inflater(47)
+    window = (ctypes.c_ubyte * WINSIZE)()
+    window_addr = ctypes.addressof(window)
+    out_pos, in_pos, bits, windows = [], [], [], []
+    totin = totout = last = 0
+    w_pos = 0 # next write position in the circular window
+    stat = os.stat(gz_filename)
+    with open(gz_filename, 'rb') as f_in:
+        while True:
+            if inf.strm.avail_in == 0:
+                data = f_in.read(CHUNK)
+                if len(data) == 0: break
+                inf.set_input(data)
+            if w_pos == WINSIZE: w_pos = 0
+            n_in = inf.strm.avail_in
+            ret, n_out = inf.inflate(window_addr + w_pos, WINSIZE - w_pos, Z_BLOCK)
+            totin += n_in - inf.strm.avail_in
+            totout += n_out
+            w_pos += n_out
+            if ret == Z_STREAM_END:
+                # end of a gzip member (trailer included). Continue if
+                # another member follows, ignore trailing junk otherwise
+                rest = inf.remaining_input()
+                if len(rest) < 2: rest += f_in.read(2 - len(rest))
+                if rest[:2] != b'\x1f\x8b': break
+                inf.reset(47)
+                inf.set_input(rest)
+                continue
+            # at the end of a deflate block header, unless it's the last block
+            dt = inf.strm.data_type
+            if dt & 128 and not dt & 64 and (totout == 0 or totout - last > span):
+                out_pos.append(totout)
+                in_pos.append(totin)
+                bits.append(dt & 7)
+                win = np.frombuffer(window, dtype='uint8')
+                windows.append(np.concatenate([win[w_pos:], win[:w_pos]]))
+                last = totout
+    windows = np.array(windows, dtype='uint8').reshape(-1, WINSIZE)
+    return GzipIndex(totout, out_pos, in_pos, bits, windows, gz_size=stat.st_size,
+                     gz_mtime=stat.st_mtime, span=span)
+
+
+def get_gzip_index(gz_filename, span=2**24, index_file=None, save=True):
+    """
+    Load the index of gz_filename from index_file (default
+    gz_filename + '.gzidx') if it is up to date with gz_filename, else build
+    it and (if save) write it to index_file. If index_file can't be written,
+    e.g. in a read-only data directory, the index is just returned
+    """
+    if index_file is None: index_file = gz_filename + '.gzidx'
+    if os.path.isfile(index_file):
+        try:
+            index = GzipIndex.load(index_file)
+            if index.matches(gz_filename): return index
+        except (OSError, ValueError, KeyError): pass
+    index = build_gzip_index(gz_filename, span)
+    if save:
+        try: index.save(index_file)
+        except OSError as e: print('get_gzip_index: could not write', index_file, ':', e)
+    return index
+
+
+class IndexedGzipFile:
+    """
+    Read-only file object for a gzip file with random access through a
+    GzipIndex. seek() is cheap: the next read() restarts decompression at the
+    closest preceding access point if that is faster than continuing
+    """
+    def __init__(self, gz_filename, index=None, span=2**24, index_file=None):
+        self.filename = gz_filename
+        self.index = index if index is not None else get_gzip_index(gz_filename, span, index_file)
+        self.size = self.index.size
+        self.f_in = open(gz_filename, 'rb')
+        self.pos = 0
+        self.inf = None
+        self.inf_pos = 0 # decompressed position of self.inf
+        self.raw = True # whether self.inf decodes raw deflate data
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR: offset += self.pos
+        elif whence == os.SEEK_END: offset += self.size
+        if offset < 0: raise ValueError('negative seek position')
+        # positions end up in ctypes pointer arithmetic: no numpy ints
+        self.pos = int(offset)
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+    def start_at_point(self, i_point):
+        """Set up a new inflater at access point i_point"""
+        self.inf = Inflater(-15)
+        self.raw = True
+        in_pos, bits = int(self.index.in_pos[i_point]), int(self.index.bits[i_point])
+        self.f_in.seek(in_pos - (1 if bits else 0))
+        if bits:
+            value = self.f_in.read(1)[0]
+            self.inf.prime(bits, value >> (8 - bits))
+        self.inf.set_dictionary(self.index.windows[i_point].tobytes())
+        self.inf_pos = int(self.index.out_pos[i_point])
+
+
+    def inflate_to(self, out_addr, n):
+        """Decompress the next n bytes to out_addr. Returns the number of
+        bytes decompressed (less than n at the end of the data)"""
+        n_done = 0
+        while n_done < n:
+            if self.inf.strm.avail_in == 0:
+                data = self.f_in.read(CHUNK)
+                if len(data) == 0: break
+                self.inf.set_input(data)
+            ret, n_out = self.inf.inflate(out_addr + n_done, n - n_done)
+            n_done += n_out
+            if ret == Z_STREAM_END:
+                # end of a gzip member: skip the trailer of a raw stream, go
+                # on with the next member if there is one
+                rest = self.inf.remaining_input()
+                need = (8 if self.raw else 0) + 2
+                if len(rest) < need: rest += self.f_in.read(need - len(rest))
+                if self.raw: rest = rest[8:]
+                if rest[:2] != b'\x1f\x8b': break
+                self.inf.reset(31)
+                self.raw = False
+                self.inf.set_input(rest)
+            elif ret == Z_BUF_ERROR and n_out == 0 and self.inf.strm.avail_in > 0: break
+        self.inf_pos += n_done
+        return n_done
+
+
+    def position(self):
+        """Get the inflater to self.pos: continue decompressing if there is
+        no access point in between, else restart at the closest point"""
+        i_point = np.searchsorted(self.index.out_pos, self.pos, side='right') - 1
+        if i_point < 0: return False
+        if self.inf is None or self.inf_pos > self.pos or self.index.out_pos[i_point] > self.inf_pos:
+            self.start_at_point(i_point)
+        skip = self.pos - self.inf_pos
+        if skip > 0:
+            buf = (ctypes.c_ubyte * min(skip, 2**20))()
+            while skip > 0:
+                n = self.inflate_to(ctypes.addressof(buf), min(skip, len(buf)))
+                if n == 0: return False
+                skip -= n
+        return True
+
+
+    def read(self, n=-1):
+        if n is None or n < 0: n = self.size - self.pos
+        n = int(min(n, self.size - self.pos))
+        if n <= 0 or not self.position(): return b''
+        out = bytearray(n)
+        n = self.inflate_to(ctypes.addressof((ctypes.c_ubyte * n).from_buffer(out)), n)
+        self.pos += n
+        return bytes(out[:n]) if n < len(out) else bytes(out)
+
+
+    def close(self):
+        if self.f_in is not None:
+            self.f_in.close()
+            self.f_in = None
+        self.inf = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_gzip(gz_filename, span=2**24, index_file=None):
+    """
+    Open gz_filename for reading with an IndexedGzipFile, or with gzip.open()
+    if the zlib library isn't available
+    """
+    if get_libz() is None:
+        print('open_gzip: zlib library not found, reading', gz_filename, 'without an index')
+        return gzip.open(gz_filename, 'rb')
+    return IndexedGzipFile(gz_filename, span=span, index_file=index_file)
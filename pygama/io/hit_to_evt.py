@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 import os
+import glob
 import time
 import argparse
 import h5py
 import numpy as np
+import numba as nb
 import pandas as pd
 from pprint import pprint
 
 import pygama.lh5 as lh5
 
-def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=None,
+def hit_to_evt(f_hit, f_evt:str=None, lh5_tables:list=None, copy_cols:list=None,
                overwrite:bool=True, evt_tb_name:str=None, builder_config:dict=None):
     """
     Given an input file containing separate Tables for each active data taker,
@@ -21,9 +23,11 @@ def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=N
 
     Parameters
     ----------
-    f_hit : str
+    f_hit : str or list of str's
         Input file containing multiple LH5 tables, one for each channel.
-        Usually a RAW or DSP file.
+        Usually a RAW or DSP file.  If a list of files (e.g. the cycle files
+        of a run, can contain wildcards) is given, they are event-built
+        together in timestamp order, with one ix_evt numbering for the run.
     f_evt : str
         Output file name.
     lh5_tables : list (optional)
@@ -36,8 +40,11 @@ def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=N
     evt_tb_name : str (optional)
         Specify the name of the output table instead of automatically setting it.
     builder_config : dict (optional)
-        Give a dict of kwargs for `cluster_events`, including coincidence window
-        times, conversion to seconds, and names of timestamp and channel columns.
+        Give a dict of kwargs for `build_tcm`, including coincidence window
+        times, conversion to seconds, names of timestamp and channel columns,
+        and the number of rows to read from each table at a time.  The tables
+        are merged in chunks, so memory use doesn't grow with the file size
+        (unless the output is returned as a DataFrame).
 
     Returns
     -------
@@ -47,7 +54,13 @@ def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=N
     """
     t_start = time.time()
 
-    # get a list of LH5 tables to decode in the input file
+    if isinstance(f_hit, str): f_hit = [f_hit]
+    f_hit = [f for f_wc in f_hit for f in sorted(glob.glob(os.path.expandvars(f_wc)))]
+    if len(f_hit) == 0:
+        print('hit_to_evt: no input files found')
+        return None
+
+    # get a list of LH5 tables to decode in the (first) input file
     if lh5_tables is None:
         lh5_tables, lh5_cols = [], {}
 
@@ -59,7 +72,7 @@ def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=N
                     if 'waveform' in col_list: col_list.remove('waveform')
                     lh5_cols[name] = col_list
 
-        with h5py.File(f_hit) as hf:
+        with h5py.File(f_hit[0], 'r') as hf:
             # to iterate through all groups, you have to pass 'visititems' a function
             hf.visititems(find_tables)
 
@@ -75,66 +88,307 @@ def hit_to_evt(f_hit:str, f_evt:str=None, lh5_tables:list=None, copy_cols:list=N
         'ch_col' : 'channel',   # name of column with channel ID (should be int)
         'ts_col' : 'timestamp', # name of column with timestamps
         'coin_window' : 4e-6,   # length of coincidence window in seconds
-        'data_cols' : copy_cols # columns to copy over into output table
+        'data_cols' : copy_cols,# columns to copy over into output table
+        'buffer_len' : 3200     # rows read from each table at a time
         }
 
     # show status before running
+    if len(f_hit) > 1:
+        ts_col = builder_config['ts_col'] if 'ts_col' in builder_config else 'timestamp'
+        f_hit, _ = order_files(f_hit, lh5_tables, ts_col)
+        print('Files to merge, in time order:\n', f_hit)
     print('Tables to merge:\n', lh5_tables)
     print('Event builder config:')
     print(builder_config)
 
-    # read LH5 tables and convert to DataFrame.  This copy and conversion is
-    # a required step!  (Clint will be happy to discuss the reasons with you.)
-    print('Loading dataframes ...')
-    dfs = []
-    for tb in lh5_tables:
-        df = lh5.load_dfs(f_hit, copy_cols, lh5_group=tb, idx_list=None, verbose=False)
-        print(f'Table: {tb}, rows:{len(df)}')
-        dfs.append(df)
-        # print(df)
-
-    # # sanity check - test cluster_events with an extra fake channel, #7, with slightly changed timestamps
-    # from scipy.ndimage.filters import gaussian_filter
-    # df_extra = dfs[1].copy()
-    # df_extra['timestamp'] = gaussian_filter(df_extra['timestamp'], sigma=0.1)
-    # df_extra['channel'] = 7
-    # dfs.append(df_extra)
-
-    # run cluster_events
+    if f_evt is not None and os.path.exists(f_evt) and overwrite:
+        os.remove(f_evt)
+    tb_name = 'events' if evt_tb_name is None else evt_tb_name
+
+    # merge the tables in chunks, and either append each chunk of the TCM to
+    # the output file or collect them for an in-memory DataFrame
     print('Building time coincidence map ...')
-    tcm = cluster_events(dfs, **builder_config)
-    print('Done.  TCM output columns:')
-    print(tcm.columns)
-
-    # examine tcm
-    # tcm_view = ['channel','tcm_sec','tcm_dt','ix_evt','ix_hit']
-    # pd.options.display.max_rows = 50
-    # pd.options.display.float_format = '{:,.3e}'.format
-    # print(tcm[tcm_view].head(50))
-    # print(tcm)
-    # print(tcm.columns)
-
-    # write to file if f_evt is set, or return in-memory DataFrame if it isn't.
+    sto = lh5.Store()
+    dfs = []
+    n_hits = 0
+    for tb_tcm in build_tcm(f_hit, lh5_tables, **builder_config):
+        n_hits += tb_tcm.size
+        if f_evt is None:
+            dfs.append(pd.DataFrame({col : tb_tcm[col].nda for col in tb_tcm.keys()}))
+        else:
+            sto.write_object(tb_tcm, tb_name, f_evt)
+    print(f'Done.  {n_hits} hits merged.')
+
+    # return in-memory DataFrame if f_evt isn't set
     if f_evt is None:
-        return tcm
+        if len(dfs) == 0: return None
+        return pd.concat(dfs, ignore_index=True)
+    print('Wrote', tb_name, 'to file:', f_evt)
 
-    print('Writing to file:', f_evt)
-    if os.path.exists(f_evt):
-        os.remove(f_evt)
+    t_elap = time.time() - t_start
+    print(f'Done!  Time elapsed: {t_elap:.2f} sec.')
+
+
+class HitCursor:
+    """
+    Reads the hits of one table in chunks of buffer_len rows for build_tcm(),
+    continuing with the same table in the next file when a file is done. The
+    hits have to be in ascending time order, also from one file to the next.
+    """
+    def __init__(self, sto, get_file, table, n_rows, ts_col, ts_unit, cols, buffer_len):
+        """
+        get_file(i_file) returns the open i_file-th file, and n_rows[i_file]
+        the number of rows of table in it (0 if the file doesn't have it)
+        """
+        self.sto = sto
+        self.get_file = get_file
+        self.table = table
+        self.n_rows = n_rows
+        self.ts_col = ts_col
+        self.ts_unit = ts_unit
+        self.cols = cols
+        self.buffer_len = buffer_len
+        # rows in the files after each file
+        self.n_rows_after = np.cumsum(np.asarray(n_rows)[::-1])[::-1] - n_rows
+        self.buf = None
+        self.t_sec = np.empty(0)
+        self.i_file = 0
+        self.start_row = 0 # row in the table of the first buffered hit
+        self.n_buf = 0
+        self.loc = 0       # next hit in the buffer to be merged
+        self.t_last = -np.inf
+        self.done = False
+
+
+    def more_in_table(self):
+        """Are there hits left to read, in this file or the next ones?"""
+        return (self.start_row + self.n_buf < self.n_rows[self.i_file]
+                or self.n_rows_after[self.i_file] > 0)
+
+
+    def fill(self):
+        """Read the next chunk once all buffered hits have been merged. Returns
+        False when the table is done in all files"""
+        if self.loc < self.n_buf: return True
+        if self.done: return False
+        self.start_row += self.n_buf
+        self.n_buf = 0
+        self.loc = 0
+        while self.start_row >= self.n_rows[self.i_file]:
+            if self.i_file == len(self.n_rows) - 1:
+                self.done = True
+                return False
+            self.i_file += 1
+            self.start_row = 0
+        self.buf, self.n_buf = self.sto.read_object(self.table, self.get_file(self.i_file),
+                                                    start_row=self.start_row,
+                                                    n_rows=self.buffer_len,
+                                                    field_mask=self.cols,
+                                                    obj_buf=self.buf)
+        if self.n_buf == 0:
+            self.done = True
+            return False
+        self.t_sec = self.buf[self.ts_col].nda[:self.n_buf] * self.ts_unit
+        if self.t_sec[0] < self.t_last or np.any(np.diff(self.t_sec) < 0):
+            print(f'Warning! timestamps reset in {self.table}.  TC map will be total nonsense!')
+        self.t_last = self.t_sec[-1]
+        return True
+
+
+@nb.njit(cache=True)
+def cluster_hits(t_sec, coin_window, t_last, ix_evt, ix_hit, evt_out, hit_out, dt_out):
+    """
+    Assign the time-ordered hits t_sec to events: a hit starts a new event if
+    it comes more than coin_window after the previous hit. t_last, ix_evt and
+    ix_hit are the time, event and sub-event index of the hit before t_sec[0],
+    and are returned updated for the next chunk
+    """
+    for i in range(len(t_sec)):
+        dt = t_sec[i] - t_last
+        if dt > coin_window:
+            ix_evt += 1
+            ix_hit = 0
+        else: ix_hit += 1
+        evt_out[i] = ix_evt
+        hit_out[i] = ix_hit
+        dt_out[i] = dt
+        t_last = t_sec[i]
+    return t_last, ix_evt, ix_hit
+
+
+def order_files(f_list, lh5_tables:list, ts_col:str='timestamp'):
+    """
+    Sort hit files (e.g. the cycle files of a run) by the earliest timestamp
+    in any of lh5_tables. Files without any hits go last.
 
+    Parameters
+    ----------
+    f_list : str or list of str's
+        The files. Can contain wildcards
+    lh5_tables : list
+        Names of the tables to look at
+    ts_col : str (optional)
+        Name of the timestamp column
+
+    Returns
+    -------
+    (f_list, n_rows) : tuple
+        The sorted list of files, and an array with the number of rows of
+        each table (2nd axis) in each file (1st axis), 0 where a table is
+        missing
+    """
+    if isinstance(f_list, str): f_list = [f_list]
+    f_list = [f for f_wc in f_list for f in sorted(glob.glob(os.path.expandvars(f_wc)))]
     sto = lh5.Store()
-    col_dict = {col : lh5.Array(tcm[col].values, attrs={'units':''}) for col in tcm.columns}
-    tb_tcm = lh5.Table(size=len(tcm), col_dict=col_dict)
-    tb_name = 'events'
-    sto.write_object(tb_tcm, tb_name, f_evt)
+    n_rows = np.zeros((len(f_list), len(lh5_tables)), dtype=np.int64)
+    t_first = np.full(len(f_list), np.inf)
+    for i_file, f in enumerate(f_list):
+        with h5py.File(f, 'r') as h5f:
+            for i_tb, tb in enumerate(lh5_tables):
+                if f'{tb}/{ts_col}' not in h5f: continue
+                n_rows[i_file, i_tb] = sto.read_n_rows(f'{tb}/{ts_col}', h5f)
+                if n_rows[i_file, i_tb] == 0: continue
+                ts, _ = sto.read_object(f'{tb}/{ts_col}', h5f, n_rows=1)
+                t_first[i_file] = min(t_first[i_file], ts.nda[0])
+    order = np.argsort(t_first, kind='stable')
+    return [f_list[i] for i in order], n_rows[order]
+
+
+def build_tcm(f_hit, lh5_tables:list, ts_unit:float=1e-8, ch_col:str='channel',
+              ts_col:str='timestamp', coin_window:float=4e-6, data_cols:list=None,
+              buffer_len:int=3200):
+    """
+    Build a time coincidence map (TCM) in chunks, with the same clustering as
+    cluster_events(), but without loading whole tables.
+
+    Each table must already be in ascending time order, so the tables are
+    k-way merged: up to buffer_len rows are read from each table, and all
+    buffered hits up to the earliest "last buffered time" among the tables
+    that still have rows to read are merged, clustered into events and
+    yielded. Memory use is therefore bounded by the number of tables times
+    buffer_len, independent of the file size.
+
+    Several files (e.g. all cycle files of a run) are event-built as one
+    stream: they are processed in timestamp order (see order_files()), and
+    each table continues in the next file when it is done in one, so events
+    straddling a file boundary are kept together and ix_evt counts through
+    the whole run.
 
-    # # sanity check, read it back in and convert back to DataFrame
-    # df_check = lh5.load_dfs(f_evt, tcm.columns, lh5_group='events', idx_list=None, verbose=False)
-    # print(tcm)
-    # print(df_check)
+    Parameters
+    ----------
+    f_hit : str or list of str's
+        Input file(s) containing one LH5 table per channel (RAW or DSP). Can
+        contain wildcards
+    lh5_tables : list
+        Names of the tables to merge
+    ts_unit, ch_col, ts_col, coin_window : (optional)
+        See cluster_events(). If a table has no ch_col column, its index in
+        lh5_tables is used as the channel
+    data_cols : list (optional)
+        Additional columns to copy into the TCM. Only columns found in all
+        tables are copied
+    buffer_len : int (optional)
+        Number of rows read from each table at a time
+
+    Yields
+    ------
+    tcm : lh5.Table
+        The next chunk of the TCM, with columns 'ix_evt', 'ix_hit', 'channel',
+        'ix_table' (index in lh5_tables), 'ix_file' (index in the time-ordered
+        list of files), 'ix_row' (row in the table of that file), 'tcm_sec',
+        'tcm_dt' and the data_cols. Event numbering continues across chunks
+        and files
+    """
+    f_list, n_rows = order_files(f_hit, lh5_tables, ts_col)
+    if len(f_list) == 0:
+        print('build_tcm: no files found')
+        return
+    tcm_cols = ['ix_evt', 'ix_hit', 'channel', 'ix_table', 'ix_file', 'ix_row', 'tcm_sec', 'tcm_dt']
+    if data_cols is None: data_cols = []
+    data_cols = [col for col in data_cols if col not in tcm_cols and col != ch_col]
+    has_ch = [True] * len(lh5_tables)
+    for i_file, f in enumerate(f_list):
+        with h5py.File(f, 'r') as h5f:
+            for i_tb, tb in enumerate(lh5_tables):
+                if n_rows[i_file, i_tb] == 0: continue
+                if f'{tb}/{ch_col}' not in h5f: has_ch[i_tb] = False
+                for col in list(data_cols):
+                    if f'{tb}/{col}' not in h5f:
+                        print(f'build_tcm: {col} not in {tb} in {f}, not copied')
+                        data_cols.remove(col)
+
+    # the files are opened when the first table gets to them, and closed once
+    # all tables are past them
+    sto = lh5.Store()
+    h5fs = {}
+    def get_file(i_file):
+        if i_file not in h5fs: h5fs[i_file] = h5py.File(f_list[i_file], 'r')
+        return h5fs[i_file]
+
+    cursors = []
+    for i_tb, tb in enumerate(lh5_tables):
+        cols = [ts_col] + ([ch_col] if has_ch[i_tb] else []) + data_cols
+        cursors.append(HitCursor(sto, get_file, tb, n_rows[:, i_tb], ts_col, ts_unit,
+                                 cols, buffer_len))
+
+    t_last, ix_evt, ix_hit = np.nan, 0, -1
+    while True:
+        active = [ii for ii, cur in enumerate(cursors) if cur.fill()]
+        if len(active) == 0: break
+
+        # no table can have a hit before t_safe left to read
+        t_bounds = [cursors[ii].t_sec[-1] for ii in active if cursors[ii].more_in_table()]
+        t_safe = min(t_bounds) if len(t_bounds) > 0 else np.inf
+
+        # take the buffered hits up to t_safe from each table
+        t_sec, channel, ix_table, ix_file, ix_row = [], [], [], [], []
+        data = {col : [] for col in data_cols}
+        for ii in active:
+            cur = cursors[ii]
+            if cur.t_sec[-1] <= t_safe: stop = cur.n_buf
+            else: stop = cur.loc + np.searchsorted(cur.t_sec[cur.loc:], t_safe, side='right')
+            if stop == cur.loc: continue
+            t_sec.append(cur.t_sec[cur.loc:stop])
+            if has_ch[ii]: channel.append(cur.buf[ch_col].nda[cur.loc:stop])
+            else: channel.append(np.full(stop-cur.loc, ii))
+            ix_table.append(np.full(stop-cur.loc, ii))
+            ix_file.append(np.full(stop-cur.loc, cur.i_file))
+            ix_row.append(np.arange(cur.start_row+cur.loc, cur.start_row+stop))
+            for col in data_cols: data[col].append(cur.buf[col].nda[cur.loc:stop])
+            cur.loc = stop
+
+        # merge the (sorted) pieces
+        t_sec = np.concatenate(t_sec)
+        order = np.argsort(t_sec, kind='stable')
+        t_sec = t_sec[order]
+        n_hits = len(t_sec)
+        evt_out = np.empty(n_hits, dtype=np.int64)
+        hit_out = np.empty(n_hits, dtype=np.int64)
+        dt_out = np.empty(n_hits, dtype=np.float64)
+        t_last, ix_evt, ix_hit = cluster_hits(t_sec, coin_window, t_last, ix_evt, ix_hit,
+                                              evt_out, hit_out, dt_out)
+
+        col_dict = {
+            'ix_evt' : lh5.Array(evt_out, attrs={'units':''}),
+            'ix_hit' : lh5.Array(hit_out, attrs={'units':''}),
+            'channel' : lh5.Array(np.concatenate(channel)[order], attrs={'units':''}),
+            'ix_table' : lh5.Array(np.concatenate(ix_table)[order], attrs={'units':''}),
+            'ix_file' : lh5.Array(np.concatenate(ix_file)[order], attrs={'units':''}),
+            'ix_row' : lh5.Array(np.concatenate(ix_row)[order], attrs={'units':''}),
+            'tcm_sec' : lh5.Array(t_sec, attrs={'units':'s'}),
+            'tcm_dt' : lh5.Array(dt_out, attrs={'units':'s'})
+        }
+        for col in data_cols:
+            col_dict[col] = lh5.Array(np.concatenate(data[col])[order], attrs={'units':''})
+        # release the views of the read buffers, otherwise they can't be resized
+        del channel, data
+        yield lh5.Table(size=n_hits, col_dict=col_dict)
 
-    t_elap = time.time() - t_start
-    print(f'Done!  Time elapsed: {t_elap:.2f} sec.')
+        i_files = [cur.i_file for cur in cursors if not cur.done]
+        i_file_min = min(i_files) if len(i_files) > 0 else len(f_list)
+        for i_file in [i for i in h5fs if i < i_file_min]: h5fs.pop(i_file).close()
+
+    for h5f in h5fs.values(): h5f.close()
 
 
 def cluster_events(tb_list:list, ts_unit:float=1e-8, ch_col:str='channel',
@@ -144,7 +398,8 @@ def cluster_events(tb_list:list, ts_unit:float=1e-8, ch_col:str='channel',
     Create a time coincidence map (TCM), given a list of data tables from separate channels.
     Assume that all tables are from different channels in a SINGLE cycle file.
     Hopefully we won't need to extend this to event building across multiple cycles
-    as in Majorana.
+    as in Majorana.  This loads and sorts everything in memory; for large files
+    use build_tcm(), which does the same clustering in chunks.
     - Sort events in DataFrames by strictly ascending timestamps
     - Group hits if the difference between times is less than `coin_window` (default length 4*us)
     - Don't allow events from the same channel into any event.
@@ -219,15 +474,15 @@ def cluster_events(tb_list:list, ts_unit:float=1e-8, ch_col:str='channel',
 
 if __name__=='__main__':
     doc = """Demonstrate usage of the `hit_to_evt` function, to build a time
-    coincidence map and organize data from many channels in a single cycle file,
-    into an event-like structure where coincindent events are time-ordered and
-    grouped together into sub-events."""
+    coincidence map and organize data from many channels in a single cycle file
+    (or all cycle files of a run), into an event-like structure where
+    coincindent events are time-ordered and grouped together into sub-events."""
 
     # parse user args
     rthf = argparse.RawTextHelpFormatter
     par = argparse.ArgumentParser(description=doc, formatter_class=rthf)
     arg, st, sf = par.add_argument, 'store_true', 'store_false'
-    arg('input', type=str, help='input file name (required)')
+    arg('input', type=str, nargs='+', help='input file name(s) (required)')
     arg('-o', '--output', type=str, help='output file name')
     args = par.parse_args()
 
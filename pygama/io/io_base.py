@@ -23,7 +23,9 @@ class DataDecoder(ABC):
     Garbage collection writes binary data as an array of uint32s to a
     variable-length array in the output file. If a problematic packet is found,
     call put_in_garbage(packet). User should set up an enum or bitbank of garbage
-    codes to be stored along with the garbage packets.
+    codes to be stored along with the garbage packets. Drivers write the
+    garbage out alongside the data with write_out_garbage(), so that bad
+    packets can be inspected later instead of stopping the run.
     """
     def __init__(self, garbage_length=256, packet_size_guess=1024):
         self.garbage_table = lh5.Table(garbage_length)
@@ -36,6 +38,7 @@ class DataDecoder(ABC):
         # before calling super()
         self.garbage_table.add_field('garbage_code',
                                      lh5.Array(shape=garbage_length, dtype='uint32'))
+        self.n_garbage = 0 # total number of packets put in the garbage
 
 
     def get_decoded_values(self, channel=None):
@@ -131,20 +134,35 @@ class DataDecoder(ABC):
 
 
     def put_in_garbage(self, packet, packet_id, code):
+        """Copy packet (any buffer) into the garbage table with its
+        packet_id and garbage code. The table grows as needed until it is
+        written out"""
+        if self.garbage_table.is_full():
+            self.garbage_table.resize(2*self.garbage_table.size)
         i_row = self.garbage_table.loc
         p8 = np.frombuffer(packet, dtype='uint8')
         self.garbage_table['packets'].set_vector(i_row, p8)
         self.garbage_table['packet_id'].nda[i_row] = packet_id
-        self.garbage_table['garbage_codes'].nda[i_row] = code
+        self.garbage_table['garbage_code'].nda[i_row] = code
         self.garbage_table.push_row()
+        self.n_garbage += 1
 
 
-    def write_out_garbage(self, filename, group='/', lh5_store=None):
+    def write_out_garbage(self, filename, group='/', lh5_store=None, force=False):
+        """Append the garbage collected so far to table 'garbage' in group
+        of filename and clear the garbage table. Nothing is written if there is
+        no garbage, unless force is True (e.g. to create the table before
+        switching a file to SWMR mode). lh5_store can be an lh5.Store or an
+        lh5.AsyncWriter. Returns the number of packets written"""
         if lh5_store is None: lh5_store = lh5.Store()
         n_rows = self.garbage_table.loc
-        if n_rows == 0: return
-        lh5_store.write_object(self.garbage_table, 'garbage', filename, group, n_rows=n_rows, append=True)
+        if n_rows == 0 and not force: return 0
+        if isinstance(lh5_store, lh5.AsyncWriter):
+            lh5_store.write_object(self.garbage_table, 'garbage', filename, group, n_rows=n_rows, copy=True)
+        else:
+            lh5_store.write_object(self.garbage_table, 'garbage', filename, group, n_rows=n_rows, append=True)
         self.garbage_table.clear()
+        return n_rows
 
 
 
@@ -1,10 +1,9 @@
-import sys
+import os, sys, time
 import numpy as np
-import pandas as pd
 from pprint import pprint
 
-from .io_base import DataTaker
-#from .waveform import Waveform
+from .io_base import DataDecoder
+from pygama import lh5
 from ..utils import tqdm_range, update_progress
 
 class llama_3316:
@@ -17,15 +16,6 @@ class llama_3316:
         self.f_in = file_binary
         self.verbose = verbosity
         flag = self.parse_fileheader()
-        # chConf = self.parse_channelConfigs()
-
-        #idx, nrx = self.__read_chunk_header()
-        #print("head1: ID: {}, nr: {}".format(idx, nrx))
-        #flag = True
-        #while flag:
-        #    fi, ci, da = self.read_next_event(chConf)
-        #    if da is None:
-        #        flag = False
 
     def parse_fileheader(self):
         """
@@ -39,8 +29,8 @@ class llama_3316:
         """
         self.f_in.seek(0)    #should be there anyhow, but re-set if not
         header = self.f_in.read(16)
-        evt_data_32 = np.fromstring(header, dtype=np.uint32)
-        evt_data_16 = np.fromstring(header, dtype=np.uint16)
+        evt_data_32 = np.frombuffer(header, dtype=np.uint32)
+        evt_data_16 = np.frombuffer(header, dtype=np.uint16)
 
         #line0: magic bytes
         magic = evt_data_32[0]
@@ -91,8 +81,8 @@ class llama_3316:
 
             channel = self.f_in.read(68)
             ch_dpf = channel[16:32]
-            evt_data_32 = np.fromstring(channel, dtype=np.uint32)
-            evt_data_dpf = np.fromstring(ch_dpf, dtype=np.float64)
+            evt_data_32 = np.frombuffer(channel, dtype=np.uint32)
+            evt_data_dpf = np.frombuffer(ch_dpf, dtype=np.float64)
 
             fadcIndex = evt_data_32[0]
             channelIndex = evt_data_32[1]
@@ -130,9 +120,6 @@ class llama_3316:
         if self.verbose > 0:
             pprint(channelConfigs)
 
-        #self.chConfigs = channelConfigs
-
-        self.currentEventIndex=-1   #points to header of next chunk, not to event
         self.currentChunkIndex=0    #points to first chunk of file
 
         return channelConfigs
@@ -149,85 +136,88 @@ class llama_3316:
         if len(header) < 8:
             raise BinaryReadException(8, len(header))
 
-        header_data_32 = np.fromstring(header, dtype=np.uint32)
-
-        self.currentEventIndex=0   #points to first event of chunk
+        header_data_32 = np.frombuffer(header, dtype=np.uint32)
 
         if header_data_32[1] == 0:
             if self.verbose > 1:
                 print("Warning: having a chunk with 0 events")
 
-        return header_data_32[0], header_data_32[1]
-
-
-    def __read_next_event(self, fadcID, channelConfigs, nrEventsPerChunk):
-        """
-        reads a chunk of data containing event data (event header and samples)
-        file pointer has to be on beginning of event, NOT on chunk header
-        Returns the channelID of the Event, as well as the chunk of data
-        """
-
-        if self.currentEventIndex == -1:
-            print("ERROR: pointing at chunk header!")
-            return None
-
-        if self.verbose > 1:
-            print("Reading chunk #{} event #{}".format(self.currentChunkIndex, self.currentEventIndex))
-
-        position = self.f_in.tell()     #save position of the event header's 1st byte
-        data1 = self.f_in.read(4)       #read the first (32 bit) word of the event's header: channelID & format bits
-        if len(data1) < 4:
-            raise BinaryReadException(4, len(data1))
-        self.f_in.seek(position)        #go back to 1st position of event header
-
-        header_data_32 = np.fromstring(data1, dtype=np.uint32)
-        channelID = (header_data_32[0] >> 4) & 0x00000fff
-        if self.verbose > 1:
-            print("Event is from FADC #{}, channel #{}".format(fadcID, channelID))
-        eventLength8 = channelConfigs[fadcID][channelID]["EventLength"]
-        eventLength8 *= 4 #EventLength is in 32 bit
-
-        data = self.f_in.read(eventLength8)
-        if len(data) < eventLength8:
-            raise BinaryReadException(eventLength8, len(data))
-
-        self.currentEventIndex += 1     #move to next event
-        if(self.currentEventIndex == nrEventsPerChunk): #if this event was the last of the chunk
-            self.currentEventIndex = -1     #points to header of next chunk, not to event
-            self.currentChunkIndex += 1     #points to next chunk of file
-
-
-        return channelID, data
+        return int(header_data_32[0]), int(header_data_32[1])
 
 
-    def read_next_event(self, channelConfigs):
+    def read_next_chunk(self, channelConfigs):
         """
         This should be the main method to call when parsing the file for events.
-        returns the current FADC index, the channel ID and the binary data of the event if a valid event is found
-        Returns -1, -1, None when after the last event in the file.
-        automatically goes to the next event in the file, calling __read_chunk_header and __read_next_event
-        when appropriate.
-        returns FADCindex, channelIndex, binaryEventData
+        Reads the next chunk of the file (FADC index + a number of events) as
+        a whole and splits its events by channel. The event length of each
+        channel is fixed by its "EventLength" in channelConfigs.
+
+        Returns the FADC index, the channel IDs of the events in the chunk,
+        and a dict channelID -> (indices of the channel's events in the
+        chunk, 2D uint32 array of their data words, one event per row).
+        Returns -1, None, None when after the last event in the file.
         """
-
-        # have to extract channel index from binary, since we need the length of the event, which can change between channels
-
-        if self.currentEventIndex == -1:     #points to header of next chunk, not to event
-            self.currentChunkSize = 0
-            try:
-                while self.currentChunkSize == 0:   #apparently needed, as there can be 0-size chunks in the file
-                    self.currentFADC, self.currentChunkSize = self.__read_chunk_header()
-            except BinaryReadException as e:
-                #print("  No more data...\n")
-                return -1,-1,None
-
         try:
-            channelID, binary_data = self.__read_next_event(self.currentFADC, channelConfigs, self.currentChunkSize)
+            nrEvents = 0
+            while nrEvents == 0:   #apparently needed, as there can be 0-size chunks in the file
+                fadcID, nrEvents = self.__read_chunk_header()
         except BinaryReadException as e:
-            #print("  No more data...\n")
-            return -1,-1,None
-
-        return self.currentFADC, channelID, binary_data
+            return -1, None, None
+        if self.verbose > 1:
+            print("Reading chunk #{}: FADC #{}, {} events".format(self.currentChunkIndex, fadcID, nrEvents))
+        self.currentChunkIndex += 1
+
+        # the channels of an FADC usually share the event length: then the
+        # chunk is a 2D array. Otherwise, walk the event headers
+        if fadcID not in channelConfigs:
+            print("ERROR: unknown FADC", fadcID, "in chunk", self.currentChunkIndex-1)
+            return -1, None, None
+        fadcConfigs = channelConfigs[fadcID]
+        lengths32 = { ch : int(conf["EventLength"]) for ch, conf in fadcConfigs.items() }
+        max_len32 = max(lengths32.values())
+        position = self.f_in.tell()
+        data = self.f_in.read(4 * max_len32 * nrEvents)
+        words = np.frombuffer(data, dtype=np.uint32, count=len(data)//4)
+        if len(set(lengths32.values())) == 1:
+            n_full = min(nrEvents, len(words) // max_len32)
+            words = words[:n_full * max_len32].reshape(n_full, max_len32)
+            channelIDs = (words[:, 0] >> 4) & 0x00000fff
+            unknown = ~np.isin(channelIDs, list(lengths32.keys()))
+            if unknown.any():
+                print("ERROR: unknown channel", channelIDs[unknown][0], "of FADC", fadcID, "in chunk", self.currentChunkIndex-1)
+                n_full = np.argmax(unknown)
+                words, channelIDs = words[:n_full], channelIDs[:n_full]
+            chunk_len32 = n_full * max_len32
+        else:
+            offsets = []
+            channelIDs = []
+            offset = 0
+            for i in range(nrEvents):
+                if offset >= len(words): break
+                channelID = (int(words[offset]) >> 4) & 0x00000fff
+                if channelID not in lengths32:
+                    print("ERROR: unknown channel", channelID, "of FADC", fadcID, "in chunk", self.currentChunkIndex-1)
+                    break
+                if offset + lengths32[channelID] > len(words): break
+                offsets.append(offset)
+                channelIDs.append(channelID)
+                offset += lengths32[channelID]
+            chunk_len32 = offset
+            offsets = np.array(offsets, dtype='int64')
+            channelIDs = np.array(channelIDs, dtype='uint32')
+        self.f_in.seek(position + 4 * chunk_len32)
+        if len(channelIDs) < nrEvents:
+            print("WARNING: chunk", self.currentChunkIndex-1, "is truncated:",
+                  len(channelIDs), "of", nrEvents, "events read")
+
+        events = {}
+        for channelID in np.unique(channelIDs).tolist():
+            i_evts = np.flatnonzero(channelIDs == channelID)
+            if words.ndim == 2: events[channelID] = (i_evts, words[i_evts])
+            else:
+                idx = offsets[i_evts, None] + np.arange(lengths32[channelID])
+                events[channelID] = (i_evts, words[idx])
+        return fadcID, channelIDs, events
 
 
 
@@ -241,8 +231,11 @@ class BinaryReadException(Exception):
         print("Exception: tried to read {} bytes, got {} bytes".format(self.reqNOB, self.gotNOB))
 
 
+# garbage code of LLAMAStruck3316 (see DataDecoder.put_in_garbage())
+LLAMA_BAD_LENGTH = 1 # waveform length doesn't match the event size
+
 
-class LLAMAStruck3316(DataTaker):
+class LLAMAStruck3316(DataDecoder):
     """
     decode Struck 3316 digitizer data
 
@@ -256,28 +249,77 @@ class LLAMAStruck3316(DataTaker):
 
         # store an entry for every event
         self.decoded_values = {
-            "packet_id": [],
-            "ievt": [],
-            "energy_first": [],
-            "energy": [],
-            "timestamp": [],
-            "peakhigh_index": [],
-            "peakhigh_value": [],
-            "information": [],
-            "accumulator1": [],
-            "accumulator2": [],
-            "accumulator3": [],
-            "accumulator4": [],
-            "accumulator5": [],
-            "accumulator6": [],
-            "accumulator7": [],
-            "accumulator8": [],
-            "mawMax": [],
-            "maw_before": [],
-            "maw_after": [],
-            "fadcID": [],
-            "channel": [],
-            "waveform": [],
+            'packet_id': { # index of the event in the file
+              'dtype': 'uint32',
+            },
+            'ievt': { # index of the decoded (non-garbage) event
+              'dtype': 'uint32',
+            },
+            'energy_first': {
+              'dtype': 'uint32',
+            },
+            'energy': {
+              'dtype': 'uint32',
+            },
+            'timestamp': {
+              'dtype': 'uint64',
+              'units': 'clock_ticks',
+            },
+            'peakhigh_index': {
+              'dtype': 'uint16',
+            },
+            'peakhigh_value': {
+              'dtype': 'uint16',
+            },
+            'information': {
+              'dtype': 'uint32',
+            },
+            'accumulator1': {
+              'dtype': 'uint32',
+            },
+            'accumulator2': {
+              'dtype': 'uint32',
+            },
+            'accumulator3': {
+              'dtype': 'uint32',
+            },
+            'accumulator4': {
+              'dtype': 'uint32',
+            },
+            'accumulator5': {
+              'dtype': 'uint32',
+            },
+            'accumulator6': {
+              'dtype': 'uint32',
+            },
+            'accumulator7': {
+              'dtype': 'uint32',
+            },
+            'accumulator8': {
+              'dtype': 'uint32',
+            },
+            'mawMax': {
+              'dtype': 'uint32',
+            },
+            'maw_before': {
+              'dtype': 'uint32',
+            },
+            'maw_after': {
+              'dtype': 'uint32',
+            },
+            'fadcID': {
+              'dtype': 'uint32',
+            },
+            'channel': {
+              'dtype': 'uint32',
+            },
+            'waveform': {
+              'dtype': 'uint16',
+              'datatype': 'waveform',
+              'length': 65532, # max value. override this before initializing buffers to save RAM
+              'sample_period': 4, # override if a different clock rate is used
+              'sample_period_units': 'ns',
+            },
         }
 
         self.config_names = []  #TODO at some point we want the metainfo here
@@ -285,19 +327,15 @@ class LLAMAStruck3316(DataTaker):
         if metadata is not None:
             self.file_config = self.readMetadata(metadata)
             print("We have {} adcs and {} samples per WF.".format(self.file_config["nadcs"],self.file_config["nsamples"]))
+            self.decoded_values['waveform']['length'] = int(self.file_config["nsamples"])
 
-        super().__init__(*args, **kwargs) # also initializes the garbage df (whatever that means...)
+        super().__init__(*args, **kwargs)
 
-        # self.event_header_length = 1 #?
         self.sample_period = 0  # ns, I will set this later, according to header info
         self.gain = 0
-        self.h5_format = "table"	#was table
-        #self.n_blsamp = 2000
         self.ievt = 0       #event number
-        self.ievt_gbg = 0      #garbage event number
-        self.window = False
+        self.n_bad = 0      #events with inconsistent waveform length
         self.df_metadata = metadata #seems that was passed to superclass before, try now like this
-        self.pytables_col_limit = 3000
 
     def readMetadata(self, meta):
         nsamples = -1
@@ -333,154 +371,140 @@ class LLAMAStruck3316(DataTaker):
         """
         self.sample_period = sample_period
         self.gain = gain
+        self.decoded_values['waveform']['sample_period'] = sample_period
 
 
-    def decode_event(self, event_data_bytes, packet_id, header_dict, fadcIndex,
-                     channelIndex, verbose=False):
+    def decode_events(self, evt_words, lh5_table, packet_ids, fadcIndex, channelIndex):
         """
-        see the llamaDAQ documentation for data word diagrams
+        Decode a batch of events of one channel into the next rows of
+        lh5_table. See the llamaDAQ documentation for data word diagrams.
+
+        evt_words is a 2D uint32 array with one event per row, e.g. from
+        llama_3316.read_next_chunk(). The events are decoded with vectorized
+        column operations, one pass per combination of format bits present
+        (usually just one per channel). Events whose waveform length doesn't
+        match their size, or that are too short for their header, are put in
+        the garbage (see put_in_garbage()) and counted in self.n_bad.
+
+        Returns the number of events consumed, which is limited by the space
+        left in lh5_table
         """
-
         if self.sample_period == 0:
-            print("ERROR: Sample period not set; use initialize() before using decode_event() on SIS3316Decoder")
+            print("ERROR: Sample period not set; use initialize() before using decode_events() on SIS3316Decoder")
             raise Exception ("Sample period not set")
 
-        # parse the raw event data into numpy arrays of 16 and 32 bit ints
-        evt_data_32 = np.fromstring(event_data_bytes, dtype=np.uint32)
-        evt_data_16 = np.fromstring(event_data_bytes, dtype=np.uint16)
-
-        # e sti gran binaries non ce li metti
-        timestamp = ((evt_data_32[0] & 0xffff0000) << 16) + evt_data_32[1]
-        format_bits = (evt_data_32[0]) & 0x0000000f
-        offset = 2
-        if format_bits & 0x1:
-            peakhigh_value = evt_data_16[4]
-            peakhigh_index = evt_data_16[5]
-            information = (evt_data_32[offset+1] >> 24) & 0xff
-            accumulator1 = evt_data_32[offset+2]
-            accumulator2 = evt_data_32[offset+3]
-            accumulator3 = evt_data_32[offset+4]
-            accumulator4 = evt_data_32[offset+5]
-            accumulator5 = evt_data_32[offset+6]
-            accumulator6 = evt_data_32[offset+7]
-            offset += 7
-        else:
-            peakhigh_value = 0
-            peakhigh_index = 0
-            information = 0
-            accumulator1 = accumulator2 = accumulator3 = accumulator4 = accumulator5 = accumulator6 = 0
-            pass
-        if format_bits & 0x2:
-            accumulator7 = evt_data_32[offset+0]
-            accumulator8 = evt_data_32[offset+1]
-            offset += 2
-        else:
-            accumulator7 = accumulator8 = 0
-            pass
-        if format_bits & 0x4:
-            mawMax = evt_data_32[offset+0]
-            maw_before = evt_data_32[offset+1]
-            maw_after = evt_data_32[offset+2]
-            offset += 3
-        else:
-            mawMax = maw_before = maw_after = 0
-            pass
-        if format_bits & 0x8:
-            energy_first = evt_data_32[offset+0]
-            energy = evt_data_32[offset+1]
-            offset += 2
-        else:
-            energy_first = energy = 0
-            pass
-        wf_length_32 = (evt_data_32[offset+0]) & 0x03ffffff
-        offset += 1 #now the offset points to the wf data
-        fadcID = fadcIndex
-        channel = channelIndex
-
-
-        # compute expected and actual array dimensions
-        wf_length16 = 2 * wf_length_32
-        header_length16 = offset * 2
-        expected_wf_length = len(evt_data_16) - header_length16
-
-        # error check: waveform size must match expectations
-        if wf_length16 != expected_wf_length:
-            print(len(evt_data_16), header_length16)
-            print("ERROR: Waveform size %d doesn't match expected size %d." %
-                  (wf_length16, expected_wf_length))
-            exit()
-
-        # indexes of stuff (all referring to the 16 bit array)
-        i_wf_start = header_length16
-        i_wf_stop = i_wf_start + wf_length16
-
-        # handle the waveform(s)
-        if wf_length_32 > 0:
-            wf_data = evt_data_16[i_wf_start:i_wf_stop]
-
-        if len(wf_data) != expected_wf_length:
-            print("ERROR: event %d, we expected %d WF samples and only got %d" %
-                  (ievt, expected_wf_length, len(wf_data)))
-            exit()
-
-        # final raw wf array
-        waveform = wf_data
-
-        # if the wf is too big for pytables, we can window it
-        if self.window:
-            wf = Waveform(wf_data, self.sample_period, self.decoder_name)
-            win_wf, win_ts = wf.window_waveform(self.win_type,
-                                                self.n_samp,
-                                                self.n_blsamp,
-                                                test=False)
-            # ts_lo, ts_hi = win_ts[0], win_ts[-1]  # FIXME: what does this mean?
-
-            waveform = win_wf # modify final wf array
-
-            if wf.is_garbage:
-                ievt = self.ievt_gbg
-                self.ievt_gbg += 1
-                self.format_data(locals(), wf.is_garbage)
-                return
-
-        if len(waveform) > self.pytables_col_limit and self.h5_format == "table":
-            print("WARNING: too many columns for tables output,\n",
-                  "         reverting to saving as fixed hdf5 ...")
-            self.h5_format = "fixed"
-
-        # set the event number (searchable HDF5 column)
-        ievt = self.ievt
-        self.ievt += 1
-
-        # send any variable with a name in "decoded_values" to the pandas output
-        self.format_data(locals())
-
-
-def process_llama_3316(daq_filename, raw_filename, run, n_max, config, verbose):
+        n = min(len(evt_words), lh5_table.size - lh5_table.loc)
+        evt_words = evt_words[:n]
+        packet_ids = packet_ids[:n]
+
+        # header length in words for each event, then the waveform length
+        format_bits = evt_words[:, 0] & 0x0000000f
+        offsets = 2 + 7*(format_bits & 0x1) + 2*((format_bits >> 1) & 0x1) \
+                    + 3*((format_bits >> 2) & 0x1) + 2*((format_bits >> 3) & 0x1)
+        offsets = offsets.astype('int64')
+        # events too short to even hold their header are bad as well
+        in_range = offsets < evt_words.shape[1]
+        i_in = np.flatnonzero(in_range)
+        wf_length_32 = np.zeros(n, dtype='int64')
+        wf_length_32[i_in] = evt_words[i_in, offsets[i_in]] & 0x03ffffff
+        good = in_range & (wf_length_32 == evt_words.shape[1] - offsets - 1)
+        if not good.all():
+            n_bad = n - np.count_nonzero(good)
+            if self.n_bad == 0:
+                print("ERROR: Waveform size doesn't match the event size in",
+                      n_bad, "events of FADC", fadcIndex, "channel", channelIndex, "... skipping them")
+            self.n_bad += n_bad
+            for i in np.flatnonzero(~good).tolist():
+                self.put_in_garbage(evt_words[i], packet_ids[i], LLAMA_BAD_LENGTH)
+            evt_words, packet_ids, format_bits = evt_words[good], packet_ids[good], format_bits[good]
+
+        n_good = len(evt_words)
+        rows = np.arange(lh5_table.loc, lh5_table.loc + n_good)
+        tbl = lh5_table
+        tbl['packet_id'].nda[rows] = packet_ids
+        tbl['ievt'].nda[rows] = self.ievt + np.arange(n_good)
+        tbl['fadcID'].nda[rows] = fadcIndex
+        tbl['channel'].nda[rows] = channelIndex
+        timestamp = ((evt_words[:, 0] & 0xffff0000).astype('uint64') << 16) + evt_words[:, 1]
+        tbl['timestamp'].nda[rows] = timestamp
+        wf_values = tbl['waveform']['values'].nda
+
+        for fb in np.unique(format_bits).tolist():
+            i_fb = np.flatnonzero(format_bits == fb)
+            r = rows[i_fb]
+            w = evt_words[i_fb]
+            offset = 2
+            if fb & 0x1:
+                tbl['peakhigh_value'].nda[r] = w[:, offset] & 0xffff
+                tbl['peakhigh_index'].nda[r] = w[:, offset] >> 16
+                tbl['information'].nda[r] = (w[:, offset+1] >> 24) & 0xff
+                tbl['accumulator1'].nda[r] = w[:, offset+1] & 0x00ffffff
+                for i in range(2, 7):
+                    tbl[f'accumulator{i}'].nda[r] = w[:, offset+i]
+                offset += 7
+            else:
+                for field in ['peakhigh_value', 'peakhigh_index', 'information']:
+                    tbl[field].nda[r] = 0
+                for i in range(1, 7): tbl[f'accumulator{i}'].nda[r] = 0
+            if fb & 0x2:
+                tbl['accumulator7'].nda[r] = w[:, offset+0]
+                tbl['accumulator8'].nda[r] = w[:, offset+1]
+                offset += 2
+            else:
+                tbl['accumulator7'].nda[r] = 0
+                tbl['accumulator8'].nda[r] = 0
+            if fb & 0x4:
+                tbl['mawMax'].nda[r] = w[:, offset+0]
+                tbl['maw_before'].nda[r] = w[:, offset+1]
+                tbl['maw_after'].nda[r] = w[:, offset+2]
+                offset += 3
+            else:
+                for field in ['mawMax', 'maw_before', 'maw_after']: tbl[field].nda[r] = 0
+            if fb & 0x8:
+                tbl['energy_first'].nda[r] = w[:, offset+0]
+                tbl['energy'].nda[r] = w[:, offset+1]
+                offset += 2
+            else:
+                tbl['energy_first'].nda[r] = 0
+                tbl['energy'].nda[r] = 0
+            offset += 1 #now the offset points to the wf data
+
+            # waveforms: all events of this format have the same length
+            wf16 = w[:, offset:].view(np.uint16)
+            wf_len = min(wf16.shape[1], wf_values.shape[1])
+            if wf_len < wf_values.shape[1]: wf_values[r, wf_len:] = 0
+            wf_values[r, :wf_len] = wf16[:, :wf_len]
+
+        self.ievt += n_good
+        lh5_table.loc += n_good
+        return n
+
+
+def process_llama_3316(daq_filename, raw_filename, run, n_max, config, verbose, buffer_size=8192):
     """
     convert llama DAQ data to pygama "raw" lh5
 
     Mario's implementation for the Struck SIS3316 digitizer.
     Requires the llamaDAQ program for producing compatible input files.
-    """
-    ROW_LIMIT = 5e4
 
+    The file is read a chunk (an FADC index and its events) at a time, and
+    the events of each channel in a chunk are decoded together into an lh5
+    Table of buffer_size rows, written to SIS3316Decoder/raw in raw_filename
+    whenever it fills up.
+
+    Returns the number of bytes read
+    """
     start = time.time()
-    f_in = open(daq_filename.encode('utf-8'), "rb")
-    if f_in == None:
+    try: f_in = open(daq_filename, "rb")
+    except FileNotFoundError:
         print("Couldn't find the file %s" % daq_filename)
         sys.exit(0)
 
-    #file = llama_3316(f_in,2) #test
-
     verbosity = 1 if verbose else 0     # 2 is for debug
     sisfile = llama_3316(f_in, verbosity)
 
     # figure out the total size
-    SEEK_END = 2
-    f_in.seek(0, SEEK_END)
-    file_size = float(f_in.tell())
-    f_in.seek(0, 0)  # rewind
+    file_size = os.path.getsize(daq_filename)
     file_size_MB = file_size / 1e6
     print("Total file size: {:.3f} MB".format(file_size_MB))
 
@@ -489,42 +513,25 @@ def process_llama_3316(daq_filename, raw_filename, run, n_max, config, verbose):
     # run = get_run_number(header_dict)
     print("Run number: {}".format(run))
 
-    pprint(header_dict)
+    if verbose: pprint(header_dict)
 
-    #see pygama/pygama/io/decoders/io_base.py
-    decoders = []
-    #decoders.append(LLAMAStruck3316(metadata=pd.DataFrame.from_dict(header_dict)))   #we just have that one
-    decoders.append(LLAMAStruck3316(metadata=header_dict))  #we just have that one
-                    # fix: saving metadata using io_bases ctor
-                    # have to convert to dataframe here in order to avoid
-                    # passing to xml_header.get_object_info in io_base.load_metadata
+    decoder = LLAMAStruck3316(metadata=header_dict)  #we just have that one
     channelOne = list(list(header_dict.values())[0].values())[0]
-    decoders[0].initialize(1000./channelOne["SampleFreq"], channelOne["Gain"])
+    decoder.initialize(1000./channelOne["SampleFreq"], channelOne["Gain"])
         # FIXME: gain set according to first found channel, but gain can change!
 
     print("pygama will run this fancy decoder: SIS3316Decoder")
 
-    # pass in specific decoder options (windowing, multisampling, etc.)
-    #for d in decoders:
-    #    d.apply_config(config) #no longer used (why?)
+    tbl = lh5.Table(buffer_size)
+    decoder.initialize_lh5_table(tbl)
+    lh5_store = lh5.Store()
+    group_path = decoder.decoder_name + '/raw'
 
     # ------------ scan over raw data starts here -----------------
-    # more code duplication
-
-    print("Beginning Tier 0 processing ...")
-
-    packet_id = 0  # number of events decoded
-    row_id = 0      #index of written rows, FIXME maybe gets unused
-    unrecognized_data_ids = []
-
-    # header is already skipped by llama_3316,
 
-    def toFile(digitizer, filename_raw, rowID, verbose):
-        numb = str(rowID).zfill(4)
-        filename_mod = filename_raw + "." + numb
-        print("redirecting output file to packetfile "+filename_mod)
-        digitizer.save_to_pytables(filename_mod, verbose)
+    print("Beginning daq-to-raw processing ...")
 
+    packet_id = 0  # number of events read
 
     n_entries = 0
     unit = "B"
@@ -536,54 +543,52 @@ def process_llama_3316(daq_filename, raw_filename, run, n_max, config, verbose):
     progress_bar = tqdm_range(0, int(n_entries), text="Processing", verbose=verbose, unit=unit)
     file_position = 0
 
-
     # start scanning
-    while (packet_id < n_max and f_in.tell() < file_size):
-        packet_id += 1
-
-        # write periodically to the output file instead of writing all at once
-        if packet_id % ROW_LIMIT == 0:
-            for d in decoders:
-                d.save_to_lh5(raw_filename)
-            row_id += 1
-
-        try:
-            fadcID, channelID, event_data = sisfile.read_next_event(header_dict)
-        except Exception as e:
-            print("Failed to get the next event ... Exception:",e)
-            break
-        if event_data is None:
-            break
-
-        decoder = decoders[0]       #well, ...
-        # sends data to the pandas dataframe
-        decoder.decode_event(event_data, packet_id, header_dict, fadcID, channelID)
+    while packet_id < n_max:
+        fadcID, channelIDs, events = sisfile.read_next_chunk(header_dict)
+        if channelIDs is None: break
+        n_evts = len(channelIDs)
+        if packet_id + n_evts > n_max: n_evts = int(n_max - packet_id)
+
+        for channelID, (i_evts, evt_words) in events.items():
+            keep = i_evts < n_evts
+            i_evts, evt_words = i_evts[keep], evt_words[keep]
+            packet_ids = packet_id + i_evts
+            # decode until the table is full, write it out, and repeat
+            while len(evt_words) > 0:
+                n_done = decoder.decode_events(evt_words, tbl, packet_ids, fadcID, channelID)
+                evt_words, packet_ids = evt_words[n_done:], packet_ids[n_done:]
+                if tbl.loc == tbl.size:
+                    lh5_store.write_object(tbl, group_path, raw_filename, n_rows=tbl.loc)
+                    tbl.clear()
+                    decoder.write_out_garbage(raw_filename, decoder.decoder_name, lh5_store)
+        packet_id += n_evts
+        if len(channelIDs) == 0: break # truncated file
 
         if verbose:
             update_len = 0
             if n_max < np.inf and n_max > 0:
-                update_len = 1
+                update_len = n_evts
             else:
                 update_len = f_in.tell() - file_position
                 file_position = f_in.tell()
             update_progress(progress_bar, update_len)
 
     print("done.  last packet ID:", packet_id)
+    bytes_read = f_in.tell()
     f_in.close()
 
     # final write to file
-    for d in decoders:
-        d.save_to_lh5(raw_filename)
-
-    if len(unrecognized_data_ids) > 0:
-        print("WARNING, Found the following unknown data IDs:")
-        for id in unrecognized_data_ids:
-            print("  {}".format(id))
-        print("hopefully they weren't important!\n")
+    if tbl.loc > 0 or not os.path.exists(raw_filename):
+        lh5_store.write_object(tbl, group_path, raw_filename, n_rows=tbl.loc)
+        tbl.clear()
+    decoder.write_out_garbage(raw_filename, decoder.decoder_name, lh5_store)
+    if decoder.n_bad > 0:
+        print("WARNING: put", decoder.n_bad, "events with inconsistent waveform length in",
+              decoder.decoder_name + "/garbage")
 
     # ---------  summary ------------
 
     print("Wrote: Tier 1 File:\n    {}\nFILE INFO:".format(raw_filename))
-    with pd.HDFStore(raw_filename,'r') as store:
-        print(store.keys())
-    #    # print(store.info())
+    print("  {} events, {:.2f} sec".format(decoder.ievt, time.time() - start))
+    return bytes_read
@@ -1,9 +1,73 @@
-import sys
+import sys, copy
 import numpy as np
+import numba as nb
 
 from .orcadaq import OrcaDecoder, get_ccc
+from .orca_packets import copy_segments
 from pygama.lh5 import Table
 
+
+# garbage codes of the Struck decoders (see DataDecoder.put_in_garbage())
+SIS_TOO_SHORT = 1    # packet too short to hold the header and footer
+SIS_BAD_LENGTH = 2   # waveform length doesn't match the packet length
+SIS_BAD_TRAILER = 3  # last word is not 0xdeadbeef
+SIS_BAD_WRAP = 4     # buffer wrap start is outside of the waveform
+
+
+@nb.njit(cache=True)
+def check_sis3302_packets(words, offsets, lengths, codes):
+    """
+    Check the SIS3302 packets at word positions offsets (of their ORCA header
+    word) with lengths lengths in words. Sets codes[i] to the garbage code of
+    packet i, or 0 for good packets. Returns the number of bad packets
+    """
+    n_bad = 0
+    for i in range(len(offsets)):
+        p0 = offsets[i] + 1
+        n_words = np.int64(lengths[i]) - 1
+        code = 0
+        wrap = words[p0] & 0x1 if n_words > 0 else 0
+        header32 = 7 if wrap else 5
+        if n_words < header32 + 4: code = SIS_TOO_SHORT
+        else:
+            wf16 = 2*np.int64(words[p0+1])
+            ene16 = 2*np.int64(words[p0+2])
+            if wf16 != 2*n_words - 2*header32 - 8 - ene16: code = SIS_BAD_LENGTH
+            elif words[p0+n_words-1] != 0xdeadbeef: code = SIS_BAD_TRAILER
+            elif wrap and np.int64(words[p0+6]) + 1 > wf16: code = SIS_BAD_WRAP
+        codes[i] = code
+        if code != 0: n_bad += 1
+    return n_bad
+
+
+@nb.njit(cache=True)
+def unpack_sis3302_waveforms(words, p16, offsets, i_pkts, out, rows):
+    """
+    Unpack the waveforms of (checked) SIS3302 packets i_pkts into rows rows of
+    the 2D array out. With buffer wrap, the waveform in the packet starts
+    somewhere in the middle: it is reordered to start at the trigger. p16 is
+    the uint16 view of the uint32 array words
+    """
+    n_out = out.shape[1]
+    for k in range(len(i_pkts)):
+        p0 = offsets[i_pkts[k]] + 1
+        wrap = words[p0] & 0x1
+        start = 2*p0 + (14 if wrap else 10)
+        stop = start + 2*np.int64(words[p0+1])
+        split = start
+        if wrap: split = min(start + np.int64(words[p0+6]) + 1, stop)
+        row = out[rows[k]]
+        j = 0
+        for m in range(split, stop):
+            if j >= n_out: break
+            row[j] = p16[m]
+            j += 1
+        for m in range(start, split):
+            if j >= n_out: break
+            row[j] = p16[m]
+            j += 1
+
+
 class ORCAStruck3302(OrcaDecoder):
     """
     ORCA decoder for Struck 3302 digitizer data
@@ -54,7 +118,6 @@ class ORCAStruck3302(OrcaDecoder):
 
         self.decoded_values = {}
         self.ievt = 0
-        self.skipped_channels = {}
         # self.enabled_cccs = []
 
 
@@ -115,6 +178,15 @@ class ORCAStruck3302(OrcaDecoder):
         p32 = np.frombuffer(packet, dtype=np.uint32)
         p16 = np.frombuffer(packet, dtype=np.uint16)
 
+        # bad packets go to the garbage. packet starts after the ORCA header
+        # word, i.e. the header word would be at offset -1
+        code = np.zeros(1, dtype='uint32')
+        check_sis3302_packets(p32, np.array([-1]), np.array([len(p32)+1]), code)
+        if code[0] != 0:
+            if verbose: print('ORCAStruck3302: packet', packet_id, 'is garbage, code', code[0])
+            self.put_in_garbage(packet, packet_id, code[0])
+            return
+
         # read the crate/card/channel first
         crate = (p32[0] >> 21) & 0xF
         card = (p32[0] >> 16) & 0x1F
@@ -123,15 +195,10 @@ class ORCAStruck3302(OrcaDecoder):
 
         # aliases for brevity
         tb = lh5_tables
-        # if the first key is an int, then there are different tables for
-        # each channel.
-        if isinstance(list(tb.keys())[0], int):
-            if ccc not in lh5_tables:
-                if ccc not in self.skipped_channels:
-                    self.skipped_channels[ccc] = 0
-                self.skipped_channels[ccc] += 1
-                return
-            tb = lh5_tables[ccc]
+        # if not a single table, there are different tables for each channel
+        if not isinstance(tb, Table):
+            tb = lh5_tables.get_table(ccc)
+            if tb is None: return
         ii = tb.loc
 
         # store packet id
@@ -166,16 +233,6 @@ class ORCAStruck3302(OrcaDecoder):
         expected_wf_length = len(p16) - orca_helper_length16 - sis_header_length16 - \
             footer_length16 - ene_wf_length16
 
-        # error check: waveform size must match expectations
-        if wf_length16 != expected_wf_length or last_word != 0xdeadbeef:
-            print(len(p16), orca_helper_length16, sis_header_length16,
-                  footer_length16)
-            print("ERROR: Waveform size %d doesn't match expected size %d." %
-                  (wf_length16, expected_wf_length))
-            print("       The Last Word (should be 0xdeadbeef):",
-                  hex(last_word))
-            exit()
-
         # indexes of stuff (all referring to the 16 bit array)
         i_wf_start = header_length16
         i_wf_stop = i_wf_start + wf_length16
@@ -193,17 +250,10 @@ class ORCAStruck3302(OrcaDecoder):
         tbwf = tb['waveform']['values'].nda[ii]
         if wf_length32 > 0:
             if not buffer_wrap:
-                if i_wf_stop - i_wf_start != expected_wf_length:
-                    print("ERROR: event %d, we expected %d WF samples and only got %d" %
-                          (ievt, expected_wf_length, i_wf_stope - i_wf_start))
                 tbwf[:expected_wf_length] = p16[i_wf_start:i_wf_stop]
             else:
                 len1 = i_stop_1-i_start_1
                 len2 = i_stop_2-i_start_2
-                if len1+len2 != expected_wf_length:
-                    print("ERROR: event %d, we expected %d WF samples and only got %d" %
-                          (ievt, expected_wf_length, len1+len2))
-                    exit()
                 tbwf[:len1] = p16[i_start_1:i_stop_1]
                 tbwf[len1:len1+len2] = p16[i_start_2:i_stop_2]
 
@@ -214,6 +264,40 @@ class ORCAStruck3302(OrcaDecoder):
         tb.push_row()
 
 
+    def decode_packets(self, words, offsets, lengths, packet_ids, lh5_tables, header_dict, verbose=False):
+        """
+        Decode a batch of packets at once, see OrcaDecoder. Same output as
+        decode_packet(), including putting bad packets in the garbage
+        """
+        # p32[0] of each packet, i.e. the word after the ORCA header
+        p0 = offsets + 1
+        h0 = words[p0]
+        cccs = get_ccc((h0 >> 21) & 0xF, (h0 >> 16) & 0x1F, (h0 >> 8) & 0xFF)
+        codes = np.empty(len(offsets), dtype='uint32')
+        if check_sis3302_packets(words, offsets, lengths, codes) == 0:
+            n_done, plan, ievt = self.plan_batch(cccs, lh5_tables)
+        else:
+            n_done, plan, ievt, good = self.plan_batch_garbage(cccs, codes, words, offsets,
+                                                               lengths, packet_ids, lh5_tables)
+            p0, h0, offsets, lengths, packet_ids = p0[good], h0[good], offsets[good], lengths[good], packet_ids[good]
+        if n_done == 0: return 0
+
+        p16 = words.view(np.uint16)
+        for tb, i, rows in plan:
+            q0, ends = p0[i], offsets[i] + lengths[i]
+            tb['packet_id'].nda[rows] = packet_ids[i]
+            tb['crate'].nda[rows] = (h0[i] >> 21) & 0xF
+            tb['card'].nda[rows] = (h0[i] >> 16) & 0x1F
+            tb['channel'].nda[rows] = (h0[i] >> 8) & 0xFF
+            tb['timestamp'].nda[rows] = words[q0+4] + ((words[q0+3].astype('uint64') & 0xFFFF0000) << 16)
+            tb['energy'].nda[rows] = words[ends-4]
+            tb['energy_first'].nda[rows] = words[ends-3]
+            unpack_sis3302_waveforms(words, p16, offsets, i, tb['waveform']['values'].nda, rows)
+            tb['ievt'].nda[rows] = ievt[i]
+            tb.loc += len(rows)
+        return n_done
+
+
 class ORCAGretina4M(OrcaDecoder):
     """
     Decoder for Majorana Gretina4M digitizer data
@@ -266,7 +350,6 @@ class ORCAGretina4M(OrcaDecoder):
         super().__init__(*args, **kwargs)
         self.decoded_values = {}
         self.ievt = 0
-        self.skipped_channels = {}
         self.use_MS = False
         self.wf_skip = 16 # the first ~dozen samples are sometimes junk
         # channel pars for multisampling mode
@@ -341,6 +424,64 @@ class ORCAGretina4M(OrcaDecoder):
         return False
 
 
+    def unpack_multisampled(self, wf, ccc, wf_out):
+        """
+        Unpack a multisampled waveform wf (int16, 2018 samples) of channel ccc
+        into one long fully-sampled waveform wf_out. Returns False on error
+        """
+        wf_len = 2018
+        # get ccc pars
+        ps = self.ps[ccc]
+        div = self.div[ccc]
+        ratio = div / ps
+
+        # find start of presummed section
+        # because it's not always self.ft_len :(
+        ift = wf_len - self.ft_len[ccc] - 2
+        min_diff = np.inf
+        min_diff_ift = ift
+        for i in range(self.wf_skip+1):
+            d1 = abs(wf[ift+i]*ratio - wf[ift+i-1])
+            if d1 < min_diff:
+                min_diff = d1
+                min_diff_ift = ift+i
+        ift = min_diff_ift
+        ift_out = ift - self.wf_skip
+
+        # copy over fully-sampled portion
+        wf_out[:ift_out] = wf[self.wf_skip:ift]
+
+        # compute slopes for interpolation
+        # rise[i-1] is the slope prior to sample i, while rise[i] is the
+        # slope following it
+        if len(self.rises) != len(wf): self.rises.resize(len(wf)-1)
+        self.rises[:] = wf[1:] - wf[:-1]
+        # correct the value right before ift
+        self.rises[ift-1] = wf[ift] - np.sum(wf[ift-ps:ift]) / div
+
+        # store double-precision values in self.remainders (later it will be
+        # used to compute remainders and do round-off
+        # Note: the interpolation done here is meant to preserve the
+        # presumming: re-presumming should reproduce the original waveform
+        rem_len = len(self.remainders) - ift_out
+        for ips in range(ps):
+            nn = int(np.floor( (rem_len - ips - 1) / ps ) + 1)
+            self.remainders[ift_out+ips::ps] = wf[ift:ift+nn]
+            self.remainders[ift_out+ips::ps] -= (2*ips+1)/(2*ps)*self.rises[ift-1:ift+nn-1]
+            self.remainders[ift_out+ips::ps] *= ratio
+
+        # now set the output based on rounding cumulative remainders
+        if len(self.remainders) != len(wf_out):
+            print("Error: remainders len", len(self.remainders), "but wf_out len", len(wf_out))
+            return False
+        for ips in range(ps):
+            np.rint(self.remainders[ift_out+ips::ps], out=wf_out[ift_out+ips::ps], casting='unsafe')
+            if ips == ps-1: break;
+            self.remainders[ift_out+ips::ps] -= wf_out[ift_out+ips::ps]
+            self.remainders[ift_out+ips+1::ps] += self.remainders[ift_out+ips:-1:ps]
+        return True
+
+
     def decode_packet(self, packet, lh5_tables, packet_id, header_dict, verbose=False):
         """
         Parse the header for an individual event
@@ -356,12 +497,8 @@ class ORCAGretina4M(OrcaDecoder):
         # aliases for brevity
         tb = lh5_tables
         if not isinstance(tb, Table):
-            if ccc not in lh5_tables:
-                if ccc not in self.skipped_channels:
-                    self.skipped_channels[ccc] = 0
-                self.skipped_channels[ccc] += 1
-                return
-            tb = lh5_tables[ccc]
+            tb = lh5_tables.get_table(ccc)
+            if tb is None: return
         ii = tb.loc
 
         tb['packet_id'].nda[ii] = packet_id
@@ -376,60 +513,9 @@ class ORCAGretina4M(OrcaDecoder):
         # wf starts from p16[18] and is always 2018 samples
         # we will chop off the start (~a dozen) and end (last 2), but not until
         # after we have handled multisampling
-        wf = p16[18:]
-        wf_len = 2018
         if self.is_multisampled(ccc):
-            # get ccc pars
-            ps = self.ps[ccc]
-            div = self.div[ccc]
-            ratio = div / ps
-
-            # find start of presummed section
-            # because it's not always self.ft_len :(
-            ift = wf_len - self.ft_len[ccc] - 2
-            min_diff = np.inf
-            min_diff_ift = ift
-            for i in range(self.wf_skip+1):
-                d1 = abs(wf[ift+i]*ratio - wf[ift+i-1])
-                if d1 < min_diff:
-                    min_diff = d1
-                    min_diff_ift = ift+i
-            ift = min_diff_ift
-            ift_out = ift - self.wf_skip
-
-            # copy over fully-sampled portion
-            tb['waveform']['values'].nda[ii][:ift_out] = wf[self.wf_skip:ift]
-
-            # compute slopes for interpolation
-            # rise[i-1] is the slope prior to sample i, while rise[i] is the
-            # slope following it
-            if len(self.rises) != len(wf): self.rises.resize(len(wf)-1)
-            self.rises[:] = wf[1:] - wf[:-1]
-            # correct the value right before ift
-            self.rises[ift-1] = wf[ift] - np.sum(wf[ift-ps:ift]) / div
-
-            # store double-precision values in self.remainders (later it will be
-            # used to compute remainders and do round-off
-            # Note: the interpolation done here is meant to preserve the
-            # presumming: re-presumming should reproduce the original waveform
-            rem_len = len(self.remainders) - ift_out
-            for ips in range(ps):
-                nn = int(np.floor( (rem_len - ips - 1) / ps ) + 1)
-                self.remainders[ift_out+ips::ps] = wf[ift:ift+nn]
-                self.remainders[ift_out+ips::ps] -= (2*ips+1)/(2*ps)*self.rises[ift-1:ift+nn-1]
-                self.remainders[ift_out+ips::ps] *= ratio
-
-            # now set the output based on rounding cumulative remainders
-            wf_out = tb['waveform']['values'].nda[ii]
-            if len(self.remainders) != len(wf_out):
-                print("Error: remainders len", len(self.remainders), "but wf_out len", len(wf_out))
+            if not self.unpack_multisampled(p16[18:], ccc, tb['waveform']['values'].nda[ii]):
                 return
-            for ips in range(ps):
-                np.rint(self.remainders[ift_out+ips::ps], out=wf_out[ift_out+ips::ps], casting='unsafe')
-                if ips == ps-1: break;
-                self.remainders[ift_out+ips::ps] -= wf_out[ift_out+ips::ps]
-                self.remainders[ift_out+ips+1::ps] += self.remainders[ift_out+ips:-1:ps]
-
         else:
             length = 2016 - self.wf_skip
             start = 16+self.wf_skip
@@ -441,6 +527,57 @@ class ORCAGretina4M(OrcaDecoder):
         self.ievt += 1
 
 
+    def decode_packets(self, words, offsets, lengths, packet_ids, lh5_tables, header_dict, verbose=False):
+        """
+        Decode a batch of packets at once, see OrcaDecoder. Same output as
+        decode_packet(), except that rows whose multisampled waveform could
+        not be unpacked are kept
+        """
+        # pu16[0] of each packet, i.e. the word after the ORCA header, in the
+        # 16-bit view of words
+        pu16 = words.view(np.uint16)
+        i0 = 2*(offsets + 1)
+        w1 = pu16[i0+1].astype('uint32')
+        w4 = pu16[i0+4].astype('uint32')
+        crate = (w1 >> 5) & 0xF
+        card = w1 & 0x1F
+        channel = w4 & 0xf
+        cccs = get_ccc(crate, card, channel)
+        n_done, plan, ievt = self.plan_batch(cccs, lh5_tables)
+        if n_done == 0: return 0
+        i0 = i0[:n_done]
+        ends16 = 2*(offsets[:n_done] + lengths[:n_done])
+
+        energy = pu16[i0+9] + ((pu16[i0+10].astype('uint32') & 0x1FF) << 16)
+        timestamp = pu16[i0+6] + (pu16[i0+7].astype('uint64') << 16) + \
+            (pu16[i0+8].astype('uint64') << 32)
+        board_id = (w4 & 0xFFF0) >> 4
+        uniq_cccs, inv = np.unique(cccs[:n_done], return_inverse=True)
+        is_ms = np.array([self.ft_len.get(ccc, 0) > 0 for ccc in uniq_cccs.tolist()], dtype=bool)[inv]
+
+        # fully-sampled waveforms are a fixed slice of the packet
+        length = 2016 - self.wf_skip
+        i_start = i0 + 16 + self.wf_skip
+        i_stop = np.minimum(i_start + length, ends16)
+        i_stop = np.where(is_ms, i_start, i_stop)
+        p16 = words.view(np.int16)
+        for tb, i, rows in plan:
+            tb['packet_id'].nda[rows] = packet_ids[i]
+            tb['ievt'].nda[rows] = ievt[i]
+            tb['energy'].nda[rows] = energy[i]
+            tb['timestamp'].nda[rows] = timestamp[i]
+            tb['crate'].nda[rows] = crate[i]
+            tb['card'].nda[rows] = card[i]
+            tb['channel'].nda[rows] = channel[i]
+            tb['board_id'].nda[rows] = board_id[i]
+            wf_nda = tb['waveform']['values'].nda
+            copy_segments(p16, i_start[i], i_stop[i], i_start[i], i_start[i], wf_nda, rows)
+            for j, row in zip(i[is_ms[i]].tolist(), rows[is_ms[i]].tolist()):
+                self.unpack_multisampled(p16[i0[j]+18:ends16[j]], cccs[j], wf_nda[row])
+            tb.loc += len(rows)
+        return n_done
+
+
 class SIS3316ORCADecoder(OrcaDecoder):
     """
     Decode ORCA Struck 3316 digitizer data.
@@ -496,7 +633,6 @@ class SIS3316ORCADecoder(OrcaDecoder):
 
         # self.event_header_length = 1 #?
         self.decoded_values = {}
-        self.skipped_channels = {}
         self.ievt = 0
 
 
@@ -543,11 +679,13 @@ class SIS3316ORCADecoder(OrcaDecoder):
     def decode_packet(self, packet, lh5_tables, packet_id, header_dict, verbose=False):
 
         # parse the raw event data into numpy arrays of 16 and 32 bit ints
-        evt_data_32 = np.fromstring(packet, dtype=np.uint32)
-        evt_data_16 = np.fromstring(packet, dtype=np.uint16)
-
-        # tb = lh5_tables
+        evt_data_32 = np.frombuffer(packet, dtype=np.uint32)
+        evt_data_16 = np.frombuffer(packet, dtype=np.uint16)
 
+        # bad packets go to the garbage
+        if len(evt_data_32) < 26:
+            self.put_in_garbage(packet, packet_id, SIS_TOO_SHORT)
+            return
 
         # read the crate/card/channel first
         crate = (evt_data_32[0] >> 21) & 0xF
@@ -556,15 +694,18 @@ class SIS3316ORCADecoder(OrcaDecoder):
         ccc = get_ccc(crate, card, channel)
 
 
-        if isinstance(list(lh5_tables.keys())[0], int):
-            if ccc not in lh5_tables:
-                print('ccc not in lh5_tables')
-                if ccc not in self.skipped_channels:
-                    self.skipped_channels[ccc] = 0
-                self.skipped_channels[ccc] += 1
-                return
-            tb = lh5_tables[ccc]
+        tb = lh5_tables
+        if not isinstance(tb, Table):
+            tb = lh5_tables.get_table(ccc)
+            if tb is None: return
         ii = tb.loc
+        tbwf = tb['waveform']['values'].nda[ii]
+        wf_length16 = len(evt_data_16) - 52
+        if wf_length16 > 0 and wf_length16 != len(tbwf):
+            if verbose: print('SIS3316ORCADecoder: packet', packet_id, 'has', wf_length16,
+                              'samples, expected', len(tbwf))
+            self.put_in_garbage(packet, packet_id, SIS_BAD_LENGTH)
+            return
 
         tb['packet_id'].nda[ii] = packet_id
 
@@ -574,21 +715,13 @@ class SIS3316ORCADecoder(OrcaDecoder):
         n_lost_records = 0
         tb['crate'].nda[ii] = evt_data_32[3]
         tb['card'].nda[ii] = evt_data_32[4]
-        try:
-            tb['channel'].nda[ii] = (evt_data_32[9] & 0xFFF0) >> 4
-        except:
-            print('Something went wrong')
-            tb['channel'].nda[ii] = 33
+        tb['channel'].nda[ii] = (evt_data_32[9] & 0xFFF0) >> 4
         buffer_wrap = 0
         crate_card_chan = crate + card + channel
         wf_length_32 = 0
         ene_wf_length = evt_data_32[4]
         evt_header_id = 0
-        try:
-            tb['timestamp'].nda[ii] = evt_data_32[10] + ((evt_data_32[9] & 0xffff0000) << 16)
-        except:
-            print('something went wrong here too')
-            tb['timestamp'].nda[ii] = 0
+        tb['timestamp'].nda[ii] = evt_data_32[10] + ((evt_data_32[9] & 0xffff0000) << 16)
 
         # compute expected and actual array dimensions
         # wf_length16 = 65000 # OK this stuff is just random <--
@@ -617,19 +750,10 @@ class SIS3316ORCADecoder(OrcaDecoder):
         i_ene_start = i_wf_stop + 1
         i_ene_stop = i_ene_start + ene_wf_length16
 
-        tbwf = tb['waveform']['values'].nda[ii]
         # handle the waveform(s)
         # if wf_length16 > 0:
         if expected_wf_length > 0:
-            # print('len(tb[waveform][values].nda[ii]) ', len(tb['waveform']['values'].nda[ii]))
-            # print(len(evt_data_16[i_wf_start:i_wf_stop]))
-            try:
-                tb['waveform']['values'].nda[ii] = evt_data_16[i_wf_start:i_wf_stop]
-            except:
-                print('hmm.. packet id: ', packet_id)
-                print('  got: ',len(evt_data_16[i_wf_start:i_wf_stop]))
-                #print(evt_data_32[i_wf_start:i_wf_stop])
-                print('  expected: ',len(tb['waveform']['values'].nda[ii]))
+            tbwf[:] = evt_data_16[i_wf_start:i_wf_stop]
 
         # TODO check if number of events matches expected
         # if len(wf_data) != expected_wf_length:
@@ -645,6 +769,61 @@ class SIS3316ORCADecoder(OrcaDecoder):
         tb.push_row()
 
 
+    def decode_packets(self, words, offsets, lengths, packet_ids, lh5_tables, header_dict, verbose=False):
+        """
+        Decode a batch of packets at once, see OrcaDecoder. Same output as
+        decode_packet(), including putting bad packets in the garbage
+        """
+        # p32[0] of each packet, i.e. the word after the ORCA header
+        p0 = offsets + 1
+        h0 = words[p0]
+        cccs = get_ccc((h0 >> 21) & 0xF, (h0 >> 16) & 0x1F, (h0 >> 8) & 0xFF)
+
+        # bad packets go to the garbage: too short for the header, or with
+        # the wrong waveform length for their table
+        wf_length16 = 2*(lengths.astype('int64') - 1) - 52
+        if isinstance(lh5_tables, Table):
+            expected_wf_length = lh5_tables['waveform']['values'].nda.shape[1]
+        else:
+            # channels without a table (slot -1) get length 0: not checked
+            widths = [tb['waveform']['values'].nda.shape[1] for tb in lh5_tables.tables]
+            expected_wf_length = np.array(widths + [0])[lh5_tables.get_slots(cccs)]
+        codes = np.where(wf_length16 < 0, SIS_TOO_SHORT, 0)
+        codes[(wf_length16 > 0) & (expected_wf_length > 0) &
+              (wf_length16 != expected_wf_length)] = SIS_BAD_LENGTH
+        if not np.any(codes):
+            n_done, plan, ievt = self.plan_batch(cccs, lh5_tables)
+        else:
+            n_done, plan, ievt, good = self.plan_batch_garbage(cccs, codes, words, offsets,
+                                                               lengths, packet_ids, lh5_tables)
+            p0, offsets, lengths, packet_ids = p0[good], offsets[good], lengths[good], packet_ids[good]
+        if n_done == 0: return 0
+        ends = offsets + lengths
+
+        crate = words[p0+3]
+        card = words[p0+4]
+        w9 = words[p0+9]
+        channel = (w9 & 0xFFF0) >> 4
+        timestamp = words[p0+10] + ((w9.astype('uint64') & 0xffff0000) << 16)
+
+        # the waveform is everything after the 52-word (16-bit) header
+        orca_helper_length16 = 52
+        i_wf_start = 2*p0 + orca_helper_length16
+        i_wf_stop = np.maximum(2*ends, i_wf_start)
+        p16 = words.view(np.uint16)
+        for tb, i, rows in plan:
+            tb['packet_id'].nda[rows] = packet_ids[i]
+            tb['crate'].nda[rows] = crate[i]
+            tb['card'].nda[rows] = card[i]
+            tb['channel'].nda[rows] = channel[i]
+            tb['timestamp'].nda[rows] = timestamp[i]
+            copy_segments(p16, i_wf_start[i], i_wf_stop[i], i_wf_start[i], i_wf_start[i],
+                          tb['waveform']['values'].nda, rows)
+            tb['ievt'].nda[rows] = ievt[i]
+            tb.loc += len(rows)
+        return n_done
+
+
         
 #This is a test decoder for the AMI286 Level sensor
 class ORAMI286LEVELDECODER(OrcaDecoder):
@@ -672,7 +851,6 @@ class ORAMI286LEVELDECODER(OrcaDecoder):
         }
         super().__init__(*args, **kwargs)  # also initializes the garbage df (whatever that means...)
 
-        self.skipped_channels = {}
         self.ievt = 0
 
     def get_decoded_values(self, channel=None):
@@ -688,8 +866,8 @@ class ORAMI286LEVELDECODER(OrcaDecoder):
     def decode_packet(self, packet, lh5_tables, packet_id, header_dict, verbose=False):
 
         # parse the raw event data into numpy arrays of 16 and 32 bit ints
-        evt_data_32 = np.fromstring(packet, dtype=np.uint32)
-        evt_data_16 = np.fromstring(packet, dtype=np.uint16)
+        evt_data_32 = np.frombuffer(packet, dtype=np.uint32)
+        evt_data_16 = np.frombuffer(packet, dtype=np.uint16)
 
         tb = lh5_tables
 
@@ -1,5 +1,7 @@
 import numpy as np
 
+from pygama import lh5
+
 from .orcadaq import OrcaDecoder, get_ccc, get_readout_info, get_auxhw_info
 from .fcdaq import FlashCamEventDecoder
 
@@ -311,7 +313,6 @@ class ORCAFlashCamADCWaveformDecoder(OrcaDecoder):
         
         super().__init__(*args, **kwargs)
         self.decoded_values = {}
-        self.skipped_channels = {}
 
     def get_decoded_values(self, channel=None):
         if channel is None:
@@ -386,13 +387,9 @@ class ORCAFlashCamADCWaveformDecoder(OrcaDecoder):
 
         # get the table for this crate/card/channel
         tbl = lh5_tables
-        if isinstance(list(tbl.keys())[0], int):
-            if ccc not in lh5_tables:
-                if ccc not in self.skipped_channels:
-                    self.skipped_channels[ccc] = 0
-                self.skipped_channels[ccc] += 1
-                return
-            tbl = lh5_tables[ccc]
+        if not isinstance(tbl, lh5.Table):
+            tbl = lh5_tables.get_table(ccc)
+            if tbl is None: return
         ii = tbl.loc
 
         # check that the waveform length is as expected
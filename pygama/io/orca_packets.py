@@ -0,0 +1,503 @@
+import os, mmap, time, socket
+import numpy as np
+import numba as nb
+
+from .gzip_index import open_gzip
+
+
+@nb.njit(cache=True)
+def index_packets(words, pos, offsets, lengths, data_ids):
+    """
+    Walk the ORCA packet headers in words starting at word pos and fill the
+    packet index arrays. The low 18 bits of a packet's first word hold the
+    record length in longs (including the header word), the upper 14 bits
+    hold the data ID.
+
+    Stops when the index arrays are full, at the first packet that extends
+    past the end of words (so that the caller can read more data), or at a
+    corrupt packet with record length 0.
+
+    Returns
+    -------
+    (n_packets, pos) : tuple of ints
+        Number of packets indexed and the word position of the next
+        (unindexed) packet
+    """
+    n_words = len(words)
+    n_max = len(offsets)
+    n = 0
+    while n < n_max and pos < n_words:
+        head = words[pos]
+        length = head & 0x3FFFF
+        if length == 0 or pos + length > n_words: break
+        offsets[n] = pos
+        lengths[n] = length
+        data_ids[n] = head >> 18
+        n += 1
+        pos += length
+    return n, pos
+
+
+@nb.njit(cache=True)
+def copy_segments(data, start1, stop1, start2, stop2, out, rows):
+    """
+    For each i, copy data[start1[i]:stop1[i]] followed by
+    data[start2[i]:stop2[i]] into row rows[i] of the 2D array out, e.g. to
+    unpack (wrapped) waveforms from a batch of packets. Segments are cut at
+    the length of out's rows.
+    """
+    n_out = out.shape[1]
+    for i in range(len(rows)):
+        row = out[rows[i]]
+        j = 0
+        for k in range(start1[i], stop1[i]):
+            if j >= n_out: break
+            row[j] = data[k]
+            j += 1
+        for k in range(start2[i], stop2[i]):
+            if j >= n_out: break
+            row[j] = data[k]
+            j += 1
+
+
+class OrcaPacketReader:
+    """
+    Iterates over the data packets of an ORCA file with little per-packet
+    overhead
+
+    Uncompressed files are memory-mapped, gzipped files are decompressed in
+    blocks of block_size bytes, with random access through a gzip index (see
+    gzip_index.py) so that reading can start anywhere in the file. The packet
+    boundaries are found a chunk of packets at a time by index_packets() and
+    packets are returned as zero-copy memoryviews into the mapped file /
+    decompressed block, which decoders can interpret with np.frombuffer(). A
+    packet view stays valid as long as it is referenced.
+
+    Example
+    -------
+    with OrcaPacketReader(orca_filename, start_byte=reclen*4) as reader:
+        for packet, data_id in reader:
+            decoders[data_id].decode_packet(packet, ...)
+    """
+
+    def __init__(self, orca_filename, start_byte=0, stop_byte=None, block_size=2**24, chunk_len=2**16):
+        """
+        Parameters
+        ----------
+        orca_filename : str
+            The ORCA file. Files ending in .gz are read with open_gzip(),
+            which builds and saves an index the first time a file is read
+        start_byte : int (optional)
+            Byte position of the first packet, e.g. reclen*4 from
+            parse_header() to skip the header. Must be a multiple of 4
+        stop_byte : int (optional)
+            Stop reading at this byte position, which should be a packet
+            boundary. By default, read to the end of the file
+        block_size : int (optional)
+            Number of (decompressed) bytes read at a time from gzipped files.
+            Blocks are extended as needed to hold larger packets
+        chunk_len : int (optional)
+            Number of packets indexed at a time
+        """
+        self.filename = orca_filename
+        self.start_byte = start_byte
+        self.stop_byte = stop_byte
+        self.block_size = block_size
+        self.chunk_len = chunk_len
+        self.is_gz = orca_filename.endswith('.gz')
+        self.f_in = None
+        self.mm = None
+        self.n_read = start_byte
+        self.block_start = start_byte
+        self._file_size = None
+        self.corrupt = False
+
+        if self.is_gz:
+            self.f_in = open_gzip(orca_filename)
+            if hasattr(self.f_in, 'size'): self._file_size = self.f_in.size
+        else:
+            self.f_in = open(orca_filename, 'rb')
+            self._file_size = os.fstat(self.f_in.fileno()).st_size
+            if self._file_size > 0:
+                self.mm = mmap.mmap(self.f_in.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    @property
+    def file_size(self):
+        """Size of the (decompressed) file in bytes. For gzipped files read
+        without an index, the whole file has to be decompressed to find out"""
+        if self._file_size is None:
+            with open_gzip(self.filename) as f:
+                self._file_size = f.seek(0, os.SEEK_END)
+        return self._file_size
+
+
+    def tell(self):
+        """Byte position of the next packet not yet returned (by iter_chunks(),
+        the end of the current chunk)"""
+        return self.n_read
+
+
+    def iter_chunks(self):
+        """
+        Generator over chunks of the packet index
+
+        Yields
+        ------
+        (words, offsets, lengths, data_ids) : tuple of arrays
+            words is a uint32 view of the data, offsets and lengths give the
+            word position and length (including the header word) of each
+            packet in words, data_ids their data IDs. The index arrays are
+            reused for the next chunk. words[0] is at byte position
+            self.block_start in the file
+        """
+        offsets = np.empty(self.chunk_len, dtype='int64')
+        lengths = np.empty(self.chunk_len, dtype='uint32')
+        data_ids = np.empty(self.chunk_len, dtype='uint32')
+        if self.is_gz: self.f_in.seek(self.start_byte)
+        base = self.start_byte
+        leftover = b''
+        block_size = self.block_size
+        while True:
+            # get the next block of data, starting on a packet boundary
+            if self.is_gz:
+                read_len = block_size
+                if self.stop_byte is not None:
+                    read_len = min(read_len, self.stop_byte - base - len(leftover))
+                data = self.f_in.read(read_len) if read_len > 0 else b''
+                if len(data) == 0: break
+                block = leftover + data
+                words = np.frombuffer(block, dtype=np.uint32, count=len(block)//4)
+            else:
+                end = len(self.mm) if self.mm is not None else 0
+                if self.stop_byte is not None: end = min(end, self.stop_byte)
+                if base >= end: break
+                words = np.frombuffer(self.mm, dtype=np.uint32, offset=base, count=(end-base)//4)
+            self.block_start = base
+
+            pos = 0
+            while True:
+                n, new_pos = index_packets(words, pos, offsets, lengths, data_ids)
+                if n == 0: break
+                self.n_read = base + new_pos*4
+                yield words, offsets[:n], lengths[:n], data_ids[:n]
+                pos = new_pos
+
+            if pos < len(words) and words[pos] & 0x3FFFF == 0:
+                print('OrcaPacketReader: found packet with length 0 at byte',
+                      self.n_read, 'of', self.filename, '... stopping')
+                self.corrupt = True
+                return
+            if not self.is_gz:
+                leftover = self.mm[self.n_read:end]
+                break
+            # carry over the partial packet at the end of the block. If not
+            # even one packet fit, it's a large one: read more at once
+            leftover = block[pos*4:]
+            block_size = self.block_size if pos > 0 else 2*block_size
+            base = self.n_read
+        if len(leftover) > 0:
+            print('OrcaPacketReader: ignoring', len(leftover),
+                  'bytes of incomplete packet at the end of', self.filename)
+
+
+    def __iter__(self):
+        """Generator over (packet, data_id)
+
+        packet is a memoryview of the packet data without the header word,
+        like the event_data returned by get_next_packet()
+        """
+        for words, offsets, lengths, data_ids in self.iter_chunks():
+            mv = memoryview(words).cast('B')
+            base = self.block_start
+            for offset, length, data_id in zip(offsets.tolist(), lengths.tolist(), data_ids.tolist()):
+                end = offset + length
+                self.n_read = base + end*4
+                yield mv[(offset+1)*4:end*4], data_id
+
+
+    def close(self):
+        if self.mm is not None:
+            # views handed out by __iter__ may still be alive: then the map is
+            # closed when they are garbage collected
+            try: self.mm.close()
+            except BufferError: pass
+            self.mm = None
+        if self.f_in is not None:
+            self.f_in.close()
+            self.f_in = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def is_stream_address(source):
+    """True if source is a socket address for OrcaStreamReader, i.e.
+    'tcp://host:port' or 'unix:///path/to/socket'"""
+    return source.startswith('tcp://') or source.startswith('unix://')
+
+
+def open_socket(address, timeout):
+    """Connect to a 'tcp://host:port' or 'unix:///path' address. Retries for
+    up to timeout seconds, e.g. while the sender is starting up"""
+    t_start = time.monotonic()
+    while True:
+        if address.startswith('unix://'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            target = address[len('unix://'):]
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            host, port = address[len('tcp://'):].rsplit(':', 1)
+            target = (host, int(port))
+        try:
+            sock.connect(target)
+            return sock
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            if time.monotonic() - t_start > timeout: raise
+            time.sleep(0.1)
+
+
+class OrcaStreamReader(OrcaPacketReader):
+    """
+    Iterates over the data packets of an ORCA file that is still being
+    written, or of an ORCA data stream read from a socket
+
+    Same interface as OrcaPacketReader, but data are read as they arrive, up
+    to block_size bytes at a time. When no new data arrive for poll_interval
+    seconds, iter_chunks() yields an empty chunk, so that the caller can e.g.
+    write out what it has decoded so far. The stream ends when the sender
+    closes the socket, at stop_byte, or when no new data have arrived for
+    idle_timeout seconds (for files, there is no other way to tell that the
+    DAQ is done writing).
+
+    Unlike with OrcaPacketReader, the header is read from the stream too,
+    with read() before iterating:
+
+    Example
+    -------
+    with OrcaStreamReader('tcp://localhost:44667') as reader:
+        reclen, header_nbytes, header_dict = read_header(reader)
+        reader.read(reclen*4 - reader.tell())
+        for packet, data_id in reader:
+            ...
+    """
+
+    def __init__(self, source, start_byte=0, stop_byte=None, block_size=2**20, chunk_len=2**16,
+                 poll_interval=0.5, idle_timeout=10):
+        """
+        Parameters
+        ----------
+        source : str
+            The (growing) ORCA file, or a socket address 'tcp://host:port' or
+            'unix:///path/to/socket' to connect to. Gzipped files can't be
+            followed
+        start_byte : int (optional)
+            Skip this many bytes of a file before reading
+        stop_byte : int (optional)
+            Stop reading at this byte position
+        block_size : int (optional)
+            Maximum number of bytes read at a time
+        chunk_len : int (optional)
+            Number of packets indexed at a time
+        poll_interval : float (optional)
+            Seconds to wait for new data before yielding an empty chunk
+        idle_timeout : float (optional)
+            End the stream after this many seconds without new data
+        """
+        self.filename = source
+        self.start_byte = start_byte
+        self.stop_byte = stop_byte
+        self.block_size = block_size
+        self.chunk_len = chunk_len
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.is_gz = False
+        self.mm = None
+        self.f_in = None
+        self.sock = None
+        self.n_read = start_byte
+        self.n_recv = start_byte
+        self.block_start = start_byte
+        self.corrupt = False
+        self.t_last_data = time.monotonic()
+
+        if is_stream_address(source):
+            if start_byte != 0: print('OrcaStreamReader: ignoring start_byte for socket', source)
+            self.n_read = self.n_recv = self.block_start = 0
+            self.sock = open_socket(source, idle_timeout)
+            self.sock.settimeout(min(0.05, poll_interval))
+        else:
+            if source.endswith('.gz'): print('OrcaStreamReader: cannot follow gzipped file', source)
+            self.f_in = open(source, 'rb', buffering=0)
+            self.f_in.seek(start_byte)
+
+
+    @property
+    def file_size(self):
+        """Number of bytes of the stream received so far (for files, the
+        current file size)"""
+        if self.f_in is not None: return os.fstat(self.f_in.fileno()).st_size
+        return self.n_recv
+
+
+    def _recv(self, n_bytes):
+        """Get up to n_bytes of whatever data are available, None at the end
+        of the stream"""
+        if self.stop_byte is not None:
+            n_bytes = min(n_bytes, self.stop_byte - self.n_recv)
+            if n_bytes <= 0: return None
+        if self.sock is None: return self.f_in.read(n_bytes)
+        try: data = self.sock.recv(n_bytes)
+        except socket.timeout: return b''
+        return data if len(data) > 0 else None
+
+
+    def read_some(self, n_bytes):
+        """
+        Read up to n_bytes. Waits up to poll_interval seconds for data to
+        arrive, then returns what there is, possibly b''. Returns None at the
+        end of the stream
+        """
+        t_start = time.monotonic()
+        while True:
+            data = self._recv(n_bytes)
+            if data is None: return None
+            now = time.monotonic()
+            if len(data) > 0:
+                self.t_last_data = now
+                self.n_recv += len(data)
+                return data
+            if now - self.t_last_data > self.idle_timeout: return None
+            if now - t_start >= self.poll_interval: return b''
+            # sockets wait in recv(), files have to be polled
+            if self.sock is None: time.sleep(min(0.05, self.poll_interval))
+
+
+    def read(self, n_bytes):
+        """Read exactly n_bytes (fewer at the end of the stream), e.g. the
+        header. Must not be called while iterating over packets"""
+        data = b''
+        while len(data) < n_bytes:
+            block = self.read_some(n_bytes - len(data))
+            if block is None: break
+            data += block
+        self.n_read += len(data)
+        self.block_start = self.n_read
+        return data
+
+
+    def iter_chunks(self):
+        """
+        Generator over chunks of the packet index, see
+        OrcaPacketReader.iter_chunks(). Yields empty chunks while waiting
+        for data
+        """
+        offsets = np.empty(self.chunk_len, dtype='int64')
+        lengths = np.empty(self.chunk_len, dtype='uint32')
+        data_ids = np.empty(self.chunk_len, dtype='uint32')
+        no_words = np.empty(0, dtype=np.uint32)
+        leftover = b''
+        while True:
+            data = self.read_some(self.block_size)
+            if data is None: break
+            if len(data) == 0:
+                self.block_start = self.n_read
+                yield no_words, offsets[:0], lengths[:0], data_ids[:0]
+                continue
+            block = leftover + data
+            base = self.block_start = self.n_read
+            words = np.frombuffer(block, dtype=np.uint32, count=len(block)//4)
+
+            pos = 0
+            while True:
+                n, new_pos = index_packets(words, pos, offsets, lengths, data_ids)
+                if n == 0: break
+                self.n_read = base + new_pos*4
+                yield words, offsets[:n], lengths[:n], data_ids[:n]
+                pos = new_pos
+
+            if pos < len(words) and words[pos] & 0x3FFFF == 0:
+                print('OrcaStreamReader: found packet with length 0 at byte',
+                      self.n_read, 'of', self.filename, '... stopping')
+                self.corrupt = True
+                return
+            leftover = block[pos*4:]
+        if len(leftover) > 0:
+            print('OrcaStreamReader: ignoring', len(leftover),
+                  'bytes of incomplete packet at the end of', self.filename)
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.f_in is not None:
+            self.f_in.close()
+            self.f_in = None
+
+
+def replay_orca(daq_filename, destination, block_size=2**16, interval=0.01, timeout=10):
+    """
+    Replay an ORCA file as if it was being taken, for testing streaming
+    decoding (see OrcaStreamReader)
+
+    Parameters
+    ----------
+    daq_filename : str
+        The ORCA file to replay
+    destination : str
+        A file name, to which the data are appended a block at a time, or a
+        socket address 'tcp://host:port' or 'unix:///path/to/socket' on which
+        to wait for one client and send it the data
+    block_size : int (optional)
+        Number of bytes written at a time. Blocks are not aligned to packets
+    interval : float (optional)
+        Seconds to wait between blocks
+    timeout : float (optional)
+        Seconds to wait for a client to connect
+
+    Returns
+    -------
+    n_bytes : int
+        Number of bytes replayed
+    """
+    server = conn = f_out = None
+    if is_stream_address(destination):
+        if destination.startswith('unix://'):
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            path = destination[len('unix://'):]
+            if os.path.exists(path): os.remove(path)
+            server.bind(path)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            host, port = destination[len('tcp://'):].rsplit(':', 1)
+            server.bind((host, int(port)))
+        server.settimeout(timeout)
+        server.listen(1)
+        conn, _ = server.accept()
+    else: f_out = open(destination, 'wb')
+
+    n_bytes = 0
+    try:
+        with open(daq_filename, 'rb') as f_in:
+            while True:
+                data = f_in.read(block_size)
+                if len(data) == 0: break
+                if conn is not None: conn.sendall(data)
+                else:
+                    f_out.write(data)
+                    f_out.flush()
+                n_bytes += len(data)
+                if interval > 0: time.sleep(interval)
+    finally:
+        if conn is not None: conn.close()
+        if server is not None: server.close()
+        if f_out is not None: f_out.close()
+    return n_bytes
@@ -1,5 +1,6 @@
-import sys, gzip
+import os, sys, gzip, copy, time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import plistlib
 
 from tqdm.std import tqdm
@@ -34,6 +35,101 @@ class OrcaDecoder(DataDecoder):
         """Overload to e.g. update decoded_values based on object_info."""
         self.object_info = object_info
 
+    # Decoders can also offer a batch interface, used by process_orca() when
+    # available:
+    #
+    # decode_packets(words, offsets, lengths, packet_ids, lh5_tables, header_dict)
+    #     decode the packets at word positions offsets (pointing to their ORCA
+    #     header word) and with lengths lengths (in words, including the header
+    #     word) in the uint32 array words, see OrcaPacketReader.iter_chunks().
+    #     Packets are decoded in order until one would overflow its table.
+    #     Returns the number of packets decoded, so that the caller can flush
+    #     the full tables and call again with the rest.
+
+    def plan_batch(self, cccs, lh5_tables):
+        """
+        Plan the scattering of a batch of packets into per-channel tables, for
+        use in decode_packets()
+
+        The batch is cut at the first packet that would overflow its table.
+        Packets from channels without a table are counted as skipped in
+        lh5_tables. self.ievt is advanced by the number of packets
+        to be decoded.
+
+        Parameters
+        ----------
+        cccs : array of ints
+            The crate-card-channel (see get_ccc()) of each packet in the batch
+        lh5_tables : Table or ChannelTables
+            A single table for all channels, or tables routed by ccc (see
+            build_tables())
+
+        Returns
+        -------
+        (n_done, plan, ievt) : tuple
+            n_done is the number of packets from the start of the batch that
+            fit in the tables. plan is a list of (tb, i_pkts, rows), one for
+            each table receiving packets: the batch indices of its packets
+            (in order) and the table rows they go to. ievt holds the event
+            number of each decoded packet. Callers must advance tb.loc by
+            len(rows) after filling
+        """
+        n_pkts = len(cccs)
+        if isinstance(lh5_tables, lh5.Table):
+            n_done = min(n_pkts, lh5_tables.size - lh5_tables.loc)
+            i_pkts = np.arange(n_done)
+            ievt = self.ievt + i_pkts
+            self.ievt += n_done
+            return n_done, [(lh5_tables, i_pkts, lh5_tables.loc + i_pkts)], ievt
+
+        # group the packets by table slot (several channels can share one)
+        tables = lh5_tables.tables
+        pkt_slots = lh5_tables.get_slots(cccs)
+        order = np.argsort(pkt_slots, kind='stable')
+        counts = np.bincount(pkt_slots + 1, minlength=len(tables)+1)
+        groups = np.split(order, np.cumsum(counts)[:-1])
+
+        # cut the batch where the first table overflows
+        n_done = n_pkts
+        for tb, i_pkts in zip(tables, groups[1:]):
+            n_free = tb.size - tb.loc
+            if len(i_pkts) > n_free: n_done = min(n_done, i_pkts[n_free])
+
+        lh5_tables.count_skipped(cccs[groups[0][groups[0] < n_done]])
+
+        plan = []
+        decoded = pkt_slots[:n_done] >= 0
+        ievt = self.ievt + np.cumsum(decoded) - 1
+        self.ievt += np.count_nonzero(decoded)
+        for tb, i_pkts in zip(tables, groups[1:]):
+            i_pkts = i_pkts[i_pkts < n_done]
+            if len(i_pkts) == 0: continue
+            plan.append((tb, i_pkts, tb.loc + np.arange(len(i_pkts))))
+        return n_done, plan, ievt
+
+
+    def plan_batch_garbage(self, cccs, codes, words, offsets, lengths, packet_ids, lh5_tables):
+        """
+        plan_batch() for a batch with bad packets, flagged by non-zero garbage
+        codes in codes. The bad packets up to where the batch is cut are put
+        in the garbage (see DataDecoder.put_in_garbage()) and left out of the
+        plan. words, offsets, lengths and packet_ids are as passed to
+        decode_packets()
+
+        Returns
+        -------
+        (n_done, plan, ievt, good) : tuple
+            As for plan_batch(), but the packet indices in plan and ievt refer
+            to the good packets, whose indices in the batch are in good
+        """
+        good = np.flatnonzero(codes == 0)
+        n_good, plan, ievt = self.plan_batch(cccs[good], lh5_tables)
+        n_done = len(codes) if n_good == len(good) else int(good[n_good])
+        for i in np.flatnonzero(codes[:n_done]).tolist():
+            start = int(offsets[i]) + 1
+            self.put_in_garbage(words[start:start+int(lengths[i])-1], int(packet_ids[i]), int(codes[i]))
+        return n_done, plan, ievt, good
+
 
 def open_orca(orca_filename):
     if orca_filename.endswith('.gz'):
@@ -50,36 +146,45 @@ def parse_header(orca_filename):
     The header is then read in ...
     """
     with open_orca(orca_filename) as xmlfile_handle:
-        #read the first word:
-        ba = bytearray(xmlfile_handle.read(8))
-
-        #Replacing this to be python2 friendly
-        # #first 4 bytes: header length in long words
-        # i = int.from_bytes(ba[:4], byteorder=sys.byteorder)
-        # #second 4 bytes: header length in bytes
-        # j = int.from_bytes(ba[4:], byteorder=sys.byteorder)
-
-        big_endian = False if sys.byteorder == "little" else True
-        i = from_bytes(ba[:4], big_endian=big_endian)
-        j = from_bytes(ba[4:], big_endian=big_endian)
-        if (np.ceil(j/4) != i-2) and (np.ceil(j/4) != i-3):
-            print('Error: header byte length = %d is the wrong size to fit into %d header packet words' % (j, i-2))
-            return i, j, {}
-
-        #read in the next that-many bytes that occupy the plist header
-        as_bytes = xmlfile_handle.read(j)
-        ba = bytearray(as_bytes)
-
-        #convert to string
-        #the readPlistFromBytes method doesn't exist in 2.7
-        if sys.version_info[0] < 3:
-            header_string = ba.decode("utf-8")
-            header_dict = plistlib.readPlistFromString(header_string)
-        elif sys.version_info[1] < 9:
-            header_dict = plistlib.readPlistFromBytes(ba)
-        else:
-            header_dict = plistlib.loads(as_bytes, fmt=plistlib.FMT_XML)
-        return i, j, header_dict
+        return read_header(xmlfile_handle)
+
+
+def read_header(xmlfile_handle):
+    """
+    Read the ORCA header from a file-like object positioned at the start of
+    the file or stream, see parse_header(). Also used for streams (see
+    OrcaStreamReader), whose header has to be read before the packets
+    """
+    #read the first word:
+    ba = bytearray(xmlfile_handle.read(8))
+
+    #Replacing this to be python2 friendly
+    # #first 4 bytes: header length in long words
+    # i = int.from_bytes(ba[:4], byteorder=sys.byteorder)
+    # #second 4 bytes: header length in bytes
+    # j = int.from_bytes(ba[4:], byteorder=sys.byteorder)
+
+    big_endian = False if sys.byteorder == "little" else True
+    i = from_bytes(ba[:4], big_endian=big_endian)
+    j = from_bytes(ba[4:], big_endian=big_endian)
+    if (np.ceil(j/4) != i-2) and (np.ceil(j/4) != i-3):
+        print('Error: header byte length = %d is the wrong size to fit into %d header packet words' % (j, i-2))
+        return i, j, {}
+
+    #read in the next that-many bytes that occupy the plist header
+    as_bytes = xmlfile_handle.read(j)
+    ba = bytearray(as_bytes)
+
+    #convert to string
+    #the readPlistFromBytes method doesn't exist in 2.7
+    if sys.version_info[0] < 3:
+        header_string = ba.decode("utf-8")
+        header_dict = plistlib.readPlistFromString(header_string)
+    elif sys.version_info[1] < 9:
+        header_dict = plistlib.readPlistFromBytes(ba)
+    else:
+        header_dict = plistlib.loads(as_bytes, fmt=plistlib.FMT_XML)
+    return i, j, header_dict
 
 
 def from_bytes(data, big_endian=False):
@@ -287,30 +392,92 @@ def get_channel(ccc):
 # Import orca_digitizers so that the list of OrcaDecoder.__subclasses__ gets populated
 # Do it here so that orca_digitizers can import the functions above here
 from . import orca_digitizers, orca_flashcam
+from .orca_packets import OrcaPacketReader, OrcaStreamReader, is_stream_address
+from .telemetry import Telemetry
 
-def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=None, verbose=False, buffer_size=1024):
+def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=None, verbose=False, buffer_size=1024, async_write=False, swmr=False, n_workers=1, n_regions=1, decoder_names=None, region=None,
+                 follow=False, flush_interval=None, flush_rows=None, idle_timeout=10, telemetry=None):
     """
     convert ORCA DAQ data to "raw" lh5
 
     ch_groups_dict: keyed by decoder_name
+    async_write: if True, full tables are handed off to an lh5.AsyncWriter and
+        written from a separate thread while decoding continues. Uses up to 3x
+        the table memory.
+    swmr: if True, the output files are written in HDF5 SWMR mode, so that
+        they can be read while being written (see lh5.tail_object)
+    n_workers, n_regions: if either is > 1, decode in parallel with
+        process_orca_parallel()
+    decoder_names: if not None, only run these decoders
+    region: if not None, only decode part of the file. A dict as returned
+        by get_orca_regions()
+    follow: if True, decode a file that is still being written, as the data
+        arrive (see OrcaStreamReader). Also done if daq_filename is a socket
+        address 'tcp://host:port' or 'unix:///path'. The stream ends when no
+        new data arrive for idle_timeout seconds (or the socket is closed)
+    flush_interval: if not None, write out the data decoded so far at least
+        every flush_interval seconds, even if the tables are not full. Useful
+        with follow and swmr, to make the data readable soon after they were
+        taken
+    flush_rows: if not None, write out tables as soon as they have flush_rows
+        rows, instead of when they are full
+    telemetry: if not None, a Telemetry, filled with the time spent reading,
+        decoding (per decoder), flushing and writing, and the packets per
+        data ID and rows per output group
+
+    returns the set of output files written to
     """
-    lh5_store = lh5.Store()
+    tel = telemetry if telemetry is not None else Telemetry()
+    follow = follow or is_stream_address(daq_filename)
+    if follow and (n_workers > 1 or n_regions > 1):
+        print('process_orca: can only follow a stream serially, ignoring n_workers and n_regions')
+        n_workers = n_regions = 1
+    if n_workers > 1 or n_regions > 1:
+        if swmr: print('process_orca: swmr is not supported in parallel mode, ignoring')
+        return process_orca_parallel(daq_filename, raw_file_pattern, n_max, ch_groups_dict,
+                                     verbose, buffer_size, async_write, n_workers, n_regions, telemetry)
+
+    lh5_store = lh5.Store(amortize_appends=True, swmr=swmr)
+    writer = lh5.AsyncWriter(lh5_store) if async_write else lh5_store
+    try:
+        return _process_orca_serial(daq_filename, raw_file_pattern, n_max, ch_groups_dict, verbose, buffer_size, async_write, swmr, decoder_names, region,
+                                    follow, flush_interval, flush_rows, idle_timeout, tel, lh5_store, writer)
+    finally:
+        # also close the outputs if decoding failed, so that the datasets
+        # over-allocated by amortized appends get trimmed to the rows written.
+        # Closing again after a successful run does nothing
+        writer.close()
 
-    f_in = open_orca(daq_filename)
-    if f_in == None:
-        print("Couldn't find the file %s" % daq_filename)
-        sys.exit(0)
 
-    # parse the header. save the length so we can jump past it later
-    reclen, header_nbytes, header_dict = parse_header(daq_filename)
+def _process_orca_serial(daq_filename, raw_file_pattern, n_max, ch_groups_dict, verbose, buffer_size, async_write, swmr, decoder_names, region,
+                         follow, flush_interval, flush_rows, idle_timeout, tel, lh5_store, writer):
+    """
+    the decoding loop of process_orca() in a single process. Writes go through
+    writer, which is lh5_store or an lh5.AsyncWriter around it. Closes writer
+    when done
+    """
+    if follow:
+        # the header comes with the stream, read it and skip to the packets
+        poll_interval = 0.5 if flush_interval is None else min(0.5, flush_interval)
+        reader = OrcaStreamReader(daq_filename, poll_interval=poll_interval, idle_timeout=idle_timeout)
+        reclen, header_nbytes, header_dict = read_header(reader)
+        reader.read(reclen*4 - reader.tell())
+        file_size = 0
+        print("Following stream", daq_filename)
+    else:
+        # parse the header. save the length so we can jump past it later
+        reclen, header_nbytes, header_dict = parse_header(daq_filename)
+
+        # reclen is in number of longs, and we want to skip a number of bytes
+        if region is None: reader = OrcaPacketReader(daq_filename, start_byte=reclen*4)
+        else:
+            reader = OrcaPacketReader(daq_filename, start_byte=region['start_byte'],
+                                      stop_byte=region['stop_byte'])
 
-    # figure out the total size
-    SEEK_END = 2
-    f_in.seek(0, SEEK_END)
-    file_size = float(f_in.tell())
-    f_in.seek(0, 0)  # rewind
-    file_size_MB = file_size / 1e6
-    print("Total file size: {:.3f} MB".format(file_size_MB))
+        # figure out the total size
+        file_size = float(reader.file_size)
+        file_size_MB = file_size / 1e6
+        print("Total file size: {:.3f} MB".format(file_size_MB))
     print("Run number:", get_run_number(header_dict))
 
 
@@ -337,6 +504,9 @@ def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=No
     if ch_groups_dict is not None:
         decode_all_data = False
         decoders_to_run = ch_groups_dict.keys()
+    if decoder_names is not None:
+        decode_all_data = False
+        decoders_to_run = [dn for dn in decoders_to_run if dn in decoder_names]
 
     # Now get the actual requested decoders
     for sub in OrcaDecoder.__subclasses__():
@@ -383,16 +553,34 @@ def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=No
         ch_tables_dict[data_id] = build_tables(ch_groups, buffer_size, dec)
     max_tbl_size = 0
 
+    # bad packets are written to {decoder_name}/garbage in the decoder's
+    # first output file
+    garbage_outputs = {}
+    for data_id, dec in decoders.items():
+        group_info = next(iter(ch_groups_dict[id2dn_dict[data_id]].values()))
+        garbage_outputs[data_id] = (group_info['out_file'], dec.decoder_name)
+
+    # SWMR files can't get new objects, so create all outputs first
+    if swmr:
+        out_files = set()
+        for data_id in decoders:
+            out_files |= create_outputs(ch_groups_dict[id2dn_dict[data_id]], lh5_store)
+            out_file, group = garbage_outputs[data_id]
+            decoders[data_id].write_out_garbage(out_file, group, lh5_store, force=True)
+        for out_file in out_files: lh5_store.start_swmr(out_file)
+    if async_write: lh5_store = writer
+
     # -- scan over raw data --
     print("Beginning daq-to-raw processing ...")
 
     packet_id = 0  # number of events decoded
+    if region is not None:
+        # continue the packet and event counts of the preceding regions
+        packet_id = region['packet_id']
+        for data_id, decoder in decoders.items():
+            if hasattr(decoder, 'ievt'): decoder.ievt = region['ievt'].get(data_id, 0)
     unrecognized_data_ids = []
 
-    # skip the header using reclen from before
-    # reclen is in number of longs, and we want to skip a number of bytes
-    f_in.seek(reclen * 4)
-
     n_entries = 0
     unit = "B"
     if n_max < np.inf and n_max > 0:
@@ -401,58 +589,122 @@ def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=No
     else:
         n_entries = file_size
     progress_bar = tqdm_range(0, int(n_entries), text="Processing", verbose=verbose, unit=unit)
-    file_position = 0
-
-    # start scanning
-    while (packet_id < n_max and f_in.tell() < file_size):
-        packet_id += 1
-
-        try:
-            packet, data_id = get_next_packet(f_in)
-        except EOFError:
-            break
-        except Exception as e:
-            print("Failed to get the next event ... Exception:", e)
-            break
-
-        if decode_all_data and data_id not in decoders:
-            if data_id not in unrecognized_data_ids:
-                unrecognized_data_ids.append(data_id)
-            continue
-
-        if data_id not in decoders: continue
-        decoder = decoders[data_id]
+    file_position = reader.tell()
 
-        # Clear the tables if the next read could overflow them.
-        # Only have to check this when the max table size is within
-        # max_n_rows_per_packet of being full.
-        if max_tbl_size + decoder.max_n_rows_per_packet() >= buffer_size:
-            ch_groups = ch_groups_dict[id2dn_dict[data_id]]
-            max_tbl_size = 0
-            for group_info in ch_groups.values():
-                tbl = group_info['table']
-                if tbl.is_full():
-                    group_path = group_info['group_path']
-                    out_file = group_info['out_file']
-                    lh5_store.write_object(tbl, group_path, out_file, n_rows=tbl.loc)
+    def write_garbage(data_id):
+        """write out the bad packets of data_id collected so far"""
+        decoder = decoders[data_id]
+        if decoder.garbage_table.loc == 0: return
+        t_start = tel.now()
+        out_file, group = garbage_outputs[data_id]
+        decoder.write_out_garbage(out_file, group, lh5_store)
+        tel.add_time('write', t_start)
+
+    def flush_full_tables(data_id, min_rows=flush_rows):
+        """write out the full tables of data_id (or those with at least
+        min_rows rows), return the max table size"""
+        t_start, t_write = tel.now(), tel.stage_time['write']
+        max_tbl_size = 0
+        for group_info in ch_groups_dict[id2dn_dict[data_id]].values():
+            tbl = group_info['table']
+            if tbl.is_full() or (min_rows is not None and tbl.loc >= max(min_rows, 1)):
+                group_path = group_info['group_path']
+                out_file = group_info['out_file']
+                if async_write:
+                    tbl = tel.submit(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
+                    ch_tables_dict[data_id] = replace_table(group_info, tbl, ch_tables_dict[data_id])
+                else:
+                    tel.write_object(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
                     tbl.clear()
-                if tbl.loc > max_tbl_size: max_tbl_size = tbl.loc
-        else: max_tbl_size += decoder.max_n_rows_per_packet()
-
-        tables = ch_tables_dict[data_id]
-        decoder.decode_packet(packet, tables, packet_id, header_dict)
+            if tbl.loc > max_tbl_size: max_tbl_size = tbl.loc
+        write_garbage(data_id)
+        # the writes are accounted for separately
+        tel.add_time('flush', t_start + tel.stage_time['write'] - t_write)
+        return max_tbl_size
+
+    # start scanning. The packet index is built a chunk at a time. Decoders
+    # with a batch interface get all packets of their data ID in the chunk at
+    # once, the others get zero-copy views of the packets one at a time
+    words = mv = None
+    t_flush = time.monotonic()
+    t_read = tel.now()
+    for words, offsets, lengths, data_ids in reader.iter_chunks():
+        tel.add_time('read', t_read)
+        n_pkts = len(offsets)
+        if packet_id + n_pkts > n_max: n_pkts = int(n_max - packet_id)
+        offsets, lengths, data_ids = offsets[:n_pkts], lengths[:n_pkts], data_ids[:n_pkts]
+        packet_ids = packet_id + 1 + np.arange(n_pkts)
+        packet_id += n_pkts
+        mv = memoryview(words).cast('B')
+
+        for data_id in np.unique(data_ids).tolist():
+            i_pkts = np.flatnonzero(data_ids == data_id)
+            tel.count_packets(data_id, len(i_pkts), 4*lengths[i_pkts].sum(), id2dn_dict.get(data_id))
+            if data_id not in decoders:
+                if decode_all_data and data_id not in unrecognized_data_ids:
+                    unrecognized_data_ids.append(data_id)
+                continue
+            decoder = decoders[data_id]
+            # time spent flushing tables is accounted for separately
+            t_decode, t_flushing = tel.now(), tel.stage_time['flush'] + tel.stage_time['write']
+            decode_stage = 'decode/' + type(decoder).__name__
+
+            if hasattr(decoder, 'decode_packets'):
+                # decode until a table is full, flush, and repeat
+                while len(i_pkts) > 0:
+                    n_done = decoder.decode_packets(words, offsets[i_pkts], lengths[i_pkts],
+                                                    packet_ids[i_pkts], ch_tables_dict[data_id],
+                                                    header_dict)
+                    i_pkts = i_pkts[n_done:]
+                    if len(i_pkts) > 0: flush_full_tables(data_id)
+                tel.add_time(decode_stage, t_decode + tel.stage_time['flush'] + tel.stage_time['write'] - t_flushing)
+                continue
+
+            for i in i_pkts.tolist():
+                # Clear the tables if the next read could overflow them.
+                # Only have to check this when the max table size is within
+                # max_n_rows_per_packet of being full.
+                if max_tbl_size + decoder.max_n_rows_per_packet() >= buffer_size:
+                    max_tbl_size = flush_full_tables(data_id)
+                else: max_tbl_size += decoder.max_n_rows_per_packet()
+
+                start = int(offsets[i]) + 1
+                stop = int(offsets[i]) + int(lengths[i])
+                tables = ch_tables_dict[data_id]
+                decoder.decode_packet(mv[start*4:stop*4], tables, int(packet_ids[i]), header_dict)
+            tel.add_time(decode_stage, t_decode + tel.stage_time['flush'] + tel.stage_time['write'] - t_flushing)
 
         if verbose:
             if n_max < np.inf and n_max > 0:
-                update_len = 1
+                update_len = n_pkts
             else:
-                update_len = f_in.tell() - file_position
-                file_position = f_in.tell()
+                update_len = reader.tell() - file_position
+                file_position = reader.tell()
             update_progress(progress_bar, update_len)
+        if packet_id >= n_max: break
+
+        # write out partially filled tables on the flush_rows / flush_interval
+        # budget. In follow mode, empty chunks arrive while waiting for data
+        if flush_rows is not None or flush_interval is not None:
+            if flush_interval is not None and time.monotonic() - t_flush >= flush_interval:
+                min_rows = 1
+            else: min_rows = flush_rows
+            if min_rows is not None:
+                max_tbl_size = 0
+                for data_id in decoders:
+                    max_tbl_size = max(max_tbl_size, flush_full_tables(data_id, min_rows))
+            if min_rows == 1:
+                t_start = tel.now()
+                lh5_store.flush()
+                tel.add_time('write', t_start)
+                t_flush = time.monotonic()
+        tel.sample()
+        t_read = tel.now()
 
 
     print("Done. Last packet ID:", packet_id)
-    f_in.close()
+    words = mv = None
+    reader.close()
 
     # final write to file
     for dec_name, ch_groups in ch_groups_dict.items():
@@ -461,9 +713,17 @@ def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=No
             if tbl.loc == 0: continue
             group_path = group_info['group_path']
             out_file = group_info['out_file']
-            lh5_store.write_object(tbl, group_path, out_file, n_rows=tbl.loc)
+            tel.write_object(lh5_store, tbl, group_path, out_file, n_rows=tbl.loc)
             print('last write')
             tbl.clear()
+    for data_id, decoder in decoders.items():
+        write_garbage(data_id)
+        if decoder.n_garbage > 0:
+            out_file, group = garbage_outputs[data_id]
+            print(f"WARNING: {decoder.decoder_name} put {decoder.n_garbage} bad packets in {group}/garbage in {out_file}")
+    t_start = tel.now()
+    lh5_store.close()
+    tel.add_time('write', t_start)
 
     if len(unrecognized_data_ids) > 0:
         print("WARNING, Found the following unknown data IDs:")
@@ -476,3 +736,144 @@ def process_orca(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=No
 
     print("Wrote RAW File:\n    {}\nFILE INFO:".format(raw_file_pattern))
 
+    out_files = set()
+    for data_id in decoders:
+        for group_info in ch_groups_dict[id2dn_dict[data_id]].values():
+            out_files.add(group_info['out_file'])
+    return out_files
+
+
+def get_orca_regions(daq_filename, n_regions, n_max=np.inf):
+    """
+    Split the packets of an ORCA file into n_regions consecutive regions of
+    about equal size, for decoding in parallel (see process_orca_parallel())
+
+    Requires a pass over the packet index of the whole file (for gzipped
+    files, decompressing it).
+
+    Returns
+    -------
+    regions : list of dicts
+        For each region, 'start_byte' and 'stop_byte' give its extent in the
+        file, 'packet_id' the number of packets before it and 'ievt' the
+        number of packets of each data ID before it, used to continue the
+        decoders' event counters. Note that ievt then also counts packets of
+        skipped channels and bad packets (see DataDecoder.put_in_garbage()) in
+        the preceding regions. Regions without packets
+        (e.g. inside a huge packet) are dropped
+    """
+    reclen, header_nbytes, header_dict = parse_header(daq_filename)
+    regions = []
+    n_before = {}
+    packet_id = 0
+    last_reg = -1
+    stop_byte = reclen*4
+    with OrcaPacketReader(daq_filename, start_byte=reclen*4) as reader:
+        size = reader.file_size - reclen*4
+        targets = reclen*4 + (size * np.arange(n_regions)) // n_regions
+        for words, offsets, lengths, data_ids in reader.iter_chunks():
+            n_pkts = len(offsets)
+            if packet_id + n_pkts > n_max: n_pkts = int(n_max - packet_id)
+            starts = reader.block_start + offsets[:n_pkts]*4
+            i_reg = np.searchsorted(targets, starts, side='right') - 1
+            for i in np.flatnonzero(np.diff(i_reg, prepend=last_reg)).tolist():
+                ievt = dict(n_before)
+                for data_id, n in zip(*np.unique(data_ids[:i], return_counts=True)):
+                    ievt[int(data_id)] = ievt.get(int(data_id), 0) + int(n)
+                regions.append({ 'start_byte' : int(starts[i]),
+                                 'packet_id' : packet_id + i,
+                                 'ievt' : ievt })
+            for data_id, n in zip(*np.unique(data_ids[:n_pkts], return_counts=True)):
+                n_before[int(data_id)] = n_before.get(int(data_id), 0) + int(n)
+            packet_id += n_pkts
+            if n_pkts > 0:
+                last_reg = i_reg[-1]
+                stop_byte = int(starts[-1]) + int(lengths[n_pkts-1])*4
+            if packet_id >= n_max: break
+    for i, region in enumerate(regions):
+        region['stop_byte'] = regions[i+1]['start_byte'] if i+1 < len(regions) else stop_byte
+    return regions
+
+
+def process_orca_job(daq_filename, raw_file_pattern, **kwargs):
+    """process_orca() in a worker of process_orca_parallel(). Returns the
+    output files and the job's Telemetry"""
+    tel = Telemetry()
+    out_files = process_orca(daq_filename, raw_file_pattern, telemetry=tel, **kwargs)
+    return out_files, tel
+
+
+def process_orca_parallel(daq_filename, raw_file_pattern, n_max=np.inf, ch_groups_dict=None, verbose=False, buffer_size=1024, async_write=False, n_workers=None, n_regions=1, telemetry=None):
+    """
+    convert ORCA DAQ data to "raw" lh5 using several worker processes
+
+    The packet stream is partitioned by decoder (i.e. by data ID) and
+    optionally into n_regions consecutive regions of the file (see
+    get_orca_regions()). Each part is decoded by process_orca() in a worker
+    process into its own temporary files. These are then appended to the
+    output files in file order, so that each output table has the same rows
+    in the same (packet_id) order as when decoding serially.
+
+    raw_file_pattern: output file name template, or a dict of them keyed by
+        system (see set_outputs()). Existing output files are overwritten
+    n_workers: number of worker processes. None: one per cpu
+    telemetry: if not None, a Telemetry, filled with the workers' stage times
+        (summed over workers) and counts, plus the time spent merging their
+        files (stage 'merge')
+    See process_orca() for the other parameters.
+
+    returns the set of output files written to
+    """
+    # the decoders to run: the ones with data in the file, or the ones the
+    # user asked for
+    reclen, header_nbytes, header_dict = parse_header(daq_filename)
+    available = [sub().decoder_name for sub in OrcaDecoder.__subclasses__()]
+    if ch_groups_dict is None: decoder_names = get_id_to_decoder_name_dict(header_dict).values()
+    else: decoder_names = ch_groups_dict.keys()
+    decoder_names = [dn for dn in decoder_names if dn in available]
+    if len(decoder_names) == 0:
+        print("No decoders. Exiting...")
+        sys.exit(1)
+
+    if n_regions > 1 or n_max < np.inf: regions = get_orca_regions(daq_filename, n_regions, n_max)
+    else: regions = [None]
+    if verbose:
+        print(f"Decoding {len(decoder_names)} data streams in {len(regions)} region(s) with {n_workers} workers")
+
+    # one job per region and decoder, each writing to its own files
+    jobs = []
+    for region in regions:
+        for decoder_name in decoder_names:
+            suffix = f'.part{os.getpid()}_{len(jobs)}'
+            kwargs = { 'buffer_size' : buffer_size, 'async_write' : async_write,
+                       'region' : region }
+            if ch_groups_dict is None: kwargs['decoder_names'] = [decoder_name]
+            else: kwargs['ch_groups_dict'] = { decoder_name : copy.deepcopy(ch_groups_dict[decoder_name]) }
+            if isinstance(raw_file_pattern, dict):
+                part_pattern = { system : oft + suffix for system, oft in raw_file_pattern.items() }
+            else: part_pattern = raw_file_pattern + suffix
+            jobs.append((part_pattern, suffix, kwargs))
+
+    with ProcessPoolExecutor(n_workers) as pool:
+        futures = [pool.submit(process_orca_job, daq_filename, part_pattern, **kwargs)
+                   for part_pattern, suffix, kwargs in jobs]
+        results = [future.result() for future in futures]
+
+    # merge in job order: regions are in file order. Existing output files
+    # (e.g. from an earlier run) are replaced, not appended to
+    t_start = Telemetry.now()
+    out_files = set()
+    for (part_pattern, suffix, kwargs), (files, job_tel) in zip(jobs, results):
+        if telemetry is not None: telemetry.merge(job_tel, file_suffix=suffix)
+        for part_file in sorted(files):
+            out_file = part_file[:-len(suffix)]
+            if out_file not in out_files and os.path.exists(out_file):
+                print('Overwriting existing file:', out_file)
+                os.remove(out_file)
+            if os.path.exists(part_file):
+                lh5.append_file(part_file, out_file, buffer_len=buffer_size)
+                os.remove(part_file)
+            out_files.add(out_file)
+    if telemetry is not None: telemetry.add_time('merge', t_start)
+    return out_files
+
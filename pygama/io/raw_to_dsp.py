@@ -20,14 +20,37 @@ from pygama.dsp.errors import DSPFatal
 
 def raw_to_dsp(f_raw, f_dsp, dsp_config, lh5_tables=None, database=None,
                outputs=None, n_max=np.inf, overwrite=True, buffer_len=3200,
-               block_width=16, verbose=1, chan_config=None):
+               block_width=16, verbose=1, chan_config=None, async_write=False):
     """
     Uses the ProcessingChain class.
     The list of processors is specifed via a JSON file.
+    If async_write is True, output tables are copied into a buffer pool and
+    written by an lh5.AsyncWriter thread while the next block is processed.
+    """
+    # raw_store keeps f_raw open, so that the object metadata are read only
+    # once for all the chunks. The output is written through its own Store
+    # (in the writer thread if async_write)
+    raw_store = lh5.Store(keep_open=True)
+    dsp_store = lh5.AsyncWriter() if async_write else lh5.Store(amortize_appends=True)
+    try:
+        return _raw_to_dsp(f_raw, f_dsp, dsp_config, lh5_tables, database, outputs, n_max, overwrite,
+                           buffer_len, block_width, verbose, chan_config, async_write, raw_store, dsp_store)
+    finally:
+        # also close the output if processing failed, so that the datasets
+        # over-allocated by amortized appends get trimmed to the rows written.
+        # Closing again after a successful run does nothing
+        dsp_store.close()
+        raw_store.close()
+
+
+def _raw_to_dsp(f_raw, f_dsp, dsp_config, lh5_tables, database, outputs, n_max, overwrite,
+                buffer_len, block_width, verbose, chan_config, async_write, raw_store, dsp_store):
+    """
+    the body of raw_to_dsp(). Reads through raw_store and writes through
+    dsp_store, which is an lh5.Store or an lh5.AsyncWriter
     """
     t_start = time.time()
 
-    raw_store = lh5.Store()
     lh5_file = raw_store.gimme_file(f_raw, 'r')
     if lh5_file is None:
         print(f'raw_to_dsp: input file not found: {f_raw}')
@@ -122,7 +145,10 @@ def raw_to_dsp(f_raw, f_dsp, dsp_config, lh5_tables=None, database=None,
                 e.wf_range = "{}-{}".format(e.wf_range[0]+start_row, e.wf_range[1]+start_row)
                 raise e
 
-            raw_store.write_object(tb_out, tb.replace('/raw', '/dsp'), f_dsp, n_rows=n_rows)
+            if async_write:
+                dsp_store.write_object(tb_out, tb.replace('/raw', '/dsp'), f_dsp, n_rows=n_rows, copy=True)
+            else:
+                dsp_store.write_object(tb_out, tb.replace('/raw', '/dsp'), f_dsp, n_rows=n_rows)
 
         if chan_config is not None:
             info_dsp = f'dsp_config/{tb}'
@@ -133,7 +159,9 @@ def raw_to_dsp(f_raw, f_dsp, dsp_config, lh5_tables=None, database=None,
         print(f'Done.  Writing to file: {f_dsp}')
 
     # write metadata to file
-    raw_store.write_object(dsp_info, 'dsp_info', f_dsp)
+    dsp_store.write_object(dsp_info, 'dsp_info', f_dsp)
+    dsp_store.close()
+    raw_store.close()
 
     t_elap = (time.time() - t_start) / 60
     print(f'Done processing.  Time elapsed: {t_elap:.2f} min.')
@@ -175,10 +203,12 @@ json config file and raw_to_dsp.""")
         help="Update existing file with new values. Useful with the --outpar option. Mutually exclusive with --recreate and --append THIS IS NOT IMPLEMENTED YET!")
     arg('-a', '--append', action='store_const', const=1, dest='writemode',
         help="Append values to existing file. Mutually exclusive with --recreate and --update THIS IS NOT IMPLEMENTED YET!")
+    arg('-w', '--asyncwrite', action='store_true',
+        help="Write output from a separate thread while processing continues.")
     args = parser.parse_args()
 
     out = args.output
     if out is None:
         out = 't2_'+args.file[args.file.rfind('/')+1:].replace('t1_', '')
 
-    raw_to_dsp(args.file, out, args.jsonconfig, lh5_tables=args.group, database=args.dbfile, verbose=args.verbose, outputs=args.outpar, n_max=args.nevents, overwrite=(args.writemode==0), buffer_len=args.chunk, block_width=args.block)
+    raw_to_dsp(args.file, out, args.jsonconfig, lh5_tables=args.group, database=args.dbfile, verbose=args.verbose, outputs=args.outpar, n_max=args.nevents, overwrite=(args.writemode==0), buffer_len=args.chunk, block_width=args.block, async_write=args.asyncwrite)
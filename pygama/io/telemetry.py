@@ -0,0 +1,207 @@
+"""
+Instrumentation of daq_to_raw conversions: time spent per processing stage and
+throughput per data stream and output group, to tell e.g. whether a slow
+conversion is disk-bound or decode-bound.
+"""
+import os, time, json
+import numpy as np
+from collections import defaultdict
+
+from pygama import lh5
+
+
+class Telemetry:
+    """
+    Collects stage timings and throughput counters during a conversion
+
+    Stages are named by the caller. process_orca() and process_flashcam() use
+    'read' (getting packets from the DAQ file), 'decode/<decoder class>',
+    'flush' (table bookkeeping and handing off tables for writing, not
+    including the writes) and 'write' (lh5 Store.write_object calls). Packet
+    counts are kept per data stream (e.g. an ORCA data ID), row counts per
+    output group.
+
+    If sample_interval is not None, sample() takes a snapshot of the counters
+    at most every sample_interval seconds, and, if a filename is given,
+    rewrites the summary to it, so that long runs can be monitored.
+
+    Example
+    -------
+    tel = Telemetry()
+    t0 = tel.now()
+    decode(...)
+    tel.add_time('decode/MyDecoder', t0)
+    tel.write_json('run_telemetry.json')
+    """
+
+    def __init__(self, sample_interval=None, filename=None):
+        self.sample_interval = sample_interval
+        self.filename = filename
+        self.t_start = time.perf_counter()
+        self.t_sample = self.t_start
+        self.stage_time = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.streams = {}
+        self.groups = {}
+        self.samples = []
+        self.info = {}
+
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+
+    def add_time(self, stage, t_start, t_stop=None):
+        """Add the time from t_start (from now()) to t_stop (default: now) to
+        stage, return t_stop"""
+        if t_stop is None: t_stop = time.perf_counter()
+        self.stage_time[stage] += t_stop - t_start
+        self.stage_calls[stage] += 1
+        return t_stop
+
+
+    def count_packets(self, stream, n_packets, n_bytes, name=None):
+        """Count n_packets packets with a total of n_bytes bytes of data
+        stream stream (e.g. a data ID), optionally labelled by name"""
+        if stream not in self.streams:
+            self.streams[stream] = { 'name' : name, 'packets' : 0, 'bytes' : 0 }
+        counts = self.streams[stream]
+        counts['packets'] += int(n_packets)
+        counts['bytes'] += int(n_bytes)
+
+
+    def count_rows(self, group, n_rows, n_bytes):
+        """Count n_rows rows with n_bytes bytes written to output group"""
+        if group not in self.groups: self.groups[group] = { 'rows' : 0, 'bytes' : 0, 'writes' : 0 }
+        counts = self.groups[group]
+        counts['rows'] += int(n_rows)
+        counts['bytes'] += int(n_bytes)
+        counts['writes'] += 1
+
+
+    def write_object(self, lh5_store, obj, name, lh5_file, n_rows=None):
+        """lh5_store.write_object(), timed as stage 'write' and counted as
+        rows of group name in lh5_file"""
+        if n_rows is None: n_rows = len(obj)
+        t0 = time.perf_counter()
+        lh5_store.write_object(obj, name, lh5_file, n_rows=n_rows)
+        self.add_time('write', t0)
+        self.count_rows(f'{lh5_file}:{name}', n_rows, get_nbytes(obj, n_rows))
+
+
+    def submit(self, lh5_writer, tbl, name, lh5_file, n_rows=None):
+        """lh5.AsyncWriter.submit(), counted like write_object(). The write
+        itself happens in the writer's thread, so only the hand-off is timed
+        (as stage 'flush')"""
+        if n_rows is None: n_rows = len(tbl)
+        self.count_rows(f'{lh5_file}:{name}', n_rows, get_nbytes(tbl, n_rows))
+        return lh5_writer.submit(tbl, name, lh5_file, n_rows=n_rows)
+
+
+    def merge(self, other, file_suffix=None):
+        """Add the stage times and counts of another Telemetry, e.g. of a
+        parallel worker. file_suffix is stripped from the file names of the
+        other's output groups, for workers writing to temporary files"""
+        for stage, t in other.stage_time.items():
+            self.stage_time[stage] += t
+            self.stage_calls[stage] += other.stage_calls[stage]
+        for stream, counts in other.streams.items():
+            self.count_packets(stream, counts['packets'], counts['bytes'], counts['name'])
+        for group, counts in other.groups.items():
+            if file_suffix is not None:
+                lh5_file, name = group.rsplit(':', 1)
+                if lh5_file.endswith(file_suffix): group = lh5_file[:-len(file_suffix)] + ':' + name
+            if group not in self.groups: self.groups[group] = { 'rows' : 0, 'bytes' : 0, 'writes' : 0 }
+            for key in counts: self.groups[group][key] += counts[key]
+
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : dict
+            'elapsed_s', 'stages' (time, fraction of the elapsed time and
+            number of calls of each stage), 'streams' (packets, bytes and
+            their rates per data stream), 'groups' (rows, bytes and their
+            rates, and number of writes per output group), 'info' (anything
+            the caller put there) and 'samples' (the periodic snapshots)
+        """
+        elapsed = time.perf_counter() - self.t_start
+        rate = lambda n: n / elapsed if elapsed > 0 else 0.
+        stages = {}
+        for stage, t in sorted(self.stage_time.items()):
+            stages[stage] = { 'time_s' : t,
+                              'fraction' : t / elapsed if elapsed > 0 else 0.,
+                              'calls' : self.stage_calls[stage] }
+        streams = {}
+        for stream, counts in self.streams.items():
+            streams[str(stream)] = dict(counts, packets_per_s=rate(counts['packets']),
+                                        bytes_per_s=rate(counts['bytes']))
+        groups = {}
+        for group, counts in self.groups.items():
+            groups[group] = dict(counts, rows_per_s=rate(counts['rows']),
+                                 bytes_per_s=rate(counts['bytes']))
+        return { 'elapsed_s' : elapsed,
+                 'stages' : stages,
+                 'streams' : streams,
+                 'groups' : groups,
+                 'info' : self.info,
+                 'samples' : self.samples }
+
+
+    def sample(self, force=False):
+        """If sample_interval seconds have passed since the last sample (or
+        force), snapshot the totals and rewrite the summary file"""
+        if self.sample_interval is None and not force: return
+        now = time.perf_counter()
+        if not force and now - self.t_sample < self.sample_interval: return
+        self.t_sample = now
+        self.samples.append({ 'elapsed_s' : now - self.t_start,
+                              'stage_time_s' : dict(self.stage_time),
+                              'packets' : sum(c['packets'] for c in self.streams.values()),
+                              'bytes' : sum(c['bytes'] for c in self.streams.values()),
+                              'rows' : sum(c['rows'] for c in self.groups.values()) })
+        if self.filename is not None: self.write_json(self.filename)
+
+
+    def write_json(self, filename=None):
+        """Write the summary to a json file (default: self.filename). The file
+        is replaced atomically, so readers never see a partial summary"""
+        if filename is None: filename = self.filename
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp_filename, filename)
+
+
+    def print_summary(self):
+        summary = self.summary()
+        print('Time elapsed: {:.2f} sec'.format(summary['elapsed_s']))
+        for stage, st in summary['stages'].items():
+            print('  {:<40} {:9.3f} sec ({:5.1%})'.format(stage, st['time_s'], st['fraction']))
+        for stream, st in summary['streams'].items():
+            label = stream if st['name'] is None else f"{stream} ({st['name']})"
+            print('  {:<40} {:9.0f} packets/s {:9.3f} MB/s'.format(label, st['packets_per_s'],
+                                                                   st['bytes_per_s']/1e6))
+        for group, st in summary['groups'].items():
+            print('  {:<40} {:9.0f} rows/s    {:9.3f} MB/s'.format(group, st['rows_per_s'],
+                                                                   st['bytes_per_s']/1e6))
+
+
+def get_nbytes(obj, n_rows=None):
+    """Number of bytes of data in the first n_rows rows of an lh5 object
+    (the whole object if n_rows is None)"""
+    if isinstance(obj, lh5.Struct):
+        return sum(get_nbytes(field, n_rows) for field in obj.values())
+    if isinstance(obj, lh5.VectorOfVectors):
+        if n_rows is None: n_rows = len(obj.cumulative_length.nda)
+        if n_rows == 0: return 0
+        n_values = obj.cumulative_length.nda[n_rows-1]
+        return (obj.cumulative_length.nda[:n_rows].nbytes
+                + obj.flattened_data.nda[:n_values].nbytes)
+    if isinstance(obj, lh5.Array):
+        return obj.nda[:n_rows].nbytes
+    if isinstance(obj, lh5.Scalar):
+        return np.asarray(obj.value).nbytes
+    return 0
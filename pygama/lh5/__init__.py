@@ -6,5 +6,9 @@ from .arrayofequalsizedarrays import ArrayOfEqualSizedArrays
 from .vectorofvectors import VectorOfVectors
 from .struct import Struct
 from .table import Table
-from .store import Store, load_nda, load_dfs
+from .store import Store, load_nda, load_dfs, lh5_to_parquet
 
+from .virtual import build_virtual_file
+from .async_writer import AsyncWriter
+from .tail import tail_object
+from .merge import append_file
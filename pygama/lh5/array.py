@@ -60,3 +60,23 @@ class Array:
         new_shape = (new_size,) + self.nda.shape[1:]
         self.nda.resize(new_shape)
 
+
+
+    def to_arrow(self, n_rows=None):
+        """Get a pyarrow Array view of the internal ndarray (of its first
+        n_rows rows, if given)
+
+        Numeric data are wrapped without copying. Arrays with more than one
+        dimension become (nested) FixedSizeListArrays over the flattened data.
+        Requires pyarrow.
+        """
+        import pyarrow as pa
+        nda = np.ascontiguousarray(self.nda[:n_rows])
+        flat = nda.reshape(-1)
+        if flat.dtype.kind in ['i', 'u', 'f']:
+            pa_type = pa.from_numpy_dtype(flat.dtype)
+            pa_arr = pa.Array.from_buffers(pa_type, len(flat), [None, pa.py_buffer(flat)])
+        else: pa_arr = pa.array(flat) # bools, strings, ...: arrow has to copy
+        for dim in reversed(nda.shape[1:]):
+            pa_arr = pa.FixedSizeListArray.from_arrays(pa_arr, dim)
+        return pa_arr
@@ -0,0 +1,166 @@
+import copy
+import threading
+import queue
+
+from .store import Store
+from .struct import Struct
+from .table import Table
+from .array import Array
+from .vectorofvectors import VectorOfVectors
+
+
+class AsyncWriter:
+    """
+    Writes lh5 objects to file from a dedicated thread
+
+    Producers hand off a filled Table with submit() and get back an empty one
+    from a small pool of buffers kept for each output location, so that e.g. a
+    decoding loop never waits for HDF5 to flush except when all buffers are
+    full (backpressure). The writer thread performs the appends with its own
+    Store, which must not be used by any other thread.
+
+    Example
+    -------
+    writer = AsyncWriter()
+    while decoding:
+        ... fill tbl ...
+        if tbl.is_full():
+            tbl = writer.submit(tbl, 'raw', 'out.lh5', n_rows=tbl.loc)
+    writer.close()
+    """
+
+
+    def __init__(self, lh5_store=None, n_buffers=3, max_queue=0):
+        """
+        Parameters
+        ----------
+        lh5_store : lh5.Store (optional)
+            The Store to write through. By default, a Store with amortized
+            appends is used. AsyncWriter calls its close() in close()
+        n_buffers : int (optional)
+            Number of tables allocated per output location, including the one
+            first passed to submit(). 2 gives double buffering, 3 triple, etc.
+        max_queue : int (optional)
+            Maximum number of pending writes. 0 means unbounded (the number of
+            pending table writes is still bounded by n_buffers)
+        """
+        self.store = lh5_store if lh5_store is not None else Store(amortize_appends=True)
+        self.n_buffers = max(n_buffers, 2)
+        self.jobs = queue.Queue(maxsize=max_queue)
+        self.pools = {}
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def submit(self, tbl, name, lh5_file, group='/', n_rows=None):
+        """Hand off tbl to be appended to lh5_file, return an empty table
+
+        tbl must not be touched by the caller after this call. The returned
+        table has the same structure and size as tbl, and its loc is 0. This
+        call only blocks if all n_buffers tables for this output location are
+        still waiting to be written.
+        """
+        self._check_error()
+        pool = self._get_pool(tbl, name, lh5_file, group)
+        self.jobs.put((tbl, name, lh5_file, group, n_rows, pool))
+        return self._get_free(pool)
+
+
+    def write_object(self, obj, name, lh5_file, group='/', n_rows=None, copy=False):
+        """Queue obj to be written with lh5.Store.write_object()
+
+        If copy is False, the caller must not modify obj until the write is
+        done (see flush()). If copy is True, obj must be a Table (e.g. the
+        output buffer of a ProcessingChain): its first n_rows rows are copied
+        into a pooled buffer and obj can be reused immediately.
+        """
+        self._check_error()
+        if not copy:
+            self.jobs.put((obj, name, lh5_file, group, n_rows, None))
+            return
+        if not isinstance(obj, Table):
+            raise TypeError('AsyncWriter: copy=True requires a Table, got ' + type(obj).__name__)
+        if n_rows is None: n_rows = len(obj)
+        pool = self._get_pool(obj, name, lh5_file, group, n_made=0)
+        buf = self._get_free(pool)
+        copy_rows(obj, buf, n_rows)
+        buf.loc = n_rows
+        self.jobs.put((buf, name, lh5_file, group, n_rows, pool))
+
+
+    def flush(self):
+        """Block until all queued writes are done"""
+        self.jobs.join()
+        self._check_error()
+
+
+    def close(self):
+        """Finish all writes, stop the writer thread and close the Store"""
+        self.jobs.put(None)
+        self.thread.join()
+        self.store.close()
+        self._check_error()
+
+
+    def _get_pool(self, tbl, name, lh5_file, group, n_made=1):
+        key = (lh5_file, group if isinstance(group, str) else group.name, name)
+        if key not in self.pools:
+            # n_made counts the caller's own table as part of the pool
+            self.pools[key] = { 'free' : queue.Queue(), 'n_made' : n_made, 'template' : tbl }
+        return self.pools[key]
+
+
+    def _get_free(self, pool):
+        try: return pool['free'].get_nowait()
+        except queue.Empty: pass
+        if pool['n_made'] < self.n_buffers:
+            pool['n_made'] += 1
+            new_tbl = copy.deepcopy(pool['template'])
+            new_tbl.clear()
+            return new_tbl
+        # backpressure: wait for the writer to hand a buffer back
+        while True:
+            try: return pool['free'].get(timeout=1)
+            except queue.Empty: self._check_error()
+
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            obj, name, lh5_file, group, n_rows, pool = job
+            try:
+                if self.error is None:
+                    self.store.write_object(obj, name, lh5_file, group=group, n_rows=n_rows)
+            except Exception as e:
+                self.error = e
+            finally:
+                if pool is not None:
+                    obj.clear()
+                    pool['free'].put(obj)
+                self.jobs.task_done()
+
+
+def copy_rows(src, dst, n_rows):
+    """Copy the first n_rows rows of lh5 object src into dst, which must have
+    the same structure (e.g. made with copy.deepcopy(src))"""
+    if isinstance(src, Struct):
+        for field, obj in src.items(): copy_rows(obj, dst[field], n_rows)
+    elif isinstance(src, VectorOfVectors):
+        if len(dst.cumulative_length) < n_rows: dst.cumulative_length.resize(n_rows)
+        dst.cumulative_length.nda[:n_rows] = src.cumulative_length.nda[:n_rows]
+        n_data = src.cumulative_length.nda[n_rows-1] if n_rows > 0 else 0
+        if len(dst.flattened_data) < n_data: dst.flattened_data.resize(n_data)
+        dst.flattened_data.nda[:n_data] = src.flattened_data.nda[:n_data]
+    elif isinstance(src, Array):
+        if len(dst) < n_rows: dst.resize(n_rows)
+        dst.nda[:n_rows] = src.nda[:n_rows]
@@ -0,0 +1,74 @@
+import os
+import h5py
+
+from .store import Store
+
+
+def append_file(src_file, dst_file, lh5_objects=None, buffer_len=3200, verbose=False):
+    """Append the lh5 objects in one file to the same objects in another
+
+    Objects not yet in dst_file are copied over as a whole with h5py, keeping
+    their chunking and compression. Array-like objects already in dst_file
+    get the rows of src_file appended, streamed through a buffer of
+    buffer_len rows. Useful e.g. for merging files written by parallel
+    workers.
+
+    Parameters
+    ----------
+    src_file : str
+        The file to be appended
+    dst_file : str
+        The file to append to. Created if it does not exist
+    lh5_objects : str or list of str's (optional)
+        Names (including their group path) of the objects to append. By
+        default, all lh5 objects (i.e. groups or datasets with a datatype
+        attribute) outside of other lh5 objects in src_file
+    buffer_len : int (optional)
+        Number of rows appended at a time
+    verbose : bool (optional)
+        Print info on the objects being appended
+
+    Returns
+    -------
+    n_rows : dict or None
+        The number of rows appended for each object (None for scalars and
+        structs), or None if something went wrong
+    """
+    src_file = os.path.expandvars(src_file)
+    dst_file = os.path.expandvars(dst_file)
+    store = Store()
+    n_rows = {}
+    with h5py.File(src_file, 'r') as src, h5py.File(dst_file, 'a') as dst:
+        if lh5_objects is None: lh5_objects = list_objects(src)
+        elif isinstance(lh5_objects, str): lh5_objects = [lh5_objects]
+        for name in lh5_objects:
+            if name not in src:
+                print('append_file:', name, 'not in', src_file)
+                return None
+            n_rows[name] = store.read_n_rows(name, src)
+            if name not in dst:
+                if verbose: print('copying', name, 'to', dst_file)
+                parent, base = os.path.split(name.strip('/'))
+                src.copy(src[name], dst.require_group(parent) if parent != '' else dst, name=base)
+                continue
+            if n_rows[name] is None:
+                if verbose: print('append_file: not appending', name, '(not array-like)')
+                continue
+            if verbose: print('appending', n_rows[name], 'rows of', name, 'to', dst_file)
+            obj_buf = None
+            for start_row in range(0, n_rows[name], buffer_len):
+                obj_buf, n_read = store.read_object(name, src, start_row=start_row,
+                                                    n_rows=buffer_len, obj_buf=obj_buf)
+                store.write_object(obj_buf, name, dst, n_rows=n_read)
+    return n_rows
+
+
+def list_objects(h5g, path=''):
+    """List the lh5 objects in h5py group h5g that are not inside another lh5
+    object, with their group paths"""
+    names = []
+    for key, obj in h5g.items():
+        name = path + '/' + key if path != '' else key
+        if 'datatype' in obj.attrs: names.append(name)
+        elif isinstance(obj, h5py.Group): names += list_objects(obj, name)
+    return names
@@ -1,4 +1,4 @@
-import sys, os
+import sys, os, time
 import numpy as np
 import h5py
 import fnmatch
@@ -15,10 +15,46 @@ from .arrayofequalsizedarrays import ArrayOfEqualSizedArrays
 from .vectorofvectors import VectorOfVectors
 
 class Store:
-    def __init__(self, base_path='', keep_open=False):
+    def __init__(self, base_path='', keep_open=False, amortize_appends=False, swmr=False, flush_interval=1.):
+        """
+        Parameters
+        ----------
+        base_path : str (optional)
+            Directory prepended to all file names
+        keep_open : bool (optional)
+            Keep files open between calls instead of re-opening them
+        amortize_appends : bool (optional)
+            Over-allocate datasets geometrically when appending, so that
+            appends of many small chunks don't each require a resize. Requires
+            calling close() after the last write. See write_nda()
+        swmr : bool (optional)
+            Open files for writing with libver='latest' so that they can be
+            switched to HDF5 single-writer/multiple-reader mode with
+            start_swmr() and read while being written (see tail_object()).
+            Implies keep_open. amortize_appends is ignored, so that readers
+            never see unwritten rows
+        flush_interval : float (optional)
+            In swmr mode, the minimum time in seconds between flushes of the
+            written data to disk for readers
+        """
         self.base_path = base_path
-        self.keep_open = keep_open
+        self.swmr = swmr
+        self.keep_open = keep_open or swmr
+        self.amortize_appends = amortize_appends and not swmr
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
         self.files = {}
+        # per-file cache of object metadata, see get_obj_info()
+        self.obj_info = {}
+        # [rows written, rows allocated] for amortized appends, keyed by
+        # (filename, ds name)
+        self.ds_lens = {}
+        # last cumulative_length of vectors of vectors written to, keyed by
+        # (filename, group name), and scratch space for offsetting them
+        self.cl_offsets = {}
+        self.cl_buf = np.empty(0, dtype='uint32')
+        # resolved datasets for amortized struct appends, see make_append_plan()
+        self.append_plans = {}
 
 
     def gimme_file(self, lh5_file, mode):
@@ -33,7 +69,8 @@ class Store:
         if mode == 'r' and not os.path.exists(full_path):
             print('file not found:', full_path)
             return None
-        h5f = h5py.File(full_path, mode)
+        if self.swmr and mode != 'r': h5f = h5py.File(full_path, mode, libver='latest')
+        else: h5f = h5py.File(full_path, mode)
         if self.keep_open: self.files[lh5_file] = h5f
         return h5f
 
@@ -46,6 +83,83 @@ class Store:
         return group
 
 
+    def start_swmr(self, lh5_file):
+        """Switch lh5_file to HDF5 single-writer/multiple-reader mode
+
+        Requires a Store made with swmr=True. From now on, readers can open
+        the file with swmr=True (e.g. through tail_object()) while this Store
+        appends to it. No new objects can be created in the file afterwards,
+        so all datasets must be created up front, e.g. by writing each output
+        table once with n_rows=0.
+        """
+        if not self.swmr:
+            print('Store: start_swmr requires a Store made with swmr=True')
+            return
+        h5f = self.gimme_file(lh5_file, 'a')
+        h5f.flush()
+        h5f.swmr_mode = True
+
+
+    def flush(self, force=True):
+        """Flush all files kept open by this Store, so that SWMR readers see
+        the data appended so far. If force is False, only flush if more than
+        flush_interval seconds have passed since the last flush"""
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.flush_interval: return
+        for h5f in self.files.values(): 
+            if h5f: h5f.flush()
+        self.last_flush = now
+
+
+    def get_obj_info(self, name, lh5_file):
+        """Get the (cached) metadata for object name in lh5_file
+
+        If this Store keeps its files open (keep_open or swmr), object
+        metadata (attributes, parsed datatype, dataset shape and dtype, group
+        keys) are read from the file only the first time they are requested,
+        and are then cached for each file. The cache for a file is invalidated
+        whenever this Store writes to it. Use clear_cache() if the file was
+        modified by something else. Other Stores re-read the metadata on each
+        call, so that they see writes made by other Stores or processes.
+
+        Returns
+        -------
+        info : dict or None
+            None if name is not in lh5_file. Otherwise a dict with keys
+            'attrs', 'datatype', 'shape' and 'elements' (see parse_datatype();
+            all are None if the datatype attribute is missing), plus
+            'ds_shape' and 'dtype' for datasets or 'keys' for groups.
+        """
+        h5f = self.gimme_file(lh5_file, 'r')
+        cache = self.obj_info.setdefault(h5f.filename, {}) if self.keep_open else {}
+        if name in cache: return cache[name]
+        if name not in h5f: return None
+
+        obj = h5f[name]
+        info = { 'attrs' : dict(obj.attrs) }
+        if 'datatype' in info['attrs']:
+            datatype, shape, elements = parse_datatype(info['attrs']['datatype'])
+        else: datatype, shape, elements = None, None, None
+        info['datatype'], info['shape'], info['elements'] = datatype, shape, elements
+        if isinstance(obj, h5py.Dataset):
+            info['ds_shape'] = (self.get_ds_len(obj),) + obj.shape[1:] if obj.shape else ()
+            info['dtype'] = obj.dtype
+        else: info['keys'] = list(obj.keys())
+        cache[name] = info
+        return info
+
+
+    def clear_cache(self, lh5_file=None):
+        """Clear the object metadata cache for lh5_file (default: all files)"""
+        if lh5_file is None: 
+            self.obj_info.clear()
+            return
+        if isinstance(lh5_file, h5py.File): filename = lh5_file.filename
+        elif self.base_path != '': filename = self.base_path + '/' + lh5_file
+        else: filename = lh5_file
+        self.obj_info.pop(filename, None)
+
+
     def ls(self, lh5_file, lh5_group=''):
         """Print a list of the group names in the lh5 file in the style of a
         Unix ls command. Supports wildcards."""
@@ -57,7 +171,8 @@ class Store:
             lh5_group='*'
             
         splitpath = lh5_group.split('/', 1)
-        matchingkeys = fnmatch.filter(lh5_file.keys(), splitpath[0])
+        keys = self.get_obj_info(lh5_file.name, lh5_file.file)['keys']
+        matchingkeys = fnmatch.filter(keys, splitpath[0])
         ret = []
         
         if len(splitpath)==1:
@@ -183,7 +298,8 @@ class Store:
 
         # get the file from the store
         h5f = self.gimme_file(lh5_file, 'r')
-        if name not in h5f:
+        info = self.get_obj_info(name, h5f)
+        if info is None:
             print('Store:', name, "not in", lh5_file)
             return None, 0
 
@@ -192,41 +308,40 @@ class Store:
             if idx is not None: idx = (idx,)
 
         # get the object's datatype
-        if 'datatype' not in h5f[name].attrs:
+        if info['datatype'] is None:
             print('Store:', name, 'in file', lh5_file, 'is missing the datatype attribute')
             return None, 0
-        datatype = h5f[name].attrs['datatype']
-        datatype, shape, elements = parse_datatype(datatype)
+        datatype, shape, elements = info['datatype'], info['shape'], info['elements']
+        attrs = info['attrs']
 
         # Scalar
         # scalars are dim-0 datasets
         if datatype == 'scalar': 
             value = h5f[name][()]
-            if elements == 'bool': value = np.bool(value)
+            if elements == 'bool': value = np.bool_(value)
             if obj_buf is not None:
                 obj_buf.value = value
-                obj_buf.attrs.update(h5f[name].attrs)
+                obj_buf.attrs.update(attrs)
                 return obj_buf, 1
-            else: return Scalar(value=value, attrs=h5f[name].attrs), 1
+            else: return Scalar(value=value, attrs=attrs), 1
 
 
         # Struct
         # recursively build a struct, return as a dictionary
         if datatype == 'struct':
 
-            # ignore obj_buf.
-            # TODO: could append new fields or overwrite/concat to existing
-            # fields. If implemented, get_buffer() above should probably also
-            # (optionally?) prep buffers for each field
-            if obj_buf is not None:
-                print("obj_buf not implemented for structs.  Returning new object")
+            # fields are read into the corresponding fields of obj_buf, which
+            # get added to it if missing
+            if obj_buf is not None and not isinstance(obj_buf, Struct):
+                print("obj_buf for", name, "not a Struct. returning new object")
+                obj_buf = None
 
             # build field_mask
             if field_mask is None: field_mask = defaultdict(lambda : True)
             elif isinstance(field_mask, dict):
                 default = True
                 if len(field_mask) > 0:
-                    default = not field_mask[field_mask.keys[0]]
+                    default = not (field_mask[list(field_mask.keys())[0]])
                 field_mask = defaultdict(lambda : default, field_mask)
             elif isinstance(field_mask, (list, tuple)):
                 field_mask = defaultdict(lambda : False, { field : True for field in field_mask} )
@@ -242,20 +357,32 @@ class Store:
                 # fields. If they all had shared indexing, they should be in a
                 # table... Maybe should emit a warning? Or allow them to be
                 # dicts keyed by field name?
-                obj_dict[field], _ = self.read_object(name+'/'+field, 
-                                                      h5f, 
-                                                      start_row=start_row, 
-                                                      n_rows=n_rows, 
-                                                      idx=idx,
-                                                      verbosity=verbosity)
+                fld_buf = None if obj_buf is None else obj_buf.get(field)
+                obj_dict[field], n_rows_read = self.read_object(name+'/'+field, 
+                                                                h5f, 
+                                                                start_row=start_row, 
+                                                                n_rows=n_rows, 
+                                                                idx=idx,
+                                                                obj_buf=fld_buf,
+                                                                verbosity=verbosity)
+                # array buffers only ever grow: trim them to what was read so
+                # that the struct holds the same data as a fresh read would
+                fld = obj_dict[field]
+                if fld is fld_buf and type(fld) in [Array, FixedSizeArray, ArrayOfEqualSizedArrays]:
+                    if len(fld) != n_rows_read: fld.resize(n_rows_read)
             # modify datatype in attrs if a field_mask was used
-            attrs = dict(h5f[name].attrs)
+            attrs = dict(attrs)
             if field_mask is not None:
                 selected_fields = []
                 for field in elements:
                     if field_mask[field]: selected_fields.append(field)
                 attrs['datatype'] =  'struct' + '{' + ','.join(selected_fields) + '}'
-            return Struct(obj_dict=obj_dict, attrs=attrs), 1
+            if obj_buf is None: return Struct(obj_dict=obj_dict, attrs=attrs), 1
+            for field, fld in obj_dict.items():
+                if obj_buf.get(field) is not fld: obj_buf[field] = fld
+            obj_buf.attrs.update(attrs)
+            obj_buf.update_datatype()
+            return obj_buf, 1
 
         # Below here is all array-like types. So trim idx if needed
         if idx is not None:
@@ -313,7 +440,7 @@ class Store:
                     print(n_rows_read, 'was expected')
 
             # modify datatype in attrs if a field_mask was used
-            attrs = dict(h5f[name].attrs)
+            attrs = dict(attrs)
             if field_mask is not None:
                 selected_fields = []
                 for field in elements:
@@ -380,7 +507,7 @@ class Store:
                     print(this_cumulen_nda[-1], da_start, start_row, n_rows_read)
 
             # determine the number of rows for the flattened_data readout
-            da_nrows = this_cumulen_nda[-1] if n_rows_read > 0 else 0
+            da_nrows = this_cumulen_nda[-1] - da_start if n_rows_read > 0 else 0
 
             # Now done with this_cumulen_nda, so we can clean it up to be ready
             # to match the in-memory version of flattened_data. Note: these
@@ -419,7 +546,7 @@ class Store:
             if obj_buf is not None: return obj_buf, n_rows_read
             return VectorOfVectors(flattened_data=flattened_data, 
                                    cumulative_length=cumulative_length, 
-                                   attrs=h5f[name].attrs), n_rows_read
+                                   attrs=attrs), n_rows_read
 
 
         # Array
@@ -435,7 +562,7 @@ class Store:
             # compute the number of rows to read
             # we culled idx above for start_row and n_rows, now we have to apply
             # the constraint of the length of the dataset
-            ds_n_rows = h5f[name].shape[0]
+            ds_n_rows = info['ds_shape'][0]
             if idx is not None:
                 if len(idx[0]) > 0 and idx[0][-1] >= ds_n_rows:
                     print("warning: idx indexed past the end of the array in the file. Culling...")
@@ -458,18 +585,19 @@ class Store:
                 # NOTE: if your script fails on this line, it may be because you
                 # have to apply this patch to h5py (or update h5py, if it's
                 # fixed): https://github.com/h5py/h5py/issues/1792
-                h5f[name].read_direct(obj_buf.nda, source_sel, dest_sel)
+                # bools are stored as uint8: read them into a uint8 view
+                dest = obj_buf.nda.view(np.uint8) if obj_buf.nda.dtype == bool else obj_buf.nda
+                h5f[name].read_direct(dest, source_sel, dest_sel)
             else: 
                 if n_rows == 0: 
-                    tmp_shape = (0,) + h5f[name].shape[1:]
-                    nda = np.empty(tmp_shape, h5f[name].dtype)
+                    tmp_shape = (0,) + info['ds_shape'][1:]
+                    nda = np.empty(tmp_shape, info['dtype'])
                 else: nda = h5f[name][source_sel]
 
             # special handling for bools
-            if elements == 'bool': nda = nda.astype(np.bool)
+            if obj_buf is None and elements == 'bool': nda = nda.astype(np.bool_)
 
-            # Finally, set attributes and return objects
-            attrs=h5f[name].attrs
+            # Finally, return objects
             if obj_buf is None:
                 if datatype == 'array': 
                     return Array(nda=nda, attrs=attrs), n_rows_to_read
@@ -500,7 +628,17 @@ class Store:
         axis 0 (the first dimension) (or axis 0 of non-scalar subfields of
         structs)
         """
+        # amortized appends of structs/tables reuse the datasets resolved in
+        # the previous write to the same location
+        plan_key = None
+        if (self.amortize_appends and append and isinstance(obj, Struct) 
+            and isinstance(lh5_file, str) and isinstance(group, str)):
+            plan_key = (lh5_file, group, name)
+            plan = self.append_plans.get(plan_key)
+            if plan is not None and self.run_append_plan(plan, obj, start_row, n_rows): return
+
         lh5_file = self.gimme_file(lh5_file, mode = 'a' if append else 'r+')
+        self.obj_info.pop(lh5_file.filename, None)
         group = self.gimme_group(group, lh5_file)
 
         # FIXME: fail if trying to overwrite an existing object without appending?
@@ -519,6 +657,8 @@ class Store:
                                   start_row=start_row,
                                   n_rows=n_rows,
                                   append=append)
+            if plan_key is not None:
+                self.append_plans[plan_key] = self.make_append_plan(obj, group)
             return
 
         # scalars
@@ -531,30 +671,28 @@ class Store:
         # vector of vectors
         elif isinstance(obj, VectorOfVectors):
             group = self.gimme_group(name, group, grp_attrs=obj.attrs)
-            if n_rows is None or n_rows > obj.cumulative_length.nda.shape[0] - start_row:
-                n_rows = obj.cumulative_length.nda.shape[0] - start_row
+            cl_nda = obj.cumulative_length.nda
+            if n_rows is None or n_rows > cl_nda.shape[0] - start_row:
+                n_rows = cl_nda.shape[0] - start_row
 
             # if appending we need to add an appropriate offset to the
-            # cumulative lengths as appropriate for the in-file object
+            # cumulative lengths as appropriate for the in-file object. With
+            # amortized appends, the last in-file value is cached so it only
+            # gets read from disk the first time we append to an existing
+            # object (such a Store is assumed to be the file's only writer)
+            cl_key = (lh5_file.filename, group.name)
             offset = 0
             if append and 'cumulative_length' in group:
-                len_cl = len(group['cumulative_length']) 
-                if len_cl > 0: offset = group['cumulative_length'][len_cl-1]
-            # Add offset to obj.cumulative_length itself to avoid memory allocation. 
-            # Then subtract it off after writing!
-            obj.cumulative_length.nda += offset
-            self.write_object(obj.cumulative_length,
-                              'cumulative_length', 
-                              lh5_file, 
-                              group, 
-                              start_row=start_row,
-                              n_rows=n_rows,
-                              append=append)
-            obj.cumulative_length.nda -= offset
-
-            # now write data array. Only write rows with data.
-            da_start = 0 if start_row == 0 else obj.cumulative_length.nda[start_row-1]
-            da_n_rows = obj.cumulative_length.nda[n_rows-1] - da_start
+                if self.amortize_appends and cl_key in self.cl_offsets: 
+                    offset = self.cl_offsets[cl_key]
+                else:
+                    len_cl = self.get_ds_len(group['cumulative_length'])
+                    if len_cl > 0: offset = group['cumulative_length'][len_cl-1]
+
+            # write the data array first so that SWMR readers never see
+            # lengths pointing past the data. Only write rows with data.
+            da_start = 0 if start_row == 0 else cl_nda[start_row-1]
+            da_n_rows = 0 if n_rows == 0 else cl_nda[start_row+n_rows-1] - da_start
             self.write_object(obj.flattened_data,
                               'flattened_data', 
                               lh5_file, 
@@ -562,6 +700,18 @@ class Store:
                               start_row=da_start,
                               n_rows=da_n_rows,
                               append=append)
+
+            # Add the offset into a scratch buffer rather than into
+            # obj.cumulative_length itself, so that obj is never modified
+            if len(self.cl_buf) < n_rows or self.cl_buf.dtype != cl_nda.dtype:
+                self.cl_buf = np.empty(2*n_rows, dtype=cl_nda.dtype)
+            cl_out = self.cl_buf[:n_rows]
+            np.add(cl_nda[start_row:start_row+n_rows], offset, out=cl_out, casting='unsafe')
+            self.write_nda(cl_out, 'cumulative_length', group, 
+                           obj.cumulative_length.attrs, append=append)
+            if self.amortize_appends:
+                if n_rows > 0: self.cl_offsets[cl_key] = int(cl_out[-1])
+                elif cl_key not in self.cl_offsets: self.cl_offsets[cl_key] = int(offset)
             return
 
         # if we get this far, must be one of the Array types
@@ -569,23 +719,7 @@ class Store:
             if n_rows is None or n_rows > obj.nda.shape[0] - start_row:
                 n_rows = obj.nda.shape[0] - start_row
             nda = obj.nda[start_row:start_row+n_rows]
-            if nda.dtype.name == 'bool': nda = nda.astype(np.uint8)
-            # need to create dataset from ndarray the first time for speed
-            # creating an empty dataset and appending to that is super slow!
-            if not append or name not in group:
-                maxshape = list(nda.shape)
-                maxshape[0] = None
-                maxshape = tuple(maxshape)
-                ds = group.create_dataset(name, data=nda, maxshape=maxshape)
-                ds.attrs.update(obj.attrs)
-                return
-            
-            # Now append
-            ds = group[name]
-            old_len = ds.shape[0]
-            add_len = nda.shape[0]
-            ds.resize(old_len + add_len, axis=0)
-            ds[-add_len:] = nda
+            self.write_nda(nda, name, group, obj.attrs, append=append)
             return
 
         else:
@@ -593,21 +727,191 @@ class Store:
             return
 
 
+    def write_nda(self, nda, name, group, attrs, append=True):
+        """Write (or append) ndarray nda to dataset name in h5py group 
+
+        Used by write_object() for all array-like data. If this Store was
+        made with amortize_appends, the extent of appended datasets grows
+        geometrically so that most appends need no resize. The number of rows
+        actually written is then tracked in the Store (see get_ds_len()), and
+        the datasets are trimmed to it by close().
+        """
+        if nda.dtype.name == 'bool': nda = nda.astype(np.uint8)
+        # need to create dataset from ndarray the first time for speed
+        # creating an empty dataset and appending to that is super slow!
+        if not append or name not in group:
+            maxshape = list(nda.shape)
+            maxshape[0] = None
+            maxshape = tuple(maxshape)
+            ds = group.create_dataset(name, data=nda, maxshape=maxshape)
+            ds.attrs.update(attrs)
+            if self.amortize_appends:
+                self.ds_lens[(group.file.filename, ds.name)] = [nda.shape[0]]*2
+            return
+
+        # Now append
+        ds = group[name]
+        if not self.amortize_appends:
+            old_len = ds.shape[0]
+            ds.resize(old_len + nda.shape[0], axis=0)
+            ds[old_len:] = nda
+            if self.swmr: self.flush(force=False)
+            return
+        ds_key = (group.file.filename, ds.name)
+        if ds_key not in self.ds_lens: self.ds_lens[ds_key] = [ds.shape[0]]*2
+        self.append_rows(ds, ds_key, nda)
+
+
+    def append_rows(self, ds, ds_key, nda):
+        """Amortized append of nda to h5py dataset ds
+
+        ds_key is the key of ds in self.ds_lens, which holds the number of
+        rows written and allocated for ds. When the dataset is full, its
+        extent is (at least) doubled.
+        """
+        if nda.dtype.name == 'bool': nda = nda.astype(np.uint8)
+        ds_len = self.ds_lens[ds_key]
+        old_len = ds_len[0]
+        new_len = old_len + nda.shape[0]
+        if new_len > ds_len[1]:
+            ds_len[1] = max(new_len, 2*ds_len[1])
+            ds.resize(ds_len[1], axis=0)
+        if new_len > old_len: ds[old_len:new_len] = nda
+        ds_len[0] = new_len
+
+
+    def get_ds_len(self, ds):
+        """Get the number of rows written to h5py dataset ds
+
+        This is ds.shape[0] unless the dataset was over-allocated by an
+        amortized append (see write_nda())
+        """
+        ds_len = self.ds_lens.get((ds.file.filename, ds.name))
+        return ds.shape[0] if ds_len is None else ds_len[0]
+
+
+    def make_append_plan(self, obj, group):
+        """Resolve the datasets for all array-like fields of struct obj once
+
+        Amortized appends of a table to the same location reuse the plan (see
+        run_append_plan()), so that all columns get appended in one pass
+        without any HDF5 group look-ups. Returns None if obj contains
+        something other than (nested) structs, vectors of vectors and arrays,
+        or no arrays at all.
+        """
+        filename = group.file.filename
+        entries = []
+        # walk nested structs with a stack rather than a recursive closure:
+        # the closure would form a reference cycle keeping the datasets (and
+        # so the file) open until the next garbage collection
+        stack = [(obj, group, ())]
+        while len(stack) > 0:
+            obj_i, group_i, path = stack.pop()
+            for field, fld in obj_i.items():
+                if isinstance(fld, Struct): 
+                    stack.append((fld, group_i[field], path+(field,)))
+                elif isinstance(fld, VectorOfVectors):
+                    fld_grp = group_i[field]
+                    cl_ds = fld_grp['cumulative_length']
+                    fd_ds = fld_grp['flattened_data']
+                    entries.append((path+(field,), cl_ds, (filename, cl_ds.name), 
+                                    fd_ds, (filename, fd_ds.name), (filename, fld_grp.name)))
+                elif isinstance(fld, Array):
+                    ds = group_i[field]
+                    entries.append((path+(field,), ds, (filename, ds.name)))
+                else: return None
+        if len(entries) == 0: return None
+        for entry in entries:
+            for ds, ds_key in zip(entry[1::2], entry[2::2]):
+                if ds_key not in self.ds_lens: self.ds_lens[ds_key] = [ds.shape[0]]*2
+        return { 'filename' : filename, 'sig' : struct_signature(obj), 'entries' : entries }
+
+
+    def run_append_plan(self, plan, obj, start_row=0, n_rows=None):
+        """Append struct obj using a plan from make_append_plan()
+
+        Returns False (without writing anything) if the plan doesn't match obj
+        or its file was closed, in which case write_object() has to take the
+        normal path.
+        """
+        if not plan['entries'][0][1].id.valid: return False
+        if struct_signature(obj) != plan['sig']: return False
+        self.obj_info.pop(plan['filename'], None)
+
+        for entry in plan['entries']:
+            fld = obj
+            for field in entry[0]: fld = fld[field]
+            if len(entry) == 3:
+                nda = fld.nda
+                n = nda.shape[0] - start_row
+                if n_rows is not None and n_rows < n: n = n_rows
+                self.append_rows(entry[1], entry[2], nda[start_row:start_row+n])
+                continue
+
+            # vector of vectors
+            path, cl_ds, cl_key, fd_ds, fd_key, offset_key = entry
+            cl_nda = fld.cumulative_length.nda
+            n = cl_nda.shape[0] - start_row
+            if n_rows is not None and n_rows < n: n = n_rows
+            if n <= 0: continue
+            da_start = 0 if start_row == 0 else cl_nda[start_row-1]
+            da_stop = cl_nda[start_row+n-1]
+            self.append_rows(fd_ds, fd_key, fld.flattened_data.nda[da_start:da_stop])
+            offset = self.cl_offsets[offset_key]
+            if len(self.cl_buf) < n or self.cl_buf.dtype != cl_nda.dtype:
+                self.cl_buf = np.empty(2*n, dtype=cl_nda.dtype)
+            cl_out = self.cl_buf[:n]
+            np.add(cl_nda[start_row:start_row+n], offset, out=cl_out, casting='unsafe')
+            self.append_rows(cl_ds, cl_key, cl_out)
+            self.cl_offsets[offset_key] = int(cl_out[-1])
+        return True
+
+
+    def close(self):
+        """Trim datasets over-allocated by amortized appends to their actual
+        length, then close any files kept open by this Store.
+
+        Must be called after the last write_object() call when amortize_appends
+        is used, otherwise the files will contain uninitialized rows at the end
+        of the appended datasets.
+        """
+        # group by file to open each file only once
+        ds_lens = defaultdict(dict)
+        for (filename, ds_name), ds_len in self.ds_lens.items():
+            ds_lens[filename][ds_name] = ds_len
+        for filename, file_ds_lens in ds_lens.items():
+            h5f = None
+            for h5f_i in self.files.values():
+                if h5f_i and h5f_i.filename == filename: h5f = h5f_i
+            if h5f is None: h5f = h5py.File(filename, 'a')
+            for ds_name, ds_len in file_ds_lens.items():
+                ds = h5f[ds_name]
+                if ds.shape[0] != ds_len[0]: ds.resize(ds_len[0], axis=0)
+            if h5f not in self.files.values(): h5f.close()
+        self.ds_lens.clear()
+        self.cl_offsets.clear()
+        self.append_plans.clear()
+        self.obj_info.clear()
+        for h5f in self.files.values(): 
+            if h5f: h5f.close()
+        self.files.clear()
+
+
     def read_n_rows(self, name, lh5_file):
         """Look up the number of rows in an Array-like object called name
         in lh5_file. Return None if it is a scalar/struct."""
         # this is basically a stripped down version of read_object
         h5f = self.gimme_file(lh5_file, 'r')
-        if name not in h5f:
+        info = self.get_obj_info(name, h5f)
+        if info is None:
             print('Store:', name, "not in", lh5_file)
             return None
 
         # get the datatype
-        if 'datatype' not in h5f[name].attrs:
+        if info['datatype'] is None:
             print('Store:', name, 'in file', lh5_file, 'is missing the datatype attribute')
             return None, 0
-        datatype = h5f[name].attrs['datatype']
-        datatype, shape, elements = parse_datatype(datatype)
+        datatype, shape, elements = info['datatype'], info['shape'], info['elements']
 
         # scalars are dim-0 datasets
         if datatype == 'scalar': 
@@ -638,18 +942,29 @@ class Store:
         # read out all arrays by slicing
         if 'array' in datatype:
             # compute the number of rows to read
-            return h5f[name].shape[0]
+            return info['ds_shape'][0]
 
         print('Store: don\'t know how to read datatype', datatype)
         return None
 
 
-def load_nda(f_list, par_list, lh5_group='', idx_list=None, verbose=True):
+def struct_signature(obj):
+    """Nested tuple of the field names (and VectorOfVectors markers) of a struct"""
+    return tuple((field, struct_signature(fld) if isinstance(fld, Struct) 
+                  else isinstance(fld, VectorOfVectors)) for field, fld in obj.items())
+
+
+def load_nda(f_list, par_list, lh5_group='', idx_list=None, verbose=True, n_threads=1):
     """ Build a dictionary of ndarrays from lh5 data
 
     Given a list of files, a list of lh5 table parameters, and an optional group
     path, return a numpy array with all values for each parameter.
 
+    The read is done in two passes: first the number of rows to be read from
+    each file is summed up and a single output array is allocated for each
+    parameter, then each file is read directly into its slice of the output
+    arrays. Peak memory use is therefore just the size of the returned data.
+
     Parameters
     ----------
     f_list : str or list of str's
@@ -662,13 +977,18 @@ def load_nda(f_list, par_list, lh5_group='', idx_list=None, verbose=True):
         For fancy-indexed reads. Must be one idx array for each file in f_list
     verbose : bool
         Print info on loaded data
+    n_threads : int (optional)
+        Number of threads used to read the files in parallel. Each file is
+        read into a disjoint slice of the output arrays, so no locking is
+        needed on our side (h5py serializes the actual HDF5 calls).
 
     Returns
     -------
     par_data : dict
         A dictionary of the parameter data keyed by the elements of par_list.
         Each entry contains the data for the specified parameter concatenated
-        over all files in f_list
+        over all files in f_list. The parameters are concatenated
+        independently, so they need not have the same number of rows
     """
     if isinstance(f_list, str): 
         f_list = [f_list]
@@ -682,24 +1002,64 @@ def load_nda(f_list, par_list, lh5_group='', idx_list=None, verbose=True):
     f_list = [f for f_wc in f_list for f in sorted(glob.glob(os.path.expandvars(f_wc)))]
     if verbose:
         print("loading data for", *f_list)
+    if len(f_list) == 0:
+        print("load_nda: no files found")
+        return None
 
+    # first pass: count the rows to be read from each file
     sto = Store()
-    par_data = {par : [] for par in par_list}
+    n_rows_list = []
+    par_bufs = {}
     for ii, f in enumerate(f_list):
-        f = sto.gimme_file(f, 'r')
+        h5f = sto.gimme_file(f, 'r')
+        n_rows_f = {}
         for par in par_list:
-            if f'{lh5_group}/{par}' not in f:
-                print(f'{lh5_group}/{par} not in file {f_list[ii]}')
+            name = f'{lh5_group}/{par}'
+            if name not in h5f:
+                print(f'{name} not in file {f_list[ii]}')
+                h5f.close()
                 return None
-            if idx_list is None: data, _ = sto.read_object(f'{lh5_group}/{par}', f)
-            else: data, _ = sto.read_object(f'{lh5_group}/{par}', f, idx=idx_list[ii])
-            if not data: continue
-            par_data[par].append(data.nda)
-    par_data = {par : np.concatenate(par_data[par]) for par in par_list}
+            n_rows_par = sto.read_n_rows(name, h5f)
+            if idx_list is not None:
+                idx = idx_list[ii]
+                if isinstance(idx, tuple): idx = idx[0]
+                # read_object culls indices past the end of the dataset
+                n_rows_par = bisect_left(idx, n_rows_par)
+            n_rows_f[par] = 0 if n_rows_par is None else n_rows_par
+            # get a correctly-typed buffer from the first file
+            if par not in par_bufs: par_bufs[par] = sto.get_buffer(name, h5f)
+        n_rows_list.append(n_rows_f)
+        h5f.close()
+
+    # allocate the output arrays once. Each parameter is concatenated over
+    # the files on its own, so parameters may have different lengths
+    start_rows = {}
+    for par, buf in par_bufs.items():
+        start_rows[par] = np.cumsum([0] + [n_rows_f[par] for n_rows_f in n_rows_list])
+        buf.resize(int(start_rows[par][-1]))
+
+    # second pass: read each file into its slice of the output
+    def read_file(ii):
+        with h5py.File(f_list[ii], 'r') as h5f:
+            idx = None if idx_list is None else idx_list[ii]
+            for par, buf in par_bufs.items():
+                sto.read_object(f'{lh5_group}/{par}', h5f, idx=idx, 
+                                n_rows=n_rows_list[ii][par], obj_buf=buf, 
+                                obj_buf_start=int(start_rows[par][ii]))
+
+    if n_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # list() re-raises any exception from the workers
+            list(executor.map(read_file, range(len(f_list))))
+    else:
+        for ii in range(len(f_list)): read_file(ii)
+
+    par_data = {par : par_bufs[par].nda for par in par_list}
     return par_data
 
 
-def load_dfs(f_list, par_list, lh5_group='', idx_list=None, verbose=True):
+def load_dfs(f_list, par_list, lh5_group='', idx_list=None, verbose=True, n_threads=1):
     """ Build a pandas dataframe from lh5 data
 
     Given a list of files (can use wildcards), a list of lh5 columns, and
@@ -716,4 +1076,69 @@ def load_dfs(f_list, par_list, lh5_group='', idx_list=None, verbose=True):
         Contains columns for each parameter in par_list, and rows containing all
         data for the associated parameters concatenated over all files in f_list
     """
-    return pd.DataFrame( load_nda(f_list, par_list, lh5_group=lh5_group, idx_list=idx_list, verbose=verbose) )
+    return pd.DataFrame( load_nda(f_list, par_list, lh5_group=lh5_group, idx_list=idx_list, verbose=verbose, n_threads=n_threads) )
+
+
+def lh5_to_parquet(f_list, lh5_table, parquet_file, buffer_len=3200, field_mask=None, verbose=True):
+    """ Convert an lh5 table to a Parquet file
+
+    The table is streamed through a single pre-allocated buffer in chunks of
+    buffer_len rows, and each chunk is handed to the Parquet writer as a
+    zero-copy Arrow view (see Table.to_arrow()), so memory use is bounded by
+    the buffer size. Requires pyarrow.
+
+    Parameters
+    ----------
+    f_list : str or list of str's
+        The file(s) containing the table. Can contain wildcards. Tables from
+        multiple files are concatenated in the output
+    lh5_table : str
+        Name of the table (including its group path)
+    parquet_file : str
+        Name of the output file
+    buffer_len : int (optional)
+        Number of rows to read and write at a time
+    field_mask : dict or list (optional)
+        Select the columns to be converted. See Store.read_object()
+    verbose : bool
+        Print info on converted data
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows written to parquet_file
+    """
+    import pyarrow.parquet as pq
+
+    if isinstance(f_list, str): f_list = [f_list]
+    f_list = [f for f_wc in f_list for f in sorted(glob.glob(os.path.expandvars(f_wc)))]
+    if verbose:
+        print("converting", lh5_table, "in", *f_list, "to", parquet_file)
+
+    sto = Store()
+    tbl_buf = None
+    writer = None
+    n_rows = 0
+    try:
+        for f in f_list:
+            h5f = sto.gimme_file(f, 'r')
+            n_rows_f = sto.read_n_rows(lh5_table, h5f)
+            if n_rows_f is None:
+                print('lh5_to_parquet: could not read', lh5_table, 'from', f)
+                return n_rows
+            for start_row in range(0, n_rows_f, buffer_len):
+                tbl_buf, n_rows_read = sto.read_object(lh5_table, h5f, 
+                                                       start_row=start_row, 
+                                                       n_rows=buffer_len, 
+                                                       field_mask=field_mask, 
+                                                       obj_buf=tbl_buf)
+                pa_tbl = tbl_buf.to_arrow(n_rows=n_rows_read)
+                if writer is None: writer = pq.ParquetWriter(parquet_file, pa_tbl.schema)
+                writer.write_table(pa_tbl)
+                # release the view, otherwise tbl_buf can't be resized
+                del pa_tbl
+                n_rows += n_rows_read
+            h5f.close()
+    finally:
+        if writer is not None: writer.close()
+    return n_rows
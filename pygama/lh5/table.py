@@ -111,3 +111,29 @@ class Table(Struct):
                 df[col] = self[col].nda
         return df
 
+
+
+    def to_arrow(self, *cols, n_rows=None):
+        """Get a pyarrow Table containing each of the columns given. If no
+        columns are given, include all fields as columns. If n_rows is given,
+        only the first n_rows rows are included (e.g. after a short read into
+        a buffer).
+
+        Array-like columns are wrapped without copying their data (see
+        Array.to_arrow() and VectorOfVectors.to_arrow()), and sub-tables (e.g.
+        waveforms) become struct columns. Note: numpy won't resize the
+        underlying arrays while the view is alive. Requires pyarrow.
+        """
+        import pyarrow as pa
+        if len(cols) == 0: cols = self.keys()
+        arrays = [self._col_to_arrow(self[col], n_rows) for col in cols]
+        return pa.Table.from_arrays(arrays, names=list(cols))
+
+
+    @staticmethod
+    def _col_to_arrow(obj, n_rows=None):
+        if isinstance(obj, Table):
+            import pyarrow as pa
+            arrays = [Table._col_to_arrow(fld, n_rows) for fld in obj.values()]
+            return pa.StructArray.from_arrays(arrays, names=list(obj.keys()))
+        return obj.to_arrow(n_rows)
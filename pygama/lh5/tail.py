@@ -0,0 +1,95 @@
+import os, time
+import h5py
+
+from .store import Store
+
+
+def tail_object(name, lh5_file, buffer_len=3200, field_mask=None, start_row=0,
+                poll_interval=1., timeout=10., verbose=False):
+    """Read the rows of an array-like lh5 object as they are appended
+
+    Generator for following a file that is being written by a Store in SWMR
+    mode (see Store.start_swmr()), e.g. for data quality monitoring while
+    daq_to_raw is running. The extents of the object's datasets are polled
+    every poll_interval seconds and only new rows are read, in chunks of up to
+    buffer_len rows. For tables, a row is only read once it has been written
+    to all columns.
+
+    Parameters
+    ----------
+    name : str
+        Name of the table or array to be read (including its group path)
+    lh5_file : str
+        The file being written. It is waited for if it does not exist or is
+        not yet in SWMR mode
+    buffer_len : int (optional)
+        Maximum number of rows yielded at a time
+    field_mask : dict or list (optional)
+        See Store.read_object()
+    start_row : int (optional)
+        First row to be read. Use e.g. the number of rows already read from a
+        previous call to resume
+    poll_interval : float (optional)
+        Time in seconds to wait between polls for new rows
+    timeout : float or None (optional)
+        Stop after no new rows have arrived for this many seconds. If None,
+        never stop
+    verbose : bool (optional)
+        Print info on the rows being read
+
+    Yields
+    ------
+    (obj_buf, n_rows) : tuple
+        The buffer holding the new rows and the number of new rows. The same
+        buffer is reused for every chunk, so process it before the next
+        iteration
+    """
+    lh5_file = os.path.expandvars(lh5_file)
+    last_new = time.monotonic()
+
+    # wait for the writer to put the file in SWMR mode
+    h5f = None
+    while h5f is None:
+        try: h5f = h5py.File(lh5_file, 'r', libver='latest', swmr=True)
+        except OSError:
+            if timeout is not None and time.monotonic() - last_new > timeout:
+                print('tail_object: could not open', lh5_file, 'in SWMR mode')
+                return
+            time.sleep(poll_interval)
+
+    try:
+        if name not in h5f:
+            print('tail_object:', name, 'not in', lh5_file)
+            return
+        # the datasets holding one entry per row: everything but scalars and
+        # the flattened_data of vectors of vectors, which are written first
+        leaves = []
+        def add_leaf(path, obj):
+            if (isinstance(obj, h5py.Dataset) and obj.ndim > 0
+                and path.split('/')[-1] != 'flattened_data'): leaves.append(obj)
+        if isinstance(h5f[name], h5py.Dataset): add_leaf(name, h5f[name])
+        else: h5f[name].visititems(add_leaf)
+        if len(leaves) == 0:
+            print('tail_object:', name, 'has no array-like data')
+            return
+
+        store = Store()
+        obj_buf = None
+        while True:
+            for ds in leaves: ds.refresh()
+            n_avail = min(ds.shape[0] for ds in leaves)
+            if n_avail > start_row:
+                # dataset extents changed: don't use cached metadata
+                store.clear_cache(h5f)
+                n_rows = min(buffer_len, n_avail - start_row)
+                obj_buf, n_rows = store.read_object(name, h5f, start_row=start_row, n_rows=n_rows,
+                                                    field_mask=field_mask, obj_buf=obj_buf)
+                if verbose: print('tail_object: read rows', start_row, 'to', start_row+n_rows)
+                start_row += n_rows
+                last_new = time.monotonic()
+                yield obj_buf, n_rows
+                continue
+            if timeout is not None and time.monotonic() - last_new > timeout: return
+            time.sleep(poll_interval)
+    finally:
+        h5f.close()
@@ -78,7 +78,9 @@ class VectorOfVectors:
     def set_vector(self, i_vec, nda):
         """Insert vector nda at location i_vec.
 
-        self.flattened_data is doubled in length until nda can be appended to it.
+        If nda doesn't fit, self.flattened_data is reallocated with at least
+        twice its length, so that appending vectors one at a time takes
+        amortized constant time per element.
         """
         if i_vec<0 or i_vec>len(self.cumulative_length.nda)-1:
             print('VectorOfVectors: Error: bad i_vec', i_vec)
@@ -88,7 +90,39 @@ class VectorOfVectors:
             return
         start = 0 if i_vec == 0 else self.cumulative_length.nda[i_vec-1]
         end = start + len(nda)
-        while end >= len(self.flattened_data.nda):
-            self.flattened_data.nda.resize(2*len(self.flattened_data.nda))
+        if end > len(self.flattened_data.nda): self.reserve(end)
         self.flattened_data.nda[start:end] = nda
         self.cumulative_length.nda[i_vec] = end
+
+
+    def reserve(self, n_data):
+        """Make room for at least n_data values in self.flattened_data,
+        growing it geometrically in one step. The values are copied into a
+        new array, so that views of the old one stay valid"""
+        old_nda = self.flattened_data.nda
+        if n_data <= len(old_nda): return
+        new_nda = np.empty(max(n_data, 2*len(old_nda)), dtype=old_nda.dtype)
+        new_nda[:len(old_nda)] = old_nda
+        self.flattened_data.nda = new_nda
+
+
+    def to_arrow(self, n_rows=None):
+        """Get a pyarrow ListArray view of this vector of vectors (of its first
+        n_rows vectors, if given)
+
+        cumulative_length provides the list offsets and flattened_data the
+        values. The values are not copied, but the offsets need a leading 0
+        so a new (n+1)-length offsets array is made. Requires pyarrow.
+        """
+        import pyarrow as pa
+        cl = self.cumulative_length.nda[:n_rows]
+        n_data = int(cl[-1]) if len(cl) > 0 else 0
+        values = Array(nda=self.flattened_data.nda[:n_data]).to_arrow()
+        # use 64-bit offsets only if needed
+        if n_data < 2**31:
+            offsets = np.zeros(len(cl)+1, dtype='int32')
+            offsets[1:] = cl
+            return pa.ListArray.from_arrays(pa.array(offsets), values)
+        offsets = np.zeros(len(cl)+1, dtype='int64')
+        offsets[1:] = cl
+        return pa.LargeListArray.from_arrays(pa.array(offsets), values)
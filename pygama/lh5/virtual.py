@@ -0,0 +1,152 @@
+import os, glob
+import numpy as np
+import h5py
+
+from .lh5_utils import parse_datatype
+
+
+def build_virtual_file(f_list, vds_file, lh5_objects, overwrite=True, verbose=False):
+    """Write an lh5 file whose objects concatenate those in a list of files
+
+    The array-like datasets of the output file are HDF5 virtual datasets
+    (VDS) mapping onto the datasets in each file in f_list, so that e.g. all
+    cycle files of a run can be read as a single table with a single open and
+    native hyperslab reads. No array data are copied, except for the
+    cumulative_length of VectorOfVectors, which has to be offset for each
+    file and so is materialized. Scalars are copied from the first file.
+
+    Source files are referenced relative to the directory of vds_file, so the
+    files can be moved around together.
+
+    Parameters
+    ----------
+    f_list : str or list of str's
+        The files to be concatenated, in order. Can contain wildcards
+    vds_file : str
+        Name of the output file
+    lh5_objects : str or list of str's
+        Names (including their group path) of the lh5 objects to be
+        concatenated. Must be present with the same structure in each file
+    overwrite : bool (optional)
+        If False, fail if vds_file already exists
+    verbose : bool (optional)
+        Print info on the objects being mapped
+
+    Returns
+    -------
+    n_rows : dict or None
+        The number of rows of each object in lh5_objects (None for scalars
+        and structs), or None if something went wrong
+    """
+    if isinstance(f_list, str): f_list = [f_list]
+    f_list = [f for f_wc in f_list for f in sorted(glob.glob(os.path.expandvars(f_wc)))]
+    if len(f_list) == 0:
+        print('build_virtual_file: no files found')
+        return None
+    if isinstance(lh5_objects, str): lh5_objects = [lh5_objects]
+
+    if os.path.exists(vds_file):
+        if not overwrite:
+            print('build_virtual_file:', vds_file, 'already exists')
+            return None
+        os.remove(vds_file)
+    vds_dir = os.path.dirname(os.path.abspath(vds_file))
+    if not os.path.exists(vds_dir): os.makedirs(vds_dir)
+    src_paths = [os.path.relpath(os.path.abspath(f), vds_dir) for f in f_list]
+
+    n_rows = {}
+    h5fs = [h5py.File(f, 'r') for f in f_list]
+    try:
+        with h5py.File(vds_file, 'w') as vds:
+            for name in lh5_objects:
+                for f, h5f in zip(f_list, h5fs):
+                    if name not in h5f:
+                        print('build_virtual_file:', name, 'not in', f)
+                        return None
+                if verbose: print('mapping', name, 'from', len(f_list), 'files')
+                n_rows[name] = _map_object(name, h5fs, src_paths, vds)
+    finally:
+        for h5f in h5fs: h5f.close()
+
+    return n_rows
+
+
+def _map_object(name, h5fs, src_paths, vds):
+    """Recursively map object name in h5fs into vds. Returns n_rows"""
+    attrs = h5fs[0][name].attrs
+    if 'datatype' not in attrs:
+        print('build_virtual_file:', name, 'is missing the datatype attribute')
+        return None
+    datatype, shape, elements = parse_datatype(attrs['datatype'])
+
+    # scalars: just copy from the first file
+    if datatype == 'scalar':
+        ds = vds.create_dataset(name, data=h5fs[0][name][()])
+        ds.attrs.update(attrs)
+        return None
+
+    # structs and tables: map each field
+    if datatype in ['struct', 'table']:
+        grp = vds.require_group(name)
+        grp.attrs.update(attrs)
+        rows = [_map_object(name+'/'+field, h5fs, src_paths, vds) for field in elements]
+        if datatype == 'struct': return None
+        if len(set(rows)) > 1:
+            print('build_virtual_file: table', name, 'has fields of different lengths:', rows)
+        return rows[0] if len(rows) > 0 else 0
+
+    # vector of vectors: flattened_data is virtual, cumulative_length gets
+    # materialized with the offset for each file added in
+    if elements.startswith('array'):
+        grp = vds.require_group(name)
+        grp.attrs.update(attrs)
+        _map_array(name+'/flattened_data', h5fs, src_paths, vds)
+        cl_name = name+'/cumulative_length'
+        cl_lens = [h5f[cl_name].shape[0] for h5f in h5fs]
+        cl_ds = vds.create_dataset(cl_name, shape=(sum(cl_lens),),
+                                   dtype=h5fs[0][cl_name].dtype, maxshape=(None,))
+        cl_ds.attrs.update(h5fs[0][cl_name].attrs)
+        start = 0
+        offset = 0
+        for h5f, cl_len in zip(h5fs, cl_lens):
+            if cl_len == 0: continue
+            cl = h5f[cl_name][()]
+            cl_ds[start:start+cl_len] = cl + offset
+            start += cl_len
+            # use the actual data length, in case it differs from cl[-1]
+            offset += h5f[name+'/flattened_data'].shape[0]
+        return start
+
+    # all other arrays
+    if 'array' in datatype: return _map_array(name, h5fs, src_paths, vds)
+
+    print('build_virtual_file: don\'t know how to map datatype', datatype)
+    return None
+
+
+def _map_array(name, h5fs, src_paths, vds):
+    """Make a virtual dataset concatenating dataset name along axis 0"""
+    ds0 = h5fs[0][name]
+    lens = []
+    for h5f in h5fs:
+        ds = h5f[name]
+        if ds.shape[1:] != ds0.shape[1:] or ds.dtype != ds0.dtype:
+            print('build_virtual_file: mismatched shape or dtype for', name,
+                  ':', ds.shape, ds.dtype, 'vs', ds0.shape, ds0.dtype)
+        lens.append(ds.shape[0])
+    n_rows = sum(lens)
+    if n_rows == 0:
+        # HDF5 can't make an empty virtual dataset: make a regular one
+        ds = vds.create_dataset(name, shape=ds0.shape, dtype=ds0.dtype, 
+                                maxshape=(None,)+ds0.shape[1:])
+        ds.attrs.update(ds0.attrs)
+        return 0
+    layout = h5py.VirtualLayout(shape=(n_rows,)+ds0.shape[1:], dtype=ds0.dtype)
+    start = 0
+    for h5f, src_path, n in zip(h5fs, src_paths, lens):
+        if n == 0: continue
+        layout[start:start+n] = h5py.VirtualSource(src_path, name, shape=h5f[name].shape)
+        start += n
+    ds = vds.create_virtual_dataset(name, layout)
+    ds.attrs.update(ds0.attrs)
+    return n_rows
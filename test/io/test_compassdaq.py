@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import pygama.lh5 as lh5
+from pygama.io.compassdaq import CAENDT57XX, process_compass
+
+
+@pytest.mark.parametrize('e_type', ['uncalibrated', 'calibrated'])
+@pytest.mark.parametrize('partial', [False, True])
+def test_process_compass(tmp_path, e_type, partial):
+    digitizer = CAENDT57XX()
+    digitizer.set_e_type(e_type)
+    n_events, num_samples = 50, 16
+    rng = np.random.default_rng(0)
+    events = np.zeros(n_events, dtype=digitizer.get_event_dtype(num_samples))
+    events['board'] = rng.integers(0, 4, n_events)
+    events['channel'] = rng.integers(0, 16, n_events)
+    events['timestamp'] = np.cumsum(rng.integers(1, 10**6, n_events))
+    events['energy'] = rng.integers(0, 2**14, n_events)
+    if e_type == 'calibrated': events['energy'] += rng.random(n_events)
+    events['energy_short'] = rng.integers(0, 2**14, n_events)
+    events['flags'] = rng.integers(0, 2**32, n_events)
+    events['num_samples'] = num_samples
+    events['waveform'] = rng.integers(0, 2**14, (n_events, num_samples))
+
+    daq_file = str(tmp_path / 'compass.bin')
+    with open(daq_file, 'wb') as f:
+        f.write(events.tobytes())
+        # an event cut off by the end of the run
+        if partial: f.write(events[:1].tobytes()[:20])
+    raw_file = str(tmp_path / 'compass.lh5')
+    n_bytes = process_compass(daq_file, raw_file, buffer_size=7, e_type=e_type)
+    assert n_bytes == events.nbytes
+
+    tbl, n_rows = lh5.Store().read_object('CAENDT57XX/raw', raw_file)
+    assert n_rows == n_events
+    for field in ['board', 'channel', 'timestamp', 'energy', 'energy_short', 'flags', 'num_samples']:
+        assert np.array_equal(tbl[field].nda, events[field])
+    assert tbl['energy'].nda.dtype == events['energy'].dtype
+    assert np.array_equal(tbl['waveform']['values'].nda, events['waveform'])
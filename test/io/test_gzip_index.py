@@ -0,0 +1,48 @@
+import gzip
+import numpy as np
+import pytest
+
+from pygama.io.gzip_index import get_libz, get_gzip_index, GzipIndex, IndexedGzipFile
+
+pytestmark = pytest.mark.skipif(get_libz() is None, reason='zlib library not found')
+
+
+def write_gz(path, n_members=1, n_bytes=2**20, seed=0):
+    """Write compressible pseudo-random data as n_members gzip members"""
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 16, n_bytes, dtype='uint8').tobytes()
+    bounds = np.linspace(0, n_bytes, n_members+1).astype(int)
+    with open(path, 'wb') as f:
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            f.write(gzip.compress(data[start:stop]))
+    return data
+
+
+@pytest.mark.parametrize('n_members', [1, 3])
+def test_indexed_reads(tmp_path, n_members):
+    gz_file = str(tmp_path / 'data.gz')
+    data = write_gz(gz_file, n_members)
+    with gzip.open(gz_file, 'rb') as f: assert f.read() == data
+
+    index = get_gzip_index(gz_file, span=2**16)
+    assert index.size == len(data)
+    assert len(index.out_pos) > 4
+    assert GzipIndex.load(gz_file + '.gzidx').matches(gz_file)
+
+    with IndexedGzipFile(gz_file, index=index) as f:
+        assert f.read() == data
+        # at access points, between them, across them, backwards
+        points = index.out_pos.tolist()
+        offsets = points + [p + 12345 for p in points] + [points[2] - 10, 1000, 0]
+        for offset in offsets:
+            f.seek(offset)
+            assert f.read(2**16 + 17) == data[offset:offset + 2**16 + 17]
+        # past the end
+        f.seek(len(data) - 10)
+        assert f.read(100) == data[-10:]
+        assert f.read(100) == b''
+        f.seek(len(data) + 100)
+        assert f.read(10) == b''
+        # numpy positions, e.g. from a packet index
+        f.seek(np.int64(points[1]))
+        assert f.read(np.uint32(100)) == data[points[1]:points[1] + 100]
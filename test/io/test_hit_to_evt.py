@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+import pygama.lh5 as lh5
+from pygama.io.hit_to_evt import build_tcm, cluster_events, order_files
+
+
+def make_hits(n_chans=4, n_events=2000, seed=0):
+    """Time-ordered hits of coincident events, as one DataFrame per channel"""
+    rng = np.random.default_rng(seed)
+    t_evt = np.cumsum(rng.exponential(1e-4, n_events))
+    dfs = []
+    for ch in range(n_chans):
+        sel = rng.random(n_events) < 0.5
+        ts = np.sort(np.round((t_evt[sel] + rng.normal(0, 1e-7, sel.sum()))/1e-8).astype(np.int64))
+        dfs.append(pd.DataFrame({'timestamp': ts,
+                                 'channel': np.full(len(ts), ch, dtype=np.int32),
+                                 'energy': rng.random(len(ts))}))
+    return dfs
+
+
+def write_hits(dfs, f):
+    store = lh5.Store()
+    for ch, df in enumerate(dfs):
+        col_dict = {col: lh5.Array(nda=df[col].values) for col in df.columns}
+        store.write_object(lh5.Table(col_dict=col_dict), f'ch{ch}/raw', f)
+
+
+def read_tcm(tcm_chunks):
+    chunks = [pd.DataFrame({col: tb[col].nda for col in tb.keys()}) for tb in tcm_chunks]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def test_build_tcm(tmp_path):
+    dfs = make_hits()
+    f = str(tmp_path / 'hits.lh5')
+    write_hits(dfs, f)
+    ref = cluster_events([df.copy() for df in dfs])
+    tables = [f'ch{ch}/raw' for ch in range(len(dfs))]
+
+    for buffer_len in [7, 10**6]:
+        tcm = read_tcm(build_tcm(f, tables, data_cols=['energy', 'timestamp'], buffer_len=buffer_len))
+        assert len(tcm) == len(ref)
+        assert np.array_equal(tcm['ix_evt'], ref['ix_evt'])
+        assert np.array_equal(tcm['ix_hit'], ref['ix_hit'])
+        assert np.allclose(tcm['tcm_sec'], ref['tcm_sec'])
+        for ch, df in enumerate(dfs):
+            hits = tcm[tcm['channel'] == ch]
+            assert np.array_equal(hits['ix_row'], np.arange(len(df)))
+            assert np.array_equal(hits['energy'], df['energy'])
+            assert np.array_equal(hits['timestamp'], df['timestamp'])
+
+
+def test_build_tcm_multi_file(tmp_path):
+    dfs = make_hits(n_chans=3, n_events=3000, seed=1)
+    # cut the run into 3 cycles in the middle of two events, so that their
+    # hits end up in different files
+    t_cuts = []
+    for i_cut in [1000, 2000]:
+        ts = np.sort(np.concatenate([df['timestamp'].values for df in dfs]))
+        t_cut = ts[len(ts)*i_cut//3000]
+        t_cuts.append(t_cut)
+        for df in dfs:
+            near = np.abs(df['timestamp'].values - t_cut) < 200
+            df.loc[near & (np.arange(len(df)) % 2 == 0), 'timestamp'] = t_cut - 1
+            df.loc[near & (np.arange(len(df)) % 2 == 1), 'timestamp'] = t_cut + 1
+            df.sort_values('timestamp', inplace=True, ignore_index=True)
+
+    # file names in reverse time order, and channel 2 missing in cycle 1
+    store = lh5.Store()
+    files = [str(tmp_path / f'cycle{2-i}.lh5') for i in range(3)]
+    for ch, df in enumerate(dfs):
+        cycle = np.searchsorted(t_cuts, df['timestamp'].values)
+        if ch == 2: dfs[ch] = df = df[cycle != 1].reset_index(drop=True)
+        cycle = np.searchsorted(t_cuts, df['timestamp'].values)
+        for i in range(3):
+            if ch == 2 and i == 1: continue
+            sel = cycle == i
+            col_dict = {col: lh5.Array(nda=df[col].values[sel]) for col in df.columns}
+            store.write_object(lh5.Table(col_dict=col_dict), f'ch{ch}/raw', files[i])
+
+    ref = cluster_events([df.copy() for df in dfs])
+    tables = [f'ch{ch}/raw' for ch in range(3)]
+    f_sorted, n_rows = order_files(sorted(files), tables)
+    assert f_sorted == files
+    assert n_rows[1, 2] == 0
+
+    tcm = read_tcm(build_tcm(str(tmp_path / 'cycle*.lh5'), tables,
+                             data_cols=['energy'], buffer_len=7))
+    assert np.array_equal(tcm['ix_evt'], ref['ix_evt'])
+    assert np.array_equal(tcm['ix_hit'], ref['ix_hit'])
+    assert (tcm.groupby('ix_evt')['ix_file'].nunique() > 1).sum() == 2
+    for (i_file, ch), hits in tcm.groupby(['ix_file', 'channel']):
+        energy = lh5.load_nda(f_sorted[i_file], ['energy'], f'ch{ch}/raw', verbose=False)['energy']
+        assert np.array_equal(energy[hits['ix_row'].values], hits['energy'].values)
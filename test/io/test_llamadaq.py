@@ -0,0 +1,111 @@
+import numpy as np
+
+import pygama.lh5 as lh5
+from pygama.io.llamadaq import process_llama_3316, LLAMA_BAD_LENGTH
+
+
+# channel -> (FADC, event length in words). FADC 0 has a single event
+# length, FADC 1 two different ones
+CHANNELS = { 0 : (0, 27), 1 : (0, 27), 2 : (1, 27), 3 : (1, 12) }
+N_SAMPLES = 20
+
+
+def make_event(rng, channel, format_bits, length, bad=False):
+    """An event of length words, and the values decode_events() should find
+    in it. Bad events get a waveform length that doesn't match"""
+    words = [0] * length
+    ts = int(rng.integers(0, 2**48))
+    words[0] = ((ts >> 16) & 0xffff0000) | (channel << 4) | format_bits
+    words[1] = ts & 0xffffffff
+    values = { 'channel' : channel, 'timestamp' : ts }
+    for field in ['peakhigh_value', 'peakhigh_index', 'information', 'mawMax', 'maw_before',
+                  'maw_after', 'energy_first', 'energy'] + [f'accumulator{i}' for i in range(1, 9)]:
+        values[field] = 0
+    offset = 2
+    if format_bits & 0x1:
+        values['peakhigh_value'], values['peakhigh_index'] = rng.integers(0, 2**16, 2).tolist()
+        values['information'] = int(rng.integers(0, 2**8))
+        values['accumulator1'] = int(rng.integers(0, 2**24))
+        words[offset] = values['peakhigh_value'] | (values['peakhigh_index'] << 16)
+        words[offset+1] = (values['information'] << 24) | values['accumulator1']
+        for i in range(2, 7): words[offset+i] = values[f'accumulator{i}'] = int(rng.integers(0, 2**32))
+        offset += 7
+    fields = [(0x2, ['accumulator7', 'accumulator8']), (0x4, ['mawMax', 'maw_before', 'maw_after']),
+              (0x8, ['energy_first', 'energy'])]
+    for bit, bit_fields in fields:
+        if not format_bits & bit: continue
+        for field in bit_fields:
+            words[offset] = values[field] = int(rng.integers(0, 2**32))
+            offset += 1
+    if offset < length:
+        n_wf32 = length - offset - 1
+        words[offset] = n_wf32 + 1 if bad else n_wf32
+        wf = rng.integers(0, 2**14, 2*n_wf32).astype('uint16')
+        words[offset+1:] = wf.view('uint32').tolist()
+        values['waveform'] = np.zeros(N_SAMPLES, dtype='uint16')
+        values['waveform'][:min(len(wf), N_SAMPLES)] = wf[:N_SAMPLES]
+    return words, values
+
+
+def write_llama_file(path, seed=0):
+    """Write a llamaDAQ file with a file header, the channel configurations
+    and chunks of events with mixed format bits. Returns the expected values
+    for each event, by index in the file, and the indices of bad events"""
+    rng = np.random.default_rng(seed)
+    words = [0x5572414c, (1 << 16) | 2, (68 << 16) | 3, len(CHANNELS)]
+    for channel, (fadc, length) in CHANNELS.items():
+        conf = np.zeros(17, dtype='uint32')
+        conf[:4] = [fadc, channel, 0x3, 100]
+        conf[4:8] = np.array([250., 0.5]).view('uint32')
+        conf[8:12] = [0xf, N_SAMPLES, 0, length]
+        words.extend(conf.tolist())
+
+    events, bad = [], []
+    for i_chunk in range(12):
+        fadc = i_chunk % 2
+        channels = [ch for ch, (f, _) in CHANNELS.items() if f == fadc]
+        n_evts = int(rng.integers(0, 6))
+        words.extend([fadc, n_evts])
+        for i in range(n_evts):
+            channel = int(rng.choice(channels))
+            length = CHANNELS[channel][1]
+            # short events only fit part of the header fields
+            format_bits = int(rng.integers(0, 16)) if length == 27 else int(rng.choice([0, 2, 4, 8]))
+            # a few with a bad waveform length, and the first event of the
+            # short channel after the fifth too short for all header fields
+            is_bad = len(events) in [5, 17] or (channel == 3 and len(events) > 5 and
+                                                 not any(events[i]['channel'] == 3 for i in bad))
+            evt_words, values = make_event(rng, channel, format_bits, length, is_bad and channel != 3)
+            values['fadcID'] = fadc
+            if is_bad:
+                if channel == 3: evt_words[0] |= 0xf
+                bad.append(len(events))
+            words.extend(evt_words)
+            events.append(values)
+    with open(path, 'wb') as f: f.write(np.array(words, dtype='uint32').tobytes())
+    return events, bad
+
+
+def test_process_llama_3316(tmp_path):
+    daq_file = str(tmp_path / 'run.bin')
+    events, bad = write_llama_file(daq_file)
+    raw_file = str(tmp_path / 'run.lh5')
+    n_bytes = process_llama_3316(daq_file, raw_file, 0, np.inf, None, False, buffer_size=5)
+    assert n_bytes == len(open(daq_file, 'rb').read())
+
+    store = lh5.Store()
+    tbl, n_rows = store.read_object('SIS3316Decoder/raw', raw_file)
+    assert n_rows == len(events) - len(bad)
+    assert np.array_equal(tbl['ievt'].nda, np.arange(n_rows))
+    packet_ids = tbl['packet_id'].nda
+    assert np.array_equal(np.sort(packet_ids), np.setdiff1d(np.arange(len(events)), bad))
+    for field in tbl.keys():
+        if field in ['packet_id', 'ievt']: continue
+        nda = tbl['waveform']['values'].nda if field == 'waveform' else tbl[field].nda
+        for row, i_evt in enumerate(packet_ids.tolist()):
+            assert np.array_equal(nda[row], events[i_evt][field]), (field, i_evt)
+
+    garbage, n_garbage = store.read_object('SIS3316Decoder/garbage', raw_file)
+    assert n_garbage == len(bad)
+    assert sorted(garbage['packet_id'].nda.tolist()) == bad
+    assert np.all(garbage['garbage_code'].nda == LLAMA_BAD_LENGTH)
@@ -0,0 +1,145 @@
+import copy
+import numpy as np
+import pytest
+
+import pygama.lh5 as lh5
+from pygama.io.ch_group import ChannelTables
+from pygama.io.orcadaq import get_ccc
+from pygama.io.orca_digitizers import ORCAStruck3302, ORCAGretina4M, SIS3316ORCADecoder
+
+
+def make_3302_packet(rng, ccc_word, wf_len32=20):
+    """A SIS3302 packet, with buffer wrap half of the time. Some get a bad
+    trailer or length, to end up in the garbage"""
+    wrap = int(rng.integers(0, 2))
+    header = [ccc_word | wrap, wf_len32, 3] + rng.integers(0, 2**32, 4 if wrap else 2).tolist()
+    if wrap: header[6] = int(rng.integers(0, 2*wf_len32))
+    body = header + rng.integers(0, 2**32, wf_len32 + 3 + 3).tolist() + [0xdeadbeef]
+    bad = rng.random()
+    if bad < 0.05: body[-1] = 0
+    elif bad < 0.1: body[1] += 1
+    return body
+
+
+def make_3316_packet(rng, ccc_word, wf_len16=60):
+    """A SIS3316 packet, a few of them with the wrong waveform length"""
+    if rng.random() < 0.1: wf_len16 += 2
+    body = rng.integers(0, 2**32, 26 + wf_len16//2).tolist()
+    body[0] = ccc_word
+    return body
+
+
+def make_gretina_packet(rng, ccc):
+    """A Gretina4M packet: 18 16-bit header words and 2018 samples"""
+    body = rng.integers(0, 2**16, 2*1018).astype('uint16')
+    crate, card, channel = ccc >> 9, (ccc >> 4) & 0x1f, ccc & 0xf
+    body[1] = (crate << 5) | card
+    body[4] = (body[4] & 0xFFF0) | channel
+    return body.view('uint32').tolist()
+
+
+def make_packets(decoder, n_packets, seed=0):
+    """Packets of random channels on crate 1, card 2, in a word array as
+    returned by OrcaPacketReader.iter_chunks()"""
+    rng = np.random.default_rng(seed)
+    packets = []
+    for i in range(n_packets):
+        ccc = get_ccc(1, 2, int(rng.integers(0, 8)))
+        ccc_word = (1 << 21) | (2 << 16) | ((ccc & 0xf) << 8)
+        if isinstance(decoder, ORCAStruck3302): body = make_3302_packet(rng, ccc_word)
+        elif isinstance(decoder, SIS3316ORCADecoder): body = make_3316_packet(rng, ccc_word)
+        else: body = make_gretina_packet(rng, ccc)
+        packets.append([(5 << 18) | (len(body)+1)] + body)
+    lengths = np.array([len(pkt) for pkt in packets], dtype='uint32')
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('int64')
+    words = np.array([w for pkt in packets for w in pkt], dtype='uint32')
+    return words, offsets, lengths
+
+
+def build_decoder_tables(decoder_class, routing, size=7):
+    """A decoder and its tables of size rows. Channels 0 and 1 share a
+    table, 3 and 4 have their own, and 2 (inside the look-up array) and 5-7
+    (past its end) are skipped"""
+    decoder = decoder_class()
+    wf_len = { ORCAStruck3302 : 40, SIS3316ORCADecoder : 60, ORCAGretina4M : 2000 }
+    for channel in range(8):
+        ccc = get_ccc(1, 2, channel)
+        decoder.decoded_values[ccc] = copy.deepcopy(decoder.decoded_values_template)
+        decoder.decoded_values[ccc]['waveform']['length'] = wf_len[decoder_class]
+        if decoder_class is ORCAGretina4M: decoder.ft_len[ccc] = 0
+    if routing == 'single':
+        tables = lh5.Table(size)
+        init_table(decoder, tables, 0)
+        return decoder, tables
+    tables = ChannelTables()
+    for channels in [[0, 1], [3], [4]]:
+        tb = lh5.Table(size)
+        init_table(decoder, tb, channels[0])
+        tables.add_table(tb, [get_ccc(1, 2, ch) for ch in channels])
+    return decoder, tables
+
+
+def init_table(decoder, tb, channel):
+    # zero the buffers: some fields are not filled by the decoders
+    decoder.initialize_lh5_table(tb, get_ccc(1, 2, channel))
+    for field in tb.keys():
+        nda = tb[field]['values'].nda if field == 'waveform' else tb[field].nda
+        nda[:] = 0
+
+
+def table_list(tables):
+    return [tables] if isinstance(tables, lh5.Table) else tables.tables
+
+
+def flush(tables, rows, force=False):
+    """Move the rows of the full tables (or all, if force) to rows"""
+    for i_tb, tb in enumerate(table_list(tables)):
+        if not (force or tb.is_full()): continue
+        for field in tb.keys():
+            nda = tb[field]['values'].nda if field == 'waveform' else tb[field].nda
+            rows.setdefault((i_tb, field), []).append(nda[:tb.loc].copy())
+        tb.clear()
+
+
+@pytest.mark.parametrize('decoder_class', [ORCAStruck3302, ORCAGretina4M, SIS3316ORCADecoder])
+@pytest.mark.parametrize('routing', ['single', 'channels'])
+def test_decode_packets(decoder_class, routing):
+    words, offsets, lengths = make_packets(decoder_class(), 200)
+    packet_ids = np.arange(len(offsets), dtype='uint32') + 1
+
+    # one packet at a time
+    decoder, tables = build_decoder_tables(decoder_class, routing)
+    ref = {}
+    for i in range(len(offsets)):
+        start, stop = offsets[i] + 1, offsets[i] + lengths[i]
+        decoder.decode_packet(memoryview(words[start:stop]), tables, int(packet_ids[i]), {})
+        flush(tables, ref)
+    flush(tables, ref, force=True)
+    ref_decoder, ref_tables = decoder, tables
+
+    # in batches, which get cut where a table fills up
+    decoder, tables = build_decoder_tables(decoder_class, routing)
+    rows = {}
+    i = 0
+    while i < len(offsets):
+        n_done = decoder.decode_packets(words, offsets[i:i+50], lengths[i:i+50], packet_ids[i:i+50], tables, {})
+        assert n_done > 0
+        i += n_done
+        flush(tables, rows)
+    flush(tables, rows, force=True)
+
+    assert rows.keys() == ref.keys()
+    for key in ref:
+        assert np.array_equal(np.concatenate(rows[key]), np.concatenate(ref[key])), key
+    assert decoder.ievt == ref_decoder.ievt
+    if routing == 'channels':
+        assert tables.skipped_channels() == ref_tables.skipped_channels()
+        assert len(tables.skipped_channels()) == 4
+    garbage, ref_garbage = decoder.garbage_table, ref_decoder.garbage_table
+    assert garbage.loc == ref_garbage.loc
+    if decoder_class is not ORCAGretina4M: assert garbage.loc > 0
+    for field in ['packet_id', 'garbage_code']:
+        assert np.array_equal(garbage[field].nda[:garbage.loc], ref_garbage[field].nda[:garbage.loc])
+    n_bytes = garbage['packets'].cumulative_length.nda[garbage.loc-1] if garbage.loc > 0 else 0
+    assert np.array_equal(garbage['packets'].flattened_data.nda[:n_bytes],
+                          ref_garbage['packets'].flattened_data.nda[:n_bytes])
@@ -0,0 +1,84 @@
+import os
+import time
+import gzip
+import plistlib
+import socket
+import threading
+import numpy as np
+import pytest
+
+from pygama.io.orcadaq import read_header
+from pygama.io.orca_packets import OrcaPacketReader, OrcaStreamReader, replay_orca
+
+
+def write_orca_file(path, n_packets=2000, seed=0):
+    """Write an ORCA file with a minimal header and packets of random length
+    and data ID. Returns the header length in bytes and the packets (data ID
+    and bytes without the header word)"""
+    rng = np.random.default_rng(seed)
+    header = { 'dataDescription' : { 'ORFooModel' : { 'Bar' : { 'dataId' : 5<<18 } } } }
+    xml = plistlib.dumps(header, fmt=plistlib.FMT_XML)
+    n_xml = len(xml)
+    xml += b'\0' * (-n_xml % 4)
+    words = [np.array([len(xml)//4 + 2, n_xml], dtype='uint32'), np.frombuffer(xml, dtype='uint32')]
+    packets = []
+    for i in range(n_packets):
+        # mostly small packets, a few larger than the read blocks
+        length = int(rng.integers(2, 200)) if i % 500 else 5000
+        data_id = int(rng.integers(1, 8))
+        pkt = rng.integers(0, 2**32, length, dtype='uint32')
+        pkt[0] = (data_id << 18) | length
+        words.append(pkt)
+        packets.append((data_id, pkt[1:].tobytes()))
+    with open(path, 'wb') as f: f.write(np.concatenate(words).tobytes())
+    return words[0][0]*4, packets
+
+
+def read_packets(reader):
+    return [(int(data_id), bytes(packet)) for packet, data_id in reader]
+
+
+def test_packet_reader(tmp_path):
+    orca_file = str(tmp_path / 'run.orca')
+    start_byte, packets = write_orca_file(orca_file)
+    with open(orca_file, 'rb') as f: data = f.read()
+    with gzip.open(orca_file + '.gz', 'wb') as f: f.write(data)
+
+    with OrcaPacketReader(orca_file, start_byte=start_byte, chunk_len=100) as reader:
+        assert read_packets(reader) == packets
+    with OrcaPacketReader(orca_file + '.gz', start_byte=start_byte, block_size=2**12) as reader:
+        assert read_packets(reader) == packets
+
+    # reading in two byte ranges split at a packet boundary
+    split = start_byte + sum(4 + len(pkt) for _, pkt in packets[:700])
+    for f in [orca_file, orca_file + '.gz']:
+        with OrcaPacketReader(f, start_byte=start_byte, stop_byte=split) as reader:
+            first = read_packets(reader)
+        with OrcaPacketReader(f, start_byte=split) as reader:
+            assert first + read_packets(reader) == packets
+
+
+@pytest.mark.parametrize('destination', ['file', 'unix'])
+def test_stream_reader_replay(tmp_path, destination):
+    orca_file = str(tmp_path / 'run.orca')
+    start_byte, packets = write_orca_file(orca_file, seed=1)
+    if destination == 'file': source = str(tmp_path / 'growing.orca')
+    else:
+        if not hasattr(socket, 'AF_UNIX'): pytest.skip('no unix sockets')
+        source = 'unix://' + str(tmp_path / 'orca.sock')
+    replay = threading.Thread(target=replay_orca, args=(orca_file, source),
+                              kwargs={ 'block_size' : 3333, 'interval' : 0.001 })
+    replay.start()
+
+    # wait for the growing file to appear
+    if destination == 'file':
+        while not os.path.exists(source): time.sleep(0.01)
+
+    with OrcaStreamReader(source, block_size=2**12, poll_interval=0.05, idle_timeout=1) as reader:
+        reclen, header_nbytes, header_dict = read_header(reader)
+        assert reclen*4 == start_byte
+        assert 'ORFooModel' in header_dict['dataDescription']
+        reader.read(reclen*4 - reader.tell())
+        streamed = read_packets(reader)
+    replay.join()
+    assert streamed == packets
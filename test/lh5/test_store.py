@@ -0,0 +1,273 @@
+import numpy as np
+import pytest
+
+import pygama.lh5 as lh5
+
+
+def write_test_files(tmp_path, n_files=3, n_rows=10):
+    store = lh5.Store()
+    files = []
+    for i in range(n_files):
+        f = str(tmp_path / f'test{i}.lh5')
+        col_dict = {
+            'energy': lh5.Array(nda=np.arange(n_rows) + 100*i),
+            'wf': lh5.ArrayOfEqualSizedArrays(nda=np.full((n_rows, 4), i), dims=[1,1]),
+        }
+        store.write_object(lh5.Table(col_dict=col_dict), 'tb', f, group='geds')
+        files.append(f)
+    return files
+
+
+def test_load_nda(tmp_path):
+    files = write_test_files(tmp_path)
+    par_data = lh5.load_nda(files, ['energy', 'wf'], 'geds/tb', verbose=False)
+    assert np.array_equal(par_data['energy'], 
+                          np.concatenate([np.arange(10) + 100*i for i in range(3)]))
+    assert par_data['wf'].shape == (30, 4)
+
+    idx_list = [np.array([1, 3]), np.array([0]), np.array([5, 9, 12])]
+    par_data = lh5.load_nda(files, ['energy'], 'geds/tb', idx_list=idx_list, 
+                            verbose=False, n_threads=3)
+    assert np.array_equal(par_data['energy'], [1, 3, 100, 205, 209])
+
+    # parameters of different lengths are concatenated independently
+    store = lh5.Store()
+    for i, f in enumerate(files):
+        store.write_object(lh5.Array(nda=np.arange(i+1)), 'n', f, group='geds/tb')
+    par_data = lh5.load_nda(files, ['energy', 'n'], 'geds/tb', verbose=False)
+    assert len(par_data['energy']) == 30
+    assert np.array_equal(par_data['n'], [0, 0, 1, 0, 1, 2])
+    assert lh5.load_nda(files, ['energy', 'missing'], 'geds/tb', verbose=False) is None
+
+
+def test_read_vov_start_row(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    store = lh5.Store()
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(10)),
+                              cumulative_length=lh5.Array(nda=np.array([1, 3, 6, 10], dtype='uint32')))
+    store.write_object(vov, 'vov', f)
+    vov, n_rows = store.read_object('vov', f, start_row=2, n_rows=1)
+    assert n_rows == 1
+    assert np.array_equal(vov.cumulative_length.nda, [3])
+    assert np.array_equal(vov.flattened_data.nda, [3, 4, 5])
+
+
+def test_build_virtual_file(tmp_path):
+    files = write_test_files(tmp_path)
+    store = lh5.Store()
+    for i, f in enumerate(files):
+        vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(6) + 10*i),
+                                  cumulative_length=lh5.Array(nda=np.array([1, 3, 6], dtype='uint32')))
+        store.write_object(vov, 'vov', f)
+
+    vds_file = str(tmp_path / 'vds' / 'run.lh5')
+    n_rows = lh5.build_virtual_file(files, vds_file, ['geds/tb', 'vov'])
+    assert n_rows == {'geds/tb': 30, 'vov': 9}
+
+    tb, n_rows_read = store.read_object('geds/tb', vds_file)
+    assert n_rows_read == 30
+    assert np.array_equal(tb['energy'].nda, 
+                          np.concatenate([np.arange(10) + 100*i for i in range(3)]))
+    vov, _ = store.read_object('vov', vds_file)
+    assert np.array_equal(vov.cumulative_length.nda, [1, 3, 6, 7, 9, 12, 13, 15, 18])
+    assert np.array_equal(vov.flattened_data.nda[6:12], np.arange(6) + 10)
+
+
+def test_obj_info_cache(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    store = lh5.Store()
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(10.))})
+    store.write_object(tbl, 'tb', f)
+    assert store.read_n_rows('tb', f) == 10
+    info = store.get_obj_info('tb/energy', f)
+    assert info['datatype'] == 'array' and info['ds_shape'] == (10,)
+
+    # appending must invalidate the cached shapes
+    store.write_object(tbl, 'tb', f)
+    assert store.read_n_rows('tb', f) == 20
+    assert store.ls(f) == ['tb']
+
+    # a default Store must see appends made by another Store
+    lh5.Store().write_object(tbl, 'tb', f)
+    assert store.read_n_rows('tb', f) == 30
+    tbl_read, n_rows = store.read_object('tb', f)
+    assert n_rows == 30
+
+    # a Store keeping its files open caches until clear_cache()
+    store = lh5.Store(keep_open=True)
+    assert store.read_n_rows('tb', f) == 30
+    assert 'tb/energy' in store.obj_info[store.gimme_file(f, 'r').filename]
+    store.close()
+
+
+def test_obj_info_cache_chunked_read(tmp_path, monkeypatch):
+    f = str(tmp_path / 'test.lh5')
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(100)),
+                              cumulative_length=lh5.Array(nda=np.arange(10, 101, 10, dtype='uint32')))
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(10.)), 'tr': vov})
+    lh5.Store().write_object(tbl, 'tb', f)
+
+    # count the metadata read from the file
+    n_parsed = []
+    parse_datatype = lh5.store.parse_datatype
+    monkeypatch.setattr(lh5.store, 'parse_datatype', lambda dt: n_parsed.append(dt) or parse_datatype(dt))
+
+    # a chunked read loop like raw_to_dsp's reads the metadata only once
+    store = lh5.Store(keep_open=True)
+    buf, _ = store.read_object('tb', f, start_row=0, n_rows=3)
+    n_first = len(n_parsed)
+    energy = []
+    for start_row in range(0, 10, 3):
+        buf, n_rows = store.read_object('tb', f, start_row=start_row, n_rows=3, obj_buf=buf)
+        energy.extend(buf['energy'].nda[:n_rows])
+    assert np.array_equal(energy, np.arange(10.))
+    assert n_first > 0 and len(n_parsed) == n_first
+    store.close()
+
+    # without keep_open, every chunk reads the metadata again
+    store = lh5.Store()
+    store.read_object('tb', f, start_row=3, n_rows=3, obj_buf=buf)
+    assert len(n_parsed) == 2*n_first
+
+
+def test_amortized_appends(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    store = lh5.Store(amortize_appends=True)
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(6)),
+                              cumulative_length=lh5.Array(nda=np.array([1, 3, 6], dtype='uint32')))
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(3.)), 'vov': vov})
+    for i in range(10): store.write_object(tbl, 'tb', f, n_rows=(2 if i%2 else 3))
+
+    # reads through the same store see only the rows written
+    assert store.read_n_rows('tb', f) == 25
+    store.close()
+
+    # the input must not be modified, and the file must have been trimmed
+    assert np.array_equal(vov.cumulative_length.nda, [1, 3, 6])
+    tbl, n_rows = lh5.Store().read_object('tb', f)
+    assert n_rows == 25
+    assert np.array_equal(tbl['vov'].cumulative_length.nda[:5], [1, 3, 6, 7, 9])
+    assert tbl['vov'].cumulative_length.nda[-1] == 5*6 + 5*3
+    assert len(tbl['vov'].flattened_data) == 45
+
+    # structs without any arrays take the normal path
+    store = lh5.Store(amortize_appends=True)
+    for i in range(3): store.write_object(lh5.Struct({'a': lh5.Struct({})}), 'st', f)
+    store.close()
+    assert lh5.Store().ls(f, 'st/') == ['st/a']
+
+
+def test_vov_append_two_writers(tmp_path):
+    # without amortized appends, the in-file cumulative_length offset must be
+    # re-read for each append, so that other writers' appends are seen
+    f = str(tmp_path / 'test.lh5')
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(3)),
+                              cumulative_length=lh5.Array(nda=np.array([1, 3], dtype='uint32')))
+    store_a, store_b = lh5.Store(), lh5.Store()
+    store_a.write_object(vov, 'vov', f)
+    store_b.write_object(vov, 'vov', f)
+    store_a.write_object(vov, 'vov', f)
+    vov_read, n_rows = lh5.Store().read_object('vov', f)
+    assert n_rows == 6
+    assert vov_read.cumulative_length.nda.tolist() == [1, 3, 4, 6, 7, 9]
+
+
+def test_async_writer(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    writer = lh5.AsyncWriter(n_buffers=2)
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.zeros(20)),
+                              cumulative_length=lh5.Array(nda=np.zeros(4, dtype='uint32')))
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.zeros(4)), 'vov': vov})
+    tables = set()
+    for i in range(10):
+        tables.add(id(tbl))
+        tbl['energy'].nda[:] = np.arange(4) + 4*i
+        tbl['vov'].cumulative_length.nda[:] = [1, 2, 3, 4]
+        tbl['vov'].flattened_data.nda[:4] = i
+        tbl.loc = 4
+        tbl = writer.submit(tbl, 'tb', f, n_rows=tbl.loc)
+        assert tbl.loc == 0
+    # copy=True leaves the caller's table usable right away
+    tbl['energy'].nda[:] = -1
+    writer.write_object(tbl, 'tb', f, n_rows=2, copy=True)
+    tbl['energy'].nda[:] = -2
+    writer.close()
+    assert len(tables) == 2
+
+    tbl, n_rows = lh5.Store().read_object('tb', f)
+    assert n_rows == 42
+    assert np.array_equal(tbl['energy'].nda, np.concatenate([np.arange(40), [-1, -1]]))
+    assert np.array_equal(tbl['vov'].flattened_data.nda[:40], np.repeat(np.arange(10), 4))
+
+
+def test_swmr_tail(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    store = lh5.Store(swmr=True, flush_interval=0)
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(6.)),
+                              cumulative_length=lh5.Array(nda=np.array([1, 3, 6], dtype='uint32')))
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(3.)), 'vov': vov})
+    store.write_object(tbl, 'tb', f, group='geds', n_rows=0)
+    store.start_swmr(f)
+
+    tail = lh5.tail_object('geds/tb', f, buffer_len=4, poll_interval=0.01, timeout=0.1)
+    store.write_object(tbl, 'tb', f, group='geds')
+    chunks = []
+    for buf, n_rows in tail:
+        chunks.append((n_rows, list(buf['energy'].nda[:n_rows]), 
+                       list(buf['vov'].cumulative_length.nda[:n_rows])))
+        if len(chunks) == 1: store.write_object(tbl, 'tb', f, group='geds', n_rows=2)
+    store.close()
+    assert chunks == [(3, [0, 1, 2], [1, 3, 6]), (2, [0, 1], [1, 3])]
+
+
+def test_read_struct_into_buffer(tmp_path):
+    f = str(tmp_path / 'test.lh5')
+    store = lh5.Store()
+    tbl = lh5.Table(col_dict={'flag': lh5.Array(nda=np.array([True, False, True])),
+                              'adc': lh5.Array(nda=np.arange(3, dtype='uint16'))})
+    st = lh5.Struct({'run': lh5.Scalar(np.int32(5)), 
+                     'thr': lh5.Array(nda=np.arange(4.)), 
+                     'status': tbl})
+    store.write_object(st, 'cfg', f)
+
+    buf, _ = store.read_object('cfg', f)
+    ndas = [buf['thr'].nda, buf['status']['flag'].nda, buf['status']['adc'].nda]
+    for i in range(2):
+        buf['thr'].nda[:] = -1
+        buf2, n_rows = store.read_object('cfg', f, obj_buf=buf)
+        assert buf2 is buf and n_rows == 1
+        new_ndas = [buf['thr'].nda, buf['status']['flag'].nda, buf['status']['adc'].nda]
+        assert all(a is b for a, b in zip(new_ndas, ndas))
+        assert buf['run'].value == 5
+        assert np.array_equal(buf['thr'].nda, np.arange(4.))
+        assert np.array_equal(buf['status']['flag'].nda, [True, False, True])
+
+
+def test_append_file(tmp_path):
+    files = write_test_files(tmp_path)
+    out = str(tmp_path / 'merged.lh5')
+    for f in files:
+        n_rows = lh5.append_file(f, out, buffer_len=4)
+        assert n_rows == {'geds/tb': 10}
+    tbl, n_rows = lh5.Store().read_object('geds/tb', out)
+    assert n_rows == 30
+    assert np.array_equal(tbl['energy'].nda,
+                          np.concatenate([np.arange(10) + 100*i for i in range(3)]))
+    assert np.array_equal(tbl['wf'].nda[:, 0], np.repeat(np.arange(3), 10))
+
+
+def test_lh5_to_parquet_jagged(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    f = str(tmp_path / 'jagged.lh5')
+    cl = np.array([1, 2, 3, 8, 13], dtype='uint32')
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(13.)),
+                              cumulative_length=lh5.Array(nda=cl))
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(5)), 'vov': vov})
+    lh5.Store().write_object(tbl, 'tb', f)
+
+    pq_file = str(tmp_path / 'jagged.parquet')
+    assert lh5.lh5_to_parquet(f, 'tb', pq_file, buffer_len=3, verbose=False) == 5
+    pa_tbl = pq.read_table(pq_file)
+    assert pa_tbl.column('energy').to_pylist() == list(range(5))
+    starts = np.concatenate([[0], cl[:-1]])
+    assert pa_tbl.column('vov').to_pylist() == [list(np.arange(13.)[i:j]) for i, j in zip(starts, cl)]
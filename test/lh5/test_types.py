@@ -1,6 +1,32 @@
+import numpy as np
+import pytest
+
 import pygama.lh5 as lh5
 
 
 def test_array():
     a = lh5.Array(shape=(1), dtype=float)
     assert a.dataype_name() == 'array'
+
+
+def test_table_to_arrow():
+    pa = pytest.importorskip('pyarrow')
+    vov = lh5.VectorOfVectors(flattened_data=lh5.Array(nda=np.arange(6)),
+                              cumulative_length=lh5.Array(nda=np.array([1, 1, 6], dtype='uint32')))
+    wf = lh5.ArrayOfEqualSizedArrays(nda=np.arange(6, dtype='uint16').reshape(3, 2), dims=[1,1])
+    tbl = lh5.Table(col_dict={'energy': lh5.Array(nda=np.arange(3.)), 'vov': vov, 'wf': wf})
+    pa_tbl = tbl.to_arrow()
+    assert pa_tbl.num_rows == 3
+    assert pa_tbl.column('energy').to_pylist() == [0., 1., 2.]
+    assert pa_tbl.column('vov').to_pylist() == [[0], [], [1, 2, 3, 4, 5]]
+    assert pa_tbl.column('wf').to_pylist() == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_vov_set_vector_grows():
+    vov = lh5.VectorOfVectors(shape_guess=(4, 2), dtype='uint16')
+    old_data = vov.flattened_data.nda
+    for i in range(4): vov.set_vector(i, np.full(5*i, i, dtype='uint16'))
+    assert vov.cumulative_length.nda.tolist() == [0, 5, 15, 30]
+    assert len(vov.flattened_data.nda) >= 30
+    assert vov.flattened_data.nda[15:30].tolist() == [3]*15
+    assert len(old_data) == 8